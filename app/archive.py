@@ -0,0 +1,223 @@
+#
+# Archive of OptiPass results
+#
+# Results are saved in an SQLite database so they can be reused by any
+# server process, including ones started after the results were made.
+# The database uses write-ahead logging, so processes can read it while
+# another process is adding a run.
+
+from contextlib import closing
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    project TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (key, version)
+);
+CREATE TABLE IF NOT EXISTS levels (
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    budget REAL NOT NULL,
+    habitat REAL NOT NULL,
+    gates TEXT NOT NULL,  -- JSON list of barrier IDs
+    PRIMARY KEY (key, version, level)
+);
+CREATE INDEX IF NOT EXISTS runs_by_project ON runs (project, created);
+'''
+
+def scenario_params(
+        project: str,
+        regions: list[str],
+        budgets: list[int],
+        targets: list[str],
+        weights: list[int] | None,
+        mapping: list[str] | None,
+        decompose: bool = False,
+        optimizer: str | None = None,
+    ) -> dict:
+    '''
+    Put the parameters of an OptiPass request in a standard form, so requests
+    that differ only in the order of the regions have the same key.  Targets
+    are left in their original order because weights are matched to targets
+    by position.  The command that runs the optimizer is part of the key, so
+    results made by a stand-in (see `optipass_command`) are never returned
+    as OptiPass results.
+
+    Returns:
+      a dictionary with the parameter values
+    '''
+    return {
+        'project': project,
+        'regions': sorted(set(regions)),
+        'budgets': list(budgets),
+        'targets': list(targets),
+        'weights': list(weights or []),
+        'mapping': list(mapping or []),
+        'decompose': bool(decompose),
+        'optimizer': optimizer or '',
+    }
+
+def scenario_key(params: dict) -> str:
+    '''
+    Compute the key for a scenario.
+
+    Arguments:
+      params: a dictionary made by `scenario_params`
+
+    Returns:
+      a string with 16 hex digits
+    '''
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+class RunArchive:
+    '''
+    An instance of this class is an interface to the database of saved runs.
+    A run is identified by its scenario key and the version of the project's
+    data (see `ProjectModel`) that was used to make it.  For each budget level
+    the archive has the budget, the potential habitat reported by OptiPass, and
+    the IDs of the selected gates; the full result tables are rebuilt from these
+    values when a run is reused.
+
+    Each method opens its own connection, so an archive can be used by
+    several threads.
+    '''
+
+    def __init__(self, path: Path):
+        '''
+        Open the database, creating it if it doesn't exist.
+
+        Arguments:
+          path: the name of the database file
+        '''
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.connect()) as db, db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        '''
+        Open a connection to the database.  Use it in a `with` statement
+        so the changes are committed, and close it when it's no longer needed
+        (e.g. with `contextlib.closing`).
+        '''
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, version: str, params: dict, cols: dict):
+        '''
+        Add a run to the archive, replacing a saved run with the same key and data version.
+
+        Arguments:
+          version: the data version
+          params: the scenario parameters (see `scenario_params`)
+          cols: a dictionary with lists of budget, habitat, and gate values, one per budget level
+        '''
+        key = scenario_key(params)
+        with closing(self.connect()) as db, db:
+            db.execute('DELETE FROM levels WHERE key = ? AND version = ?', (key, version))
+            db.execute(
+                'INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)',
+                (key, version, params['project'], json.dumps(params), time.time()),
+            )
+            db.executemany(
+                'INSERT INTO levels VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (key, version, i, b, h, json.dumps(list(g)))
+                    for i, (b, h, g) in enumerate(zip(cols['budget'], cols['habitat'], cols['gates']))
+                ],
+            )
+
+    def prune(self, project: str, versions: list[str]) -> int:
+        '''
+        Delete a project's runs that were made with other versions of its data.
+
+        Arguments:
+          project: the project name
+          versions: the data versions to keep
+
+        Returns:
+          the number of runs deleted
+        '''
+        marks = ', '.join('?' * len(versions))
+        with closing(self.connect()) as db, db:
+            old = db.execute(
+                f'SELECT key, version FROM runs WHERE project = ? AND version NOT IN ({marks})',
+                (project, *versions),
+            ).fetchall()
+            db.executemany('DELETE FROM levels WHERE key = ? AND version = ?', old)
+            db.executemany('DELETE FROM runs WHERE key = ? AND version = ?', old)
+        return len(old)
+
+    def lookup(self, key: str, version: str) -> dict | None:
+        '''
+        Find the results of a saved run.
+
+        Arguments:
+          key: the scenario key
+          version: the data version
+
+        Returns:
+          a dictionary with lists of budget, habitat, and gate values, or None
+          if there is no run for the scenario and data version
+        '''
+        with closing(self.connect()) as db, db:
+            rows = db.execute(
+                'SELECT budget, habitat, gates FROM levels WHERE key = ? AND version = ? ORDER BY level',
+                (key, version),
+            ).fetchall()
+        if not rows:
+            return None
+        return {
+            'budget': [r[0] for r in rows],
+            'habitat': [r[1] for r in rows],
+            'gates': [json.loads(r[2]) for r in rows],
+        }
+
+    def runs(self, project: str) -> list[dict]:
+        '''
+        List the saved runs for a project.
+
+        Arguments:
+          project: the project name
+
+        Returns:
+          a list of dictionaries with the key, data version, time the run was saved,
+          and scenario parameters of each run, most recent first
+        '''
+        with closing(self.connect()) as db, db:
+            rows = db.execute(
+                'SELECT key, version, created, params FROM runs WHERE project = ? ORDER BY created DESC',
+                (project,),
+            ).fetchall()
+        return [
+            {'key': k, 'version': v, 'created': c, 'params': json.loads(p)}
+            for k, v, c, p in rows
+        ]
+
+    def params(self, key: str, version: str | None = None) -> dict | None:
+        '''
+        Find the scenario parameters for a saved run.  The parameters are
+        the same for every version of a run, so the version is optional.
+
+        Arguments:
+          key: the scenario key
+          version: the data version (optional)
+
+        Returns:
+          the parameters, or None if there is no such run
+        '''
+        with closing(self.connect()) as db, db:
+            if version is None:
+                row = db.execute('SELECT params FROM runs WHERE key = ? LIMIT 1', (key,)).fetchone()
+            else:
+                row = db.execute('SELECT params FROM runs WHERE key = ? AND version = ?', (key, version)).fetchone()
+        return json.loads(row[0]) if row else None
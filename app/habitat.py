@@ -0,0 +1,327 @@
+#
+# Potential habitat calculations
+#
+# Compute the potential habitat of a river network for a given set of
+# restored gates without running OptiPass.  Only numpy is needed; the
+# frames passed to `from_frames` come from `OptiPass`, so this module can
+# be used when the server starts without importing pandas.
+
+import heapq
+import numpy as np
+
+class HabitatModel:
+    '''
+    An instance of this class computes the potential habitat available when
+    a set of gates (a "portfolio") is restored.
+
+    The cumulative passability of a barrier is the product of the passability
+    values of the barrier itself and every barrier downstream from it.  The
+    potential habitat for a target is the sum, over all barriers, of the
+    cumulative passability times the unscaled habitat above the barrier.
+    These are the same values computed by `OptiPass.add_potential_habitat`.
+
+    The model remembers the portfolio it evaluated most recently.  When it is
+    asked to evaluate a new portfolio it only updates the cumulative passability
+    of barriers in the subtrees above gates that were added or removed, and it
+    adjusts the habitat totals by the difference.
+    '''
+
+    def __init__(self,
+            ids: list[str],
+            dsids: list[str | None],
+            prepass: np.ndarray,
+            postpass: np.ndarray,
+            habitat: np.ndarray,
+            weights: list[int] | None = None,
+            targets: list[str] | None = None,
+            costs: np.ndarray | None = None):
+        '''
+        Instantiate a new model with no gates selected.
+
+        Arguments:
+          ids: barrier IDs
+          dsids: ID of the barrier downstream from each barrier (None or NaN at a river mouth)
+          prepass: array with one row per barrier and one column per target, passability before restoration
+          postpass: same shape as prepass, passability after restoration
+          habitat: same shape as prepass, unscaled habitat
+          weights: target weights (optional, default is 1 for each target)
+          targets: target names (optional, used to label results)
+          costs: cost to restore each gate, NaN if it can't be restored (optional, used by `greedy`)
+        '''
+        self.ids = list(ids)
+        self.index = { x: i for i, x in enumerate(self.ids) }
+
+        self.prepass = np.asarray(prepass, dtype=float).reshape(len(self.ids), -1)
+        self.postpass = np.asarray(postpass, dtype=float).reshape(self.prepass.shape)
+        self.habitat = np.asarray(habitat, dtype=float).reshape(self.prepass.shape)
+
+        ntargets = self.prepass.shape[1]
+        self.weights = np.asarray(weights if weights else [1] * ntargets, dtype=float)
+        self.targets = list(targets) if targets else [f'T{i+1}' for i in range(ntargets)]
+        self.costs = np.full(len(self.ids), np.nan) if costs is None else np.asarray(costs, dtype=float)
+
+        # A downstream ID that is missing or not part of this network
+        # means the barrier is at a river mouth
+        self.parent = np.array([self.index.get(d, -1) for d in dsids], dtype=int)
+        self.children = [[] for _ in self.ids]
+        for i, p in enumerate(self.parent):
+            if p >= 0:
+                self.children[p].append(i)
+
+        self.depth = np.zeros(len(self.ids), dtype=int)
+        for i in self._preorder(np.flatnonzero(self.parent < 0)):
+            if self.parent[i] >= 0:
+                self.depth[i] = self.depth[self.parent[i]] + 1
+
+        self.selected = np.zeros(len(self.ids), dtype=bool)
+        self.cp = np.zeros(self.prepass.shape)
+        self.totals = np.zeros(ntargets)
+        self._update(np.flatnonzero(self.parent < 0))
+
+    @classmethod
+    def from_frames(cls,
+            barriers: 'pandas.DataFrame',
+            passability: 'pandas.DataFrame',
+            mapping: 'pandas.DataFrame',
+            weights: list[int] | None = None):
+        '''
+        Create a model from the data frames built by the `OptiPass` constructor.
+        Missing passability values are replaced by 0, the same way they are
+        in `OptiPass.add_potential_habitat`.
+
+        Arguments:
+          barriers: barrier frame, with ID, DSID, cost, and NPROJ columns
+          passability: passability frame, indexed by row number and with an ID column
+          mapping: target mapping frame, with prepass, postpass, and unscaled columns
+          weights: target weights (optional)
+
+        Returns:
+          a new HabitatModel object
+        '''
+        df = passability.fillna(0).set_index('ID').loc[barriers.ID]
+        return cls(
+            barriers.ID,
+            barriers.DSID,
+            df[list(mapping.prepass)].to_numpy(),
+            df[list(mapping.postpass)].to_numpy(),
+            df[list(mapping.unscaled)].to_numpy(),
+            weights,
+            list(mapping.index),
+            barriers.cost.where(barriers.NPROJ == 1).to_numpy(dtype=float),
+        )
+
+    def select(self, gates: list[str]):
+        '''
+        Make a set of gates the current portfolio.  Cumulative passabilities
+        are updated only in the subtrees above the gates that changed.
+
+        Arguments:
+          gates: IDs of the gates to restore
+        '''
+        wanted = np.zeros(len(self.ids), dtype=bool)
+        wanted[[self.index[g] for g in gates]] = True
+        flipped = np.flatnonzero(wanted != self.selected)
+        self.selected = wanted
+        self._update(flipped)
+
+    def evaluate(self, gates: list[str]) -> tuple:
+        '''
+        Compute the potential habitat for a portfolio.
+
+        Arguments:
+          gates: IDs of the gates to restore
+
+        Returns:
+          a tuple with an array of weighted potential habitat values, one per
+          target, and the total weighted potential habitat
+        '''
+        self.select(gates)
+        res = self.totals * self.weights
+        return res, res.sum()
+
+    def greedy(self, budget: float) -> list[str]:
+        '''
+        Choose a portfolio with a greedy heuristic:  repeatedly add the gate with
+        the largest increase in weighted potential habitat per dollar, skipping
+        gates that don't fit in the remaining budget.  The model is left with
+        the chosen portfolio as its current selection.
+
+        The increase for a gate g is (post - pre) * D * U, where D is the cumulative
+        passability of the barrier below g and U is the habitat above g, discounted
+        by the passability of the barriers in between.  Adding g changes D for the
+        barriers above it and U for the barriers below it, so only those gates
+        are re-ranked.
+
+        Arguments:
+          budget: the amount that can be spent
+
+        Returns:
+          the IDs of the chosen gates
+        '''
+        self.select([])
+        p = self.prepass.copy()
+        up = self._upstream(p)
+
+        def ratio(i):
+            d = self.cp[self.parent[i]] if self.parent[i] >= 0 else 1.0
+            gain = ((self.postpass[i] - self.prepass[i]) * d * up[i]) @ self.weights
+            if self.costs[i] > 0:
+                return gain / self.costs[i]
+            return np.inf if gain > 0 else 0.0
+
+        stamp = np.zeros(len(self.ids), dtype=int)
+        heap = [(-ratio(i), i, 0) for i in np.flatnonzero(self.costs <= budget)]
+        heapq.heapify(heap)
+        remaining = budget
+        while heap:
+            r, g, k = heapq.heappop(heap)
+            if k != stamp[g] or self.selected[g] or self.costs[g] > remaining:
+                continue
+            if r >= 0:
+                break
+            remaining -= self.costs[g]
+            self.selected[g] = True
+            self._update([g])
+            delta = (self.postpass[g] - p[g]) * up[g]
+            p[g] = self.postpass[g]
+            affected = list(self._preorder(self.children[g]))
+            d = self.parent[g]
+            while d >= 0:
+                up[d] += delta
+                delta = delta * p[d]
+                affected.append(d)
+                d = self.parent[d]
+            for i in affected:
+                if not self.selected[i] and self.costs[i] <= remaining:
+                    stamp[i] += 1
+                    heapq.heappush(heap, (-ratio(i), i, stamp[i]))
+
+        return [self.ids[i] for i in np.flatnonzero(self.selected)]
+
+    def upper_bound(self, budget: float) -> float:
+        '''
+        Compute an upper bound on the weighted potential habitat of any portfolio
+        that fits in a budget.  The bound is the smaller of two bounds:
+
+        Gates that cost more than the budget can't be part of the portfolio,
+        so both bounds leave them at their passability before restoration.
+
+        * A barrier can only gain habitat if at least one gate on its path to
+          the river mouth is restored, so the first bound adds the largest
+          possible gain for every barrier that has a gate on its path that
+          costs no more than the budget.
+
+        * The increase from adding a gate g to any portfolio is (post - pre) * D * U
+          (see `greedy`), and D and U are largest when every other gate has its
+          best passability.  The total gain of a portfolio is at most the sum
+          of these largest increases, so the second bound is the value of the
+          fractional knapsack problem with those increases and the gate costs:
+          gates are taken in order of increase per dollar, and the last one
+          is counted in proportion to the part of its cost that fits.
+
+        Arguments:
+          budget: the amount that can be spent
+
+        Returns:
+          the upper bound
+        '''
+        affordable = self.costs <= budget
+        best = np.where(affordable[:,None], np.maximum(self.prepass, self.postpass), self.prepass)
+        improves = affordable & (best > self.prepass).any(axis=1)
+        reachable = improves.copy()
+        for i in self._preorder(np.flatnonzero(self.parent < 0)):
+            if (d := self.parent[i]) >= 0:
+                reachable[i] |= reachable[d]
+        cp_pre = self._cumulative(self.prepass)
+        cp_best = self._cumulative(best)
+        base = float(((self.habitat * cp_pre) @ self.weights).sum())
+        gain = (self.habitat * (cp_best - cp_pre)) @ self.weights
+        by_path = base + float(gain[reachable].sum())
+
+        down = self._below(cp_best)
+        increase = np.where(improves, ((best - self.prepass) * down * self._upstream(best)) @ self.weights, 0.0)
+
+        total = 0.0
+        remaining = budget
+        for g in sorted(np.flatnonzero(increase > 0), key=lambda g: self.costs[g] / increase[g]):
+            if self.costs[g] <= remaining:
+                total += increase[g]
+                remaining -= self.costs[g]
+            else:
+                total += increase[g] * remaining / self.costs[g]
+                break
+        return min(by_path, base + total)
+
+    def standalone_gains(self) -> np.ndarray:
+        '''
+        Compute the increase in potential habitat for each target when a barrier
+        is the only gate restored, (post - pre) * D * U (see `greedy`).  The
+        current portfolio is not used or changed.
+
+        Returns:
+          an array with one row per barrier and one column per target, not weighted
+        '''
+        down = self._below(self._cumulative(self.prepass))
+        return (self.postpass - self.prepass) * down * self._upstream(self.prepass)
+
+    def _cumulative(self, p):
+        '''
+        Helper function that computes the cumulative passability of every barrier
+        when each barrier has the passability in the corresponding row of p.
+        '''
+        cp = np.array(p, dtype=float)
+        for i in self._preorder(np.flatnonzero(self.parent < 0)):
+            if (d := self.parent[i]) >= 0:
+                cp[i] *= cp[d]
+        return cp
+
+    def _below(self, cp):
+        '''
+        Helper function that gives each barrier the cumulative passability of
+        the barrier downstream from it (1 at a river mouth).
+        '''
+        return np.where((self.parent >= 0)[:,None], cp[self.parent], 1.0)
+
+    def _upstream(self, p):
+        '''
+        Helper function that computes the habitat above every barrier, including
+        its own, with the habitat above each barrier upstream discounted by the
+        passability (from p) of the barriers in between.
+        '''
+        up = self.habitat.copy()
+        for i in reversed(list(self._preorder(np.flatnonzero(self.parent < 0)))):
+            if (d := self.parent[i]) >= 0:
+                up[d] += p[i] * up[i]
+        return up
+
+    def _preorder(self, roots):
+        '''
+        Helper function used to iterate over subtrees -- generate the IDs of
+        barriers in the subtrees above a set of roots, starting each subtree
+        at its root so a barrier always comes after the barrier downstream
+        from it.
+        '''
+        stack = list(reversed(roots))
+        while stack:
+            i = stack.pop()
+            yield i
+            stack.extend(self.children[i])
+
+    def _update(self, roots):
+        '''
+        Recompute cumulative passability in the subtrees above a set of barriers,
+        adjusting the habitat totals by the change at each barrier.  Roots are
+        handled from the most downstream up, and a subtree nested inside one
+        that was already updated is skipped.
+        '''
+        done = set()
+        for r in sorted(roots, key=lambda i: self.depth[i]):
+            if r in done:
+                continue
+            for i in self._preorder([r]):
+                done.add(i)
+                p = self.postpass[i] if self.selected[i] else self.prepass[i]
+                if (d := self.parent[i]) >= 0:
+                    p = p * self.cp[d]
+                self.totals += self.habitat[i] * (p - self.cp[i])
+                self.cp[i] = p
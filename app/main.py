@@ -8,34 +8,54 @@
 # The top level file defines paths to static pages and RESTful 
 # web services that provide data files and run the optimizer.
 
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import FileResponse
+# Modules that depend on pandas, numpy, networkx, or PIL are imported by
+# the functions that use them, so importing this module (and answering
+# requests for projects, maps, and text files) doesn't wait for them to load.
+
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pathlib import Path
-from typing import Annotated
+from typing import Annotated, TYPE_CHECKING
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
+import asyncio
+from email.utils import formatdate
+import gzip
+import hashlib
+import json
 import logging
-from rich.logging import RichHandler
+import os
+
+from .spatial import GridIndex
+from .tables import Table, to_float
 
-from .optipass import run_optipass
+if TYPE_CHECKING:
+    from .tiles import MapPyramid
 
 def init():
     '''
     Define global variables used in the rest of the application:
     paths to static data and names of static data files, a list of 
     names of projects, a dictionary of region names for each project.
+    Called when the application starts (see `lifespan`).
     '''
+    from rich.logging import RichHandler
+    from .archive import RunArchive
 
-    global BARRIERS, BARRIER_FILE
+    global BARRIERS, BARRIER_FILE, PASSABILITY_FILE
     global MAPS, MAPINFO_FILE
     global TARGETS, TARGET_FILE, LAYOUT_FILE
     global COLNAMES, COLNAME_FILE
-    global HTMLDIR, IMAGEDIR
+    global HTMLDIR, IMAGEDIR, WELCOME_FILE
+    global MODELS, ARCHIVE, SCENARIOS, SCENARIO_FILE
 
     MAPS = 'static/maps'
     MAPINFO_FILE = 'mapinfo.json'
 
     BARRIERS = 'static/barriers'
     BARRIER_FILE = 'barriers.csv'
+    PASSABILITY_FILE = 'passability.csv'
 
     TARGETS = 'static/targets'
     TARGET_FILE = 'targets.csv'
@@ -45,9 +65,24 @@ def init():
     COLNAME_FILE = 'colnames.csv'
 
     HTMLDIR = 'static/html'
+    WELCOME_FILE = 'welcome.html'
     # IMAGEDIR = 'static/images'
 
+    SCENARIOS = 'static/scenarios'
+    SCENARIO_FILE = 'scenarios.json'
+
+    MODELS = 'tmp/models'
+    ARCHIVE = 'tmp/archive.db'
+
     global project_names, region_names
+    global habitat_models, MAX_HABITAT_MODELS
+    global region_frontiers, MAX_REGION_FRONTIERS, run_archive
+    global process_pool, OPTIPASS_WORKERS
+    global prewarm_pool, PREWARM, PREWARM_INTERVAL, PREWARM_DELAY, PREWARM_LOCK
+    global map_pyramids
+    global barrier_tables, passability_tables, barrier_index
+    global project_models, project_bundles, gate_rankings
+    global project_stamps, RELOAD_INTERVAL
 
     logging.basicConfig(
         level=logging.INFO,
@@ -60,13 +95,140 @@ def init():
     logging.info(f'projects: {project_names}')
 
     region_names = { }
-    for project in project_names:
-        barrier_file = Path(BARRIERS) / project / BARRIER_FILE
-        with open(barrier_file) as f:
-            f.readline()     # skip the header
-            region_names[project] = { rec.split(',')[1] for rec in f }
+    barrier_tables = { }
+    passability_tables = { }
+    barrier_index = { }
+    project_models = { }
+    project_bundles = { }
+    gate_rankings = { }
+    project_stamps = { }
+
+    # Projects are loaded again when their files change; this is how often
+    # the files are checked, in seconds
+    RELOAD_INTERVAL = float(os.environ.get('OPTIPASS_RELOAD_INTERVAL', 30))
+
+    habitat_models = OrderedDict()
+    MAX_HABITAT_MODELS = 32
+    # Results for each group of regions in decomposed runs, keyed by the run
+    # version so results made with older files are never used; when the
+    # limit is reached the least recently used results are removed
+    region_frontiers = OrderedDict()
+    MAX_REGION_FRONTIERS = 4096
+    run_archive = RunArchive(ARCHIVE)
+
+    # Worker processes for OptiPass requests, started when the first request
+    # arrives; OPTIPASS_WORKERS=0 runs requests in a thread instead
+    OPTIPASS_WORKERS = int(os.environ.get('OPTIPASS_WORKERS', min(4, os.cpu_count() or 1)))
+    process_pool = None
+
+    # Default scenarios are run in the background when the server starts, and
+    # again every PREWARM_INTERVAL seconds to catch reloaded projects, by the
+    # one server process that holds PREWARM_LOCK; OPTIPASS_PREWARM=0 turns
+    # this off
+    PREWARM = os.environ.get('OPTIPASS_PREWARM', '1') != '0'
+    PREWARM_INTERVAL = float(os.environ.get('OPTIPASS_PREWARM_INTERVAL', 600))
+    PREWARM_DELAY = float(os.environ.get('OPTIPASS_PREWARM_DELAY', 10))
+    PREWARM_LOCK = Path(ARCHIVE).with_name('prewarm.lock')
+    prewarm_pool = None
+
+    map_pyramids = { }
+
+    # a project with missing or malformed data files is left out so the
+    # server can still answer requests for the other projects
+    for project in list(project_names):
+        try:
+            load_project(project)
+        except Exception:
+            logging.exception(f'project {project} not loaded')
+            project_names.remove(project)
     logging.info(f'regions: {region_names}')
 
+def load_project(project: str):
+    '''
+    Read the data files for a project and make the tables, indexes, shared
+    model, bundle, and gate rankings used to answer requests, and remove
+    archived runs made with older data.  Called when the server starts, and
+    again when any of the project's files changes (see `watch_projects`).
+    The tables, index, and model are all made before any of them replaces
+    the previous version, so an error leaves the old data in place.
+
+    Args:
+        project:  the project name
+    '''
+    from .model import ProjectModel
+
+    stamp = files_stamp(project_files(project))
+
+    bt = Table.read(Path(BARRIERS) / project / BARRIER_FILE)
+    bt.add_index('region')
+    index = GridIndex(
+        [to_float(x) for x in bt.columns['X']],
+        [to_float(y) for y in bt.columns['Y']],
+    )
+    pt = Table.read(Path(BARRIERS) / project / PASSABILITY_FILE)
+    region_of = dict(zip(bt.columns['ID'], bt.columns['region']))
+    pt.add_index('region', [region_of.get(x) for x in pt.columns['ID']])
+    model = ProjectModel.publish(project, Path(BARRIERS) / project, MODELS)
+
+    region_names[project] = set(bt.indexes['region'])
+    barrier_tables[project] = bt
+    barrier_index[project] = index
+    passability_tables[project] = pt
+    project_models[project] = model
+    project_bundles[project] = make_bundle(project)
+    gate_rankings[project] = make_rankings(project)
+    project_stamps[project] = stamp
+
+    # saved runs made with older data will never be used again
+    try:
+        versions = [run_version(project, m) for m in run_mappings(project)]
+        if n := run_archive.prune(project, versions):
+            logging.info(f'removed {n} archived runs for {project}')
+    except Exception:
+        logging.exception(f'archive not pruned: {project}')
+
+def project_files(project: str) -> list[Path]:
+    '''
+    List the files used to make the data for a project in `load_project`.
+
+    Args:
+        project:  the project name
+
+    Returns:
+        the paths to the barrier, passability, target, layout, mapinfo, and
+        welcome files, and all the colname files
+    '''
+    files = [
+        Path(BARRIERS) / project / BARRIER_FILE,
+        Path(BARRIERS) / project / PASSABILITY_FILE,
+        Path(TARGETS) / project / TARGET_FILE,
+        Path(TARGETS) / project / LAYOUT_FILE,
+        Path(MAPS) / project / MAPINFO_FILE,
+        Path(HTMLDIR) / project / WELCOME_FILE,
+    ]
+    return files + sorted((Path(COLNAMES) / project).rglob('*.csv'))
+
+def files_stamp(files: list[Path]) -> tuple:
+    '''
+    Record the modification time and size of a set of files, so changes can
+    be detected without reading the files.
+
+    Args:
+        files:  the paths to the files
+
+    Returns:
+        a tuple with the name, modification time, and size of each file
+        (None for the time and size of a file that doesn't exist)
+    '''
+    res = []
+    for p in files:
+        try:
+            st = p.stat()
+            res.append((str(p), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            res.append((str(p), None, None))
+    return tuple(res)
+
 def read_text_file(project: str, area: str, fn: str) -> str:
     '''
     Read a text file from one of the static subdirectories.
@@ -86,14 +248,452 @@ def read_text_file(project: str, area: str, fn: str) -> str:
     
     with open(p) as f:
         return f.read().rstrip()
+
+def mapping_file(project: str, mapping: list[str] | None) -> Path:
+    '''
+    Find the file that maps target names to passability columns.
+
+    Args:
+        project:  the project name
+        mapping:  None to use the project's only mapping file, otherwise
+            a list with the mapping name and the name of the alternative (e.g. `current`)
+
+    Returns:
+        the path to the colnames file
+    '''
+    cname_dir = Path(COLNAMES) / project
+    if mapping is None:
+        return cname_dir / COLNAME_FILE
+    else:
+        return cname_dir / mapping[0] / f'{mapping[1]}.csv'
+
+def run_version(project: str, mapping: list[str] | None) -> str:
+    '''
+    Compute the version used to save OptiPass runs in the archive.  It
+    combines the version of the project's barrier and passability data with
+    the contents of the target file and the mapping file, so a saved run is
+    not used after any of them changes.
+
+    Args:
+        project:  the project name
+        mapping:  the mapping name and alternative, or None for the project's only mapping file
+
+    Returns:
+        a string with 16 hex digits
+    '''
+    from .model import data_version
+    files = [Path(TARGETS) / project / TARGET_FILE, mapping_file(project, mapping)]
+    h = hashlib.sha1(project_models[project].version.encode())
+    h.update(data_version(files).encode())
+    return h.hexdigest()[:16]
+
+def run_mappings(project: str) -> list[list[str] | None]:
+    '''
+    List the values of the `mapping` parameter that can be used in OptiPass
+    requests for a project.
+
+    Args:
+        project:  the project name
+
+    Returns:
+        a list with None if the project has a single colnames file, otherwise
+        a list with the mapping name and alternative for each colname file
+    '''
+    info = colname_info(project)
+    if info['name'] is None:
+        return [None]
+    return [[info['name'], f] for f in info['files']]
+
+def colname_info(project: str) -> dict:
+    '''
+    Find the names of the colname files for a project.
+
+    Args:
+        project:  the project name
+
+    Returns:
+        a dictionary with two entries, the name of the mapping (None if the project
+        has a single colnames.csv file) and the names of the colname files
+    '''
+    cname_dir = Path(COLNAMES) / project
+    cname_file = cname_dir / COLNAME_FILE
+    if cname_file.is_file():
+        return { 'name': None, 'files': [COLNAME_FILE]}
+    elif cname_dir.is_dir():
+        alts = list(cname_dir.iterdir())
+        assert len(alts) == 1, f'colnames/{project} should have exactly one folder'
+        alt_name = alts[0]
+        assert alt_name.is_dir(), f'no directory for {alt_name}'
+        cnames = [p.stem for p in alt_name.iterdir() if p.suffix == '.csv']
+        return { 'name': alt_name.name, 'files': cnames }
+    else:
+        assert False, f'file not found: {cname_file}'
+
+def make_bundle(project: str) -> dict:
+    '''
+    Collect the data a client needs when it opens a project:  the values
+    returned by the `projects`, `barriers`, `targets`, `colnames`, and `mapinfo`
+    requests and the project's welcome page.  The data is saved in JSON format,
+    compressed, along with an entity tag based on the contents.  A value is
+    None if the file it comes from is missing.
+
+    Args:
+        project:  the project name
+
+    Returns:
+        a dictionary with the compressed data, the entity tag, and the modification time
+    '''
+    def optional(f, *args):
+        try:
+            return f(*args)
+        except (FileNotFoundError, AssertionError) as err:
+            logging.warning(f'bundle: {project}: {err}')
+            return None
+
+    data = {
+        'project': project,
+        'projects': project_names,
+        'barriers': barrier_tables[project].to_csv(),
+        'targets': optional(read_text_file, project, TARGETS, TARGET_FILE),
+        'layout': optional(read_text_file, project, TARGETS, LAYOUT_FILE),
+        'colnames': optional(colname_info, project),
+        'mapinfo': optional(read_text_file, project, MAPS, MAPINFO_FILE),
+        'welcome': optional(read_text_file, project, HTMLDIR, WELCOME_FILE),
+    }
+    content = json.dumps(data).encode()
+    return {
+        'content': gzip.compress(content, mtime=0),
+        'etag': hashlib.sha1(content).hexdigest()[:16],
+        'last_modified': formatdate(usegmt=True),
+    }
+
+def make_rankings(project: str) -> dict:
+    '''
+    Compute the standalone gain of every gate for each mapping file in a project.
+
+    Args:
+        project:  the project name
+
+    Returns:
+        a dictionary that maps the path of each colname file to a GateRanking object
+    '''
+    from .ranking import GateRanking
+
+    try:
+        info = colname_info(project)
+    except (FileNotFoundError, AssertionError) as err:
+        logging.warning(f'ranking: {project}: {err}')
+        return { }
+    mappings = [None] if info['name'] is None else [[info['name'], f] for f in info['files']]
+    res = { }
+    for mapping in mappings:
+        p = mapping_file(project, mapping)
+        try:
+            res[p] = GateRanking(project_models[project], Table.read(p))
+        except KeyError as err:
+            logging.warning(f'ranking: {p}: unknown column {err}')
+    return res
+
+def query_table(
+        table: Table, 
+        regions: list[str] | None, 
+        columns: list[str] | None, 
+        offset: int, 
+        limit: int | None,
+    ) -> tuple[str, int]:
+    '''
+    Select rows and columns from a barrier or passability table.
+
+    Args:
+        table:  the table
+        regions:  names of regions to include (None means all regions)
+        columns:  names of columns to include (None means all columns)
+        offset:  number of selected rows to skip
+        limit:  maximum number of rows to return (None means no limit)
+
+    Returns:
+        the rows, in CSV format, and the number of rows that matched before
+        the offset and limit were applied
+    '''
+    if columns is not None:
+        unknown = [c for c in columns if c not in table.columns]
+        assert not unknown, f'unknown columns: {unknown}'
+    rows = table.find('region', regions) if regions else range(len(table))
+    end = None if limit is None else offset + limit
+    return table.to_csv(rows[offset:end], columns), len(rows)
+
+def map_pyramid(project: str, filename: str) -> 'MapPyramid':
+    '''
+    Find the image pyramid for a map file, making a new one the first time 
+    the map is requested or if the file has changed since the pyramid was made.
+
+    Args:
+        project:  the project name
+        filename:  the name of an image file in the project's map folder
+
+    Returns:
+        the MapPyramid object for the file
+    '''
+    from .tiles import MapPyramid
+
+    p = Path(MAPS) / project / filename
+    if not p.is_file():
+        raise FileNotFoundError(p)
+    pyramid = map_pyramids.get(p)
+    st = p.stat()
+    if pyramid is None or pyramid.version != f'{st.st_mtime_ns:x}-{st.st_size:x}':
+        logging.info(f'making image pyramid: {p}')
+        pyramid = map_pyramids[p] = MapPyramid(p)
+    return pyramid
+
+def image_error(err: Exception) -> HTTPException:
+    '''
+    Make the response for an error while reading a map image: status 415 if
+    the file isn't an image PIL can read, otherwise 500.
+
+    Args:
+        err:  the exception raised by `map_pyramid` or a MapPyramid method
+
+    Returns:
+        the exception to raise in the endpoint
+    '''
+    from PIL import UnidentifiedImageError
+
+    if isinstance(err, UnidentifiedImageError):
+        return HTTPException(status_code=415, detail=f'not an image file: {err}')
+    return HTTPException(status_code=500, detail=f'server error: {err}')
+
+async def run_job(f, *args):
+    '''
+    Call a function in one of the OptiPass worker processes, so the server can
+    answer other requests while it runs.  The pool is made the first time it
+    is needed.  If OPTIPASS_WORKERS is 0 the function runs in a thread.
+
+    If a worker process dies (e.g. it runs out of memory) the pool can't be
+    used again, so it is replaced by a new pool and the function is called
+    one more time.
+
+    Args:
+        f:  the function (it has to be defined at the top level of a module)
+        args:  arguments to pass to the function
+
+    Returns:
+        the value returned by the function
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    import multiprocessing
+
+    global process_pool
+    if OPTIPASS_WORKERS == 0:
+        return await asyncio.to_thread(f, *args)
+    for attempt in range(2):
+        if process_pool is None:
+            logging.info(f'starting {OPTIPASS_WORKERS} OptiPass workers')
+            process_pool = ProcessPoolExecutor(OPTIPASS_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        pool = process_pool
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, f, *args)
+        except BrokenProcessPool:
+            logging.warning('OptiPass worker process stopped; restarting workers')
+            # another request may have replaced the pool already
+            if process_pool is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                process_pool = None
+            if attempt > 0:
+                raise RuntimeError('OptiPass worker process stopped')
+
+async def prewarm(project: str):
+    '''
+    Run the default scenarios for a project (see `read_scenarios`) that aren't
+    already in the run archive.  Scenarios are run one at a time by a single
+    worker process with low scheduling priority, and only the values saved in
+    the archive are computed.
+
+    Args:
+        project:  the project name
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    import multiprocessing
+    from .optipass import optipass_job, optipass_command
+    from .archive import scenario_params, scenario_key
+    from .prewarm import read_scenarios, lower_priority
+
+    global prewarm_pool
+
+    p = Path(SCENARIOS) / project / SCENARIO_FILE
+    if not p.is_file():
+        return
+    target_file = Path(TARGETS) / project / TARGET_FILE
+    try:
+        targets = Table.read(target_file).columns['abbrev']
+        scenarios = read_scenarios(p, region_names[project], targets)
+    except Exception as err:
+        logging.warning(f'prewarm: {project}: {err}')
+        return
+
+    model = project_models[project]
+    for s in scenarios:
+        params = scenario_params(project, s['regions'], s['budgets'], s['targets'], s['weights'], s['mapping'], optimizer=optipass_command())
+        run = scenario_key(params)
+        version = await asyncio.to_thread(run_version, project, s['mapping'])
+        if await asyncio.to_thread(run_archive.lookup, run, version) is not None:
+            continue
+        if prewarm_pool is None:
+            prewarm_pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=lower_priority)
+        logging.info(f'prewarm: {project}: {s}')
+        try:
+            _, _, levels, _ = await asyncio.get_running_loop().run_in_executor(
+                prewarm_pool,
+                optipass_job,
+                model.path,
+                target_file,
+                mapping_file(project, s['mapping']),
+                s['regions'],
+                s['budgets'],
+                s['targets'],
+                s['weights'],
+                None,
+                None,
+                (),
+                ['summary'],
+            )
+            await asyncio.to_thread(run_archive.save, version, params, levels)
+        except BrokenProcessPool:
+            logging.warning(f'prewarm: {project}: worker process stopped')
+            prewarm_pool.shutdown(wait=False, cancel_futures=True)
+            prewarm_pool = None
+        except Exception as err:
+            logging.warning(f'prewarm: {project}: {err}')
+
+async def watch_projects():
+    '''
+    Background task started when the server starts.  Every RELOAD_INTERVAL
+    seconds it checks whether any of the files used to load a project
+    (see `project_files`) has been changed, added, or removed, and if so loads
+    the project again.  Errors are logged and the project is checked again
+    after the next interval.
+    '''
+    def changed(project):
+        return files_stamp(project_files(project)) != project_stamps.get(project)
+
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        for project in list(project_names):
+            try:
+                if await asyncio.to_thread(changed, project):
+                    logging.info(f'reloading project: {project}')
+                    await asyncio.to_thread(load_project, project)
+            except Exception:
+                # e.g. a data file that is being replaced; try again next time
+                logging.exception(f'project {project} not reloaded')
+
+async def prewarm_projects():
+    '''
+    Background task started when the server starts.  After waiting PREWARM_DELAY
+    seconds, so the modules used to run OptiPass aren't loaded while the server
+    is answering its first requests, it runs the default scenarios for every
+    project, and runs them again every PREWARM_INTERVAL seconds.  Scenarios
+    already in the archive for the current data are skipped, so only projects
+    reloaded by `watch_projects` since the last pass start new runs.  Errors are
+    logged, and the project is tried again after the next interval.  The task
+    stops if OptiPass is not installed; changed projects are still reloaded.
+
+    When the server has several worker processes only the one that holds a
+    lock on PREWARM_LOCK runs the scenarios.  The others try to take the lock
+    at every interval, so another process takes over if the one running
+    scenarios exits.
+    '''
+    from importlib import import_module
+    from .prewarm import claim
+
+    await asyncio.sleep(PREWARM_DELAY)
+    optipass = await asyncio.to_thread(import_module, '.optipass', __package__)
+    if not optipass.optipass_is_installed():
+        logging.info('prewarm: OptiPass not installed')
+        return
+
+    lock = None
+    try:
+        while True:
+            if lock is None and (lock := claim(PREWARM_LOCK)) is None:
+                logging.debug('prewarm: scenarios are run by another process')
+            for project in project_names:
+                if lock is None:
+                    break
+                try:
+                    await prewarm(project)
+                except Exception:
+                    # e.g. a project that failed to reload; try again next time
+                    logging.exception(f'prewarm: {project}')
+            await asyncio.sleep(PREWARM_INTERVAL)
+    finally:
+        if lock is not None:
+            lock.close()
+
+def cached_response(
+        request: Request, 
+        content: bytes, 
+        media_type: str, 
+        etag: str, 
+        last_modified: str,
+        headers: dict | None = None,
+    ) -> Response:
+    '''
+    Make a response with cache validators.  If the client already has
+    the current version the response has status 304 and no content.
+
+    Args:
+        request:  the request, used to look for an If-None-Match header
+        content:  the body of the response
+        media_type:  the content type
+        etag:  the entity tag for this version of the content (without quotes)
+        last_modified:  the modification time, in HTTP date format
+        headers:  additional headers (optional)
+
+    Returns:
+        the response object
+    '''
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': last_modified,
+        'Cache-Control': 'public, max-age=3600',
+    } | (headers or {})
+    tags = [t.strip() for t in request.headers.get('if-none-match', '').split(',')]
+    if headers['ETag'] in tags or '*' in tags:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
     
 ###
 #
-# Top level program -- initialize the global variables and start the app
+# Top level program -- create the app; the global variables are initialized
+# when the server starts
 #
 
-init()
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''
+    Initialize the global variables before the server accepts requests, and
+    start the tasks that reload changed projects and run default scenarios
+    in the background.
+    '''
+    global process_pool, prewarm_pool
+    init()
+    tasks = [asyncio.create_task(watch_projects())]
+    if PREWARM:
+        tasks.append(asyncio.create_task(prewarm_projects()))
+    yield
+    for task in tasks:
+        task.cancel()
+    if process_pool is not None:
+        process_pool.shutdown(wait=False, cancel_futures=True)
+        process_pool = None
+    if prewarm_pool is not None:
+        prewarm_pool.shutdown(wait=False, cancel_futures=True)
+        prewarm_pool = None
+
+app = FastAPI(lifespan=lifespan)
     
 ###
 # Return a list of project names.
@@ -123,23 +723,153 @@ async def html(project: str, filename: str) -> str:
         raise HTTPException(status_code=500, detail=f'server error: {err}')
 
 ###
-# Return the barrier file for a project.
+# Return everything a client needs to open a project in a single compressed
+# response.  The bundles are made when the server starts.
+
+@app.get("/bundle/{project}")
+async def bundle(request: Request, project: str) -> Response:
+    '''
+    Respond to GET requests of the form `/bundle/P` where P is a project name.
+
+    Returns:
+        a JSON object with the list of projects, the project's barrier file, 
+        targets, layout, colnames, and map settings, and the welcome page.  The
+        response is compressed if the client accepts gzip encoding.
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'bundle: unknown project: {project}')
+    b = project_bundles[project]
+    if 'gzip' in request.headers.get('accept-encoding', ''):
+        content, headers = b['content'], {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+    else:
+        content, headers = gzip.decompress(b['content']), {'Vary': 'Accept-Encoding'}
+    return cached_response(request, content, 'application/json', b['etag'], b['last_modified'], headers)
+
+###
+# Return the barrier file for a project.  Query parameters can be used to
+# select regions and columns and to fetch the rows a page at a time.
 
 @app.get("/barriers/{project}")
-async def barriers(project: str) -> dict:
+async def barriers(
+    project: str,
+    region: Annotated[list[str] | None, Query()] = None,
+    columns: Annotated[list[str] | None, Query()] = None,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int | None, Query(ge=0)] = None,
+) -> dict:
     '''
     Respond to GET requests of the form `/barriers/P` where P is a project name.
 
+    Args:
+        region:  names of regions to include (optional)
+        columns:  names of columns to include (optional)
+        offset:  number of rows to skip (optional)
+        limit:  maximum number of rows to return (optional)
+
     Returns:
-        the barrier data file for a project, as one long string.
+        the barrier data file for a project, as one long string, and the number
+        of barriers that matched the region filter.
     '''
     if project not in project_names:
         raise HTTPException(status_code=404, detail=f'barriers: unknown project: {project}')
     try:
-        barriers = read_text_file(project, BARRIERS, BARRIER_FILE)
-        return {'project': project, 'barriers': barriers}
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail=f'file not found: {BARRIERS}/{BARRIER_FILE}')
+        barriers, total = query_table(barrier_tables[project], region, columns, offset, limit)
+        return {'project': project, 'barriers': barriers, 'total': total}
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'barriers: {err}')
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+###
+# Return the passability file for a project, with the same options as
+# the barrier file.
+
+@app.get("/passability/{project}")
+async def passability(
+    project: str,
+    region: Annotated[list[str] | None, Query()] = None,
+    columns: Annotated[list[str] | None, Query()] = None,
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int | None, Query(ge=0)] = None,
+) -> dict:
+    '''
+    Respond to GET requests of the form `/passability/P` where P is a project name.
+
+    Args:
+        region:  names of regions to include (optional)
+        columns:  names of columns to include (optional)
+        offset:  number of rows to skip (optional)
+        limit:  maximum number of rows to return (optional)
+
+    Returns:
+        the passability data file for a project, as one long string, and the number
+        of barriers that matched the region filter.
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'passability: unknown project: {project}')
+    try:
+        passability, total = query_table(passability_tables[project], region, columns, offset, limit)
+        return {'project': project, 'passability': passability, 'total': total}
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'passability: {err}')
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+###
+# Return the barriers inside a rectangle on the map for a project.
+
+@app.get("/barriers/{project}/bbox")
+async def barriers_in_box(
+    project: str,
+    xmin: Annotated[float, Query(allow_inf_nan=False)],
+    ymin: Annotated[float, Query(allow_inf_nan=False)],
+    xmax: Annotated[float, Query(allow_inf_nan=False)],
+    ymax: Annotated[float, Query(allow_inf_nan=False)],
+) -> dict:
+    '''
+    Respond to GET requests of the form `/barriers/P/bbox?ARGS` where P is a project name
+    and the query parameters are the corners of a rectangle (usually the map viewport).
+
+    Returns:
+        the header line of the barrier file and the lines for barriers with 
+        X and Y coordinates inside the rectangle, as one long string.
+        The coordinates must be finite and the minimums can't be greater
+        than the maximums (status 422).
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'barriers: unknown project: {project}')
+    if xmin > xmax or ymin > ymax:
+        raise HTTPException(status_code=422, detail=f'barriers: empty box: {xmin}, {ymin}, {xmax}, {ymax}')
+    try:
+        rows = barrier_index[project].within(xmin, ymin, xmax, ymax)
+        return {'project': project, 'barriers': barrier_tables[project].to_csv(rows)}
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+###
+# Return the barriers closest to a location on the map for a project.
+
+@app.get("/barriers/{project}/nearest")
+async def barriers_near(
+    project: str,
+    x: Annotated[float, Query(allow_inf_nan=False)],
+    y: Annotated[float, Query(allow_inf_nan=False)],
+    n: Annotated[int, Query(gt=0)] = 1,
+) -> dict:
+    '''
+    Respond to GET requests of the form `/barriers/P/nearest?ARGS` where P is a project name
+    and the query parameters are a location and the number of barriers to return.
+
+    Returns:
+        the header line of the barrier file and the lines for the n barriers 
+        closest to the location, closest first, as one long string.
+        The coordinates must be finite (status 422).
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'barriers: unknown project: {project}')
+    try:
+        rows = barrier_index[project].nearest(x, y, n)
+        return {'project': project, 'barriers': barrier_tables[project].to_csv(rows)}
     except Exception as err:
         raise HTTPException(status_code=500, detail=f'server error: {err}')
 
@@ -166,18 +896,92 @@ async def mapinfo(project: str) -> dict:
 
 
 ###
-# Return a static map (image file) for a project
+# Return a static map (image file) for a project.  If the client specifies
+# a width, return the smallest version of the map at least that wide.  Images
+# are loaded, scaled, and encoded in a separate thread so other requests
+# aren't delayed.
 
 @app.get("/map/{project}/{filename}")
-async def map(project: str, filename: str) -> FileResponse:
+async def map(
+    request: Request,
+    project: str, 
+    filename: str,
+    width: Annotated[int | None, Query(gt=0)] = None,
+) -> Response:
+    '''
+    Respond to GET requests of the form `/map/P/F` where P is a project name
+    and F is the name of an image file.
+
+    Args:
+        width:  the width of the map in the client (optional)
+
+    Returns:
+        the image, either the original file or a scaled version in PNG format
+    '''
     p = Path(MAPS) / project / filename
     if not p.exists():
         raise HTTPException(status_code=404, detail=f'map: file not found: {p}')
     try:
+        if width is not None:
+            pyramid = await asyncio.to_thread(map_pyramid, project, filename)
+            z, img = await asyncio.to_thread(pyramid.scaled, width)
+            if z < pyramid.max_zoom:
+                return cached_response(request, img, 'image/png', f'{pyramid.version}-{z}', pyramid.last_modified)
         resp = FileResponse(p)
         return resp
+    except FileNotFoundError as err:
+        raise HTTPException(status_code=404, detail=f'map: file not found: {err}')
     except Exception as err:
-        raise HTTPException(status_code=500, detail=f'server error: {err}')
+        raise image_error(err)
+
+###
+# Return a description of the tiles for a static map
+
+@app.get("/tiles/{project}/{filename}")
+async def tile_info(project: str, filename: str) -> dict:
+    '''
+    Respond to GET requests of the form `/tiles/P/F` where P is a project name
+    and F is the name of an image file.
+
+    Returns:
+        a dictionary with the size of the image, the tile size, and the size 
+        of the image at each zoom level
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'tiles: unknown project: {project}')
+    try:
+        pyramid = await asyncio.to_thread(map_pyramid, project, filename)
+        return {'project': project, 'map_file': filename} | pyramid.info()
+    except FileNotFoundError as err:
+        raise HTTPException(status_code=404, detail=f'tiles: file not found: {err}')
+    except Exception as err:
+        raise image_error(err)
+
+###
+# Return one tile from a static map
+
+@app.get("/tiles/{project}/{filename}/{z}/{x}/{y}")
+async def tile(request: Request, project: str, filename: str, z: int, x: int, y: int) -> Response:
+    '''
+    Respond to GET requests of the form `/tiles/P/F/z/x/y` where P is a project name,
+    F is the name of an image file, z is a zoom level (0 is the smallest image), 
+    and x and y are the column and row of the tile.
+
+    Returns:
+        the tile, in PNG format
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'tiles: unknown project: {project}')
+    try:
+        pyramid = await asyncio.to_thread(map_pyramid, project, filename)
+        img = await asyncio.to_thread(pyramid.tile, z, x, y)
+        return cached_response(request, img, 'image/png', f'{pyramid.version}-{z}-{x}-{y}', pyramid.last_modified)
+    except FileNotFoundError as err:
+        raise HTTPException(status_code=404, detail=f'tiles: file not found: {err}')
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'tiles: {err}')
+    except Exception as err:
+        raise image_error(err)
 
 ###
 # Return the restoration target descriptions
@@ -216,19 +1020,7 @@ async def colnames(project: str) -> dict:
     '''
     try:
         assert project in project_names, f'unknown project: {project}'
-        cname_dir = Path(COLNAMES) / project
-        cname_file = cname_dir / COLNAME_FILE
-        if cname_file.is_file():
-            return { 'name': None, 'files': [COLNAME_FILE]}
-        elif cname_dir.is_dir():
-            alts = list(cname_dir.iterdir())
-            assert len(alts) == 1, f'colnames/{project} should have exactly one folder'
-            alt_name = alts[0]
-            assert alt_name.is_dir(), f'no directory for {alt_name}'
-            cnames = [p.stem for p in alt_name.iterdir() if p.suffix == '.csv']
-            return { 'name': alt_name.name, 'files': cnames }
-        else:
-            assert False, f'file not found: {cname_file}'
+        return colname_info(project)
     except Exception as err:
         raise HTTPException(status_code=404, detail=f'colnames: {err}')
 
@@ -246,10 +1038,27 @@ async def optipass(
     weights: Annotated[list[int] | None, Query()] = None, 
     mapping: Annotated[list[str] | None, Query()] = None,
     tempdir: Annotated[str | None, Query()] = None,
+    progressive: bool = False,
+    decompose: bool = False,
+    components: Annotated[list[str] | None, Query()] = None,
 )-> dict:
     '''
     A GET request of the form `/optipass/project?ARGS` runs OptiPass using the parameter 
     values passed in the URL.
+
+    If `progressive` is true the response is streamed, one JSON object per line:
+    first a provisional result for each budget level, computed with a greedy
+    heuristic, then the exact result for each level as OptiPass finishes it, and
+    finally the same tables returned by a regular request.  Progressive runs
+    are not saved in or read from the run archive, and OptiPass runs in a
+    thread of the server process instead of the worker pool.  They can't be
+    combined with `decompose` (status 400).
+
+    If `decompose` is true OptiPass is run separately on each independent
+    river system and the results are combined (see `run_decomposed`).
+    Results for each river system are saved and reused by later requests.
+    The combined portfolios are not guaranteed to be optimal, so the response
+    has an `approximate` entry set to true.
     
     Args:
         project:  the name of the project (used to make path to static files)
@@ -259,6 +1068,14 @@ async def optipass(
         weights:  list of ints, one for each target (optional)
         mapping:  project-specific target names, e.g. `current` or `future` (optional)
         tempdir:  directory that has existing results (optional, used in testing)
+        progressive:  stream provisional and exact results (optional)
+        decompose:  run OptiPass on each river system separately (optional)
+        components:  the parts of the result tables to make (optional, default is all of them)
+
+    Results are saved in the run archive.  If the archive has a run with the same
+    parameters, made by the same optimizer with the same versions of the project's
+    data, target, and mapping files (see `run_version`), the tables are made from
+    the saved results and OptiPass is not run.
 
     Returns:
         a dictionary with a status indicator and a token that can be used to fetch results.
@@ -271,33 +1088,91 @@ async def optipass(
     logging.debug(f'mapping {mapping}')
     logging.debug(f'tempdir {tempdir}')
 
+    from .optipass import optipass_job, rebuild_job, optipass_is_installed, optipass_command, OptiPass, COMPONENTS
+    from .archive import scenario_params, scenario_key
+
+    if progressive and decompose:
+        raise HTTPException(status_code=400, detail='optipass: progressive and decompose can not be used together')
+
     try:
         assert project in project_names, f'unknown project: {project}'
+        unknown = [c for c in components or [] if c not in COMPONENTS]
+        assert not unknown, f'unknown components: {unknown}'
 
-        barrier_path = Path(BARRIERS) / project
+        model = project_models[project]
         target_file = Path(TARGETS) / project / TARGET_FILE
+        cname_file = mapping_file(project, mapping)
+
+        if progressive:
+            if tempdir is None and not optipass_is_installed():
+                raise NotImplementedError('OptiPassMain.exe not found')
+
+            def setup():
+                op = OptiPass(model, target_file, cname_file, regions, targets, weights, tempdir)
+                op.create_input_frame()
+                return op
+
+            op = await asyncio.to_thread(setup)
+            return StreamingResponse(stream_results(op.run_progressive(*budgets, components)), media_type='application/x-ndjson')
 
-        cname_dir = Path(COLNAMES) / project
-        if mapping is None:
-            cname_file = cname_dir / COLNAME_FILE
+        params = scenario_params(project, regions, budgets, targets, weights, mapping, decompose, optipass_command())
+        run = scenario_key(params)
+        version = await asyncio.to_thread(run_version, project, mapping)
+        levels = None if tempdir else await asyncio.to_thread(run_archive.lookup, run, version)
+
+        if levels is not None:
+            logging.info(f'using archived run {run}')
+            summary, matrix = await run_job(
+                rebuild_job,
+                model.path,
+                target_file,
+                cname_file,
+                regions,
+                targets,
+                weights,
+                levels,
+                components,
+            )
         else:
-            cname_file = cname_dir / mapping[0] / f'{mapping[1]}.csv'
- 
-        summary, matrix = run_optipass(
-            barrier_path, 
-            target_file,
-            cname_file,
-            regions,
-            budgets,
-            targets, 
-            weights,
-            tempdir,
-        )
+            key = (project, version, tuple(targets), tuple(weights or []), tuple(mapping or []))
+            frontiers = None
+            if decompose and tempdir is None:
+                stale = [k for k in region_frontiers if k[0][0] == project and k[0][1] != version]
+                for k in stale:
+                    del region_frontiers[k]
+                frontiers = { k: v for k, v in region_frontiers.items() if k[0] == key }
 
-        return {
-            'summary': summary.to_csv(),
-            'matrix': matrix.to_csv(),
-        }
+            summary, matrix, levels, frontiers = await run_job(
+                optipass_job,
+                model.path,
+                target_file,
+                cname_file,
+                regions,
+                budgets,
+                targets,
+                weights,
+                tempdir,
+                frontiers,
+                key,
+                components,
+            )
+            for k, v in (frontiers or {}).items():
+                region_frontiers[k] = v
+                region_frontiers.move_to_end(k)
+            while len(region_frontiers) > MAX_REGION_FRONTIERS:
+                region_frontiers.popitem(last=False)
+            if tempdir is None:
+                await asyncio.to_thread(run_archive.save, version, params, levels)
+
+        res = { } if tempdir else { 'run': run }
+        if decompose and tempdir is None:
+            # portfolios combined from separate runs may not be optimal (see `merge_frontiers`)
+            res['approximate'] = True
+        if summary is not None:
+            res['summary'] = summary
+        if matrix is not None:
+            res['matrix'] = matrix
+        return res
 
     except AssertionError as err:
         raise HTTPException(status_code=404, detail=f'optipass: {err}')
@@ -308,3 +1183,257 @@ async def optipass(
     except Exception as err:
         logging.exception(err)
         raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+async def stream_results(results):
+    '''
+    Convert the dictionaries made by a generator into lines of JSON.  The
+    generator runs in a separate thread so the server can handle other
+    requests while OptiPass is running.  If the generator raises an exception
+    the last line has an error message.
+
+    Args:
+        results:  the generator
+
+    Returns:
+        an asynchronous generator that produces the lines
+    '''
+    try:
+        while (item := await asyncio.to_thread(next, results, None)) is not None:
+            yield json.dumps(item) + '\n'
+    except Exception as err:
+        logging.exception(err)
+        yield json.dumps({'error': str(err)}) + '\n'
+
+###
+# List the runs saved in the archive, and make the result tables for a saved run.
+
+@app.get("/runs/{project}")
+async def runs(project: str) -> dict:
+    '''
+    Respond to GET requests of the form `/runs/P` where P is a project name.
+
+    Returns:
+        a list of the saved runs for the project, most recent first, with the
+        key, data version, time (in seconds since the epoch), and parameters of
+        each run, and a flag that is True if the run used the current versions
+        of the project's data, target, and mapping files
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'runs: unknown project: {project}')
+    lst = await asyncio.to_thread(run_archive.runs, project)
+    versions = { }
+    for r in lst:
+        mapping = tuple(r['params']['mapping'])
+        if mapping not in versions:
+            versions[mapping] = await asyncio.to_thread(run_version, project, list(mapping) or None)
+    return {
+        'project': project,
+        'runs': [r | {'current': r['version'] == versions[tuple(r['params']['mapping'])]} for r in lst],
+    }
+
+@app.get("/runs/{project}/{run}")
+async def replay(
+    project: str, 
+    run: str,
+    components: Annotated[list[str] | None, Query()] = None,
+) -> dict:
+    '''
+    Respond to GET requests of the form `/runs/P/R` where P is a project name 
+    and R is the key of a saved run.  Only runs made with the current versions
+    of the project's data, target, and mapping files can be replayed.
+
+    Args:
+        components:  the parts of the result tables to make (optional, default is all of them)
+
+    Returns:
+        the parameters of the run and the same tables returned by `optipass`
+    '''
+    from .optipass import rebuild_job, COMPONENTS
+
+    try:
+        assert project in project_names, f'unknown project: {project}'
+        unknown = [c for c in components or [] if c not in COMPONENTS]
+        assert not unknown, f'unknown components: {unknown}'
+        model = project_models[project]
+        params = await asyncio.to_thread(run_archive.params, run)
+        assert params is not None and params['project'] == project, f'no run {run}'
+        version = await asyncio.to_thread(run_version, project, params['mapping'] or None)
+        levels = await asyncio.to_thread(run_archive.lookup, run, version)
+        assert levels is not None, f'no run {run} for the current data'
+        summary, matrix = await run_job(
+            rebuild_job,
+            model.path,
+            Path(TARGETS) / project / TARGET_FILE,
+            mapping_file(project, params['mapping'] or None),
+            params['regions'],
+            params['targets'],
+            params['weights'] or None,
+            levels,
+            components,
+        )
+        res = { 'run': run, 'params': params }
+        if summary is not None:
+            res['summary'] = summary
+        if matrix is not None:
+            res['matrix'] = matrix
+        return res
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'runs: {err}')
+    except Exception as err:
+        logging.exception(err)
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+###
+# Rank gates by their standalone benefit per dollar.  The gains are computed
+# when the server starts.
+
+@app.get("/ranking/{project}")
+async def ranking(
+    project: str,
+    targets: Annotated[list[str], Query()],
+    weights: Annotated[list[int] | None, Query()] = None,
+    region: Annotated[list[str] | None, Query()] = None,
+    mapping: Annotated[list[str] | None, Query()] = None,
+    k: Annotated[int | None, Query(gt=0)] = None,
+) -> dict:
+    '''
+    Respond to GET requests of the form `/ranking/P?ARGS` where P is a project name.
+    The gain for a gate is the increase in weighted potential habitat when that
+    gate is the only one restored.
+
+    Args:
+        project:  the name of the project
+        targets:  list of 2-letter target IDs
+        weights:  list of ints, one for each target (optional)
+        region:  names of regions to include (optional)
+        mapping:  project-specific target names, e.g. `current` or `future` (optional)
+        k:  the number of gates to return (optional, the default is all of them)
+
+    Returns:
+        a CSV table with the ID, region, cost, weighted gain, and gain per dollar of
+        each gate, in order of decreasing gain per dollar
+    '''
+    try:
+        assert project in project_names, f'unknown project: {project}'
+        p = mapping_file(project, mapping)
+        assert p in gate_rankings[project], f'unknown mapping: {mapping}'
+        rows, gains, ratios = gate_rankings[project][p].top(targets, weights, region, k)
+        bt = barrier_tables[project]
+        records = [
+            [bt.columns['ID'][i], bt.columns['region'][i], bt.columns['cost'][i], f'{g:.6g}', f'{r:.6g}'] 
+            for i, g, r in zip(rows, gains, ratios)
+        ]
+        return {
+            'project': project,
+            'ranking': Table(['ID', 'region', 'cost', 'gain', 'ratio'], records).to_csv(),
+        }
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'ranking: {err}')
+    except Exception as err:
+        logging.exception(err)
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
+
+###
+# Evaluate a portfolio of gates chosen by the user.  Models are cached so a
+# request that differs from the previous one by a few gates only updates the
+# subtrees above those gates.  A new model is built in a separate thread, but
+# the handler doesn't await anything after it gets a model from the cache, so
+# a model is never used by two requests at the same time.
+
+def habitat_model(
+        project: str,
+        regions: list[str],
+        targets: list[str],
+        weights: list[int] | None,
+        mapping: list[str] | None,
+    ) -> 'HabitatModel':
+    '''
+    Make the habitat model used to evaluate portfolios.  The target columns
+    are put in the same order as the targets in the request, so weights are
+    matched to targets the same way they are by `ranking`.
+
+    Args:
+        project:  the project name
+        regions:  names of the regions to include
+        targets:  names of the targets
+        weights:  one weight for each target (optional)
+        mapping:  the mapping name and alternative (optional)
+
+    Returns:
+        a new HabitatModel object
+    '''
+    from .optipass import OptiPass
+    from .habitat import HabitatModel
+
+    op = OptiPass(
+        project_models[project],
+        Path(TARGETS) / project / TARGET_FILE,
+        mapping_file(project, mapping),
+        regions,
+        targets,
+        weights,
+    )
+    assert len(op.barriers) > 0, f'no barriers in regions {regions}'
+    unmapped = [t for t in targets if t not in op.mapping.index]
+    assert not unmapped, f'no passability columns for targets: {unmapped}'
+    return HabitatModel.from_frames(op.barriers, op.passability, op.mapping.loc[targets], weights)
+
+@app.get("/evaluate/{project}")
+async def evaluate(
+    project: str, 
+    regions: Annotated[list[str], Query()], 
+    targets: Annotated[list[str], Query()], 
+    gates: Annotated[list[str] | None, Query()] = None, 
+    weights: Annotated[list[int] | None, Query()] = None, 
+    mapping: Annotated[list[str] | None, Query()] = None,
+)-> dict:
+    '''
+    A GET request of the form `/evaluate/project?ARGS` computes the potential
+    habitat when a specified set of gates is restored, without running OptiPass.
+    
+    Args:
+        project:  the name of the project (used to make path to static files)
+        regions:  comma-separated string of region names
+        targets:  comma-separated string of 2-letter target IDs
+        gates:  IDs of the gates to restore (optional, the default is no gates)
+        weights:  list of ints, one for each target (optional)
+        mapping:  project-specific target names, e.g. `current` or `future` (optional)
+
+    Returns:
+        a dictionary with the weighted potential habitat for each target and the
+        total weighted potential habitat, as computed by `add_potential_habitat`
+    '''
+    if project not in project_names:
+        raise HTTPException(status_code=404, detail=f'evaluate: unknown project: {project}')
+    if weights and len(weights) != len(targets):
+        raise HTTPException(status_code=400, detail='evaluate: need one weight for each target')
+
+    try:
+        # the data version is part of the key so models made before the project
+        # was loaded again are not used (they are removed as new models are added)
+        key = (project, project_models[project].version, tuple(sorted(regions)), tuple(targets), tuple(weights or []), tuple(mapping or []))
+        if key in habitat_models:
+            habitat_models.move_to_end(key)
+        else:
+            habitat_models[key] = await asyncio.to_thread(habitat_model, project, regions, targets, weights, mapping)
+            if len(habitat_models) > MAX_HABITAT_MODELS:
+                habitat_models.popitem(last=False)
+        model = habitat_models[key]
+
+        gates = sorted(set(gates or []))
+        unknown = [g for g in gates if g not in model.index]
+        assert not unknown, f'unknown gates: {unknown}'
+
+        habitat, wph = model.evaluate(gates)
+        return {
+            'project': project,
+            'gates': gates,
+            'habitat': { t: float(h) for t, h in zip(model.targets, habitat) },
+            'wph': float(wph),
+        }
+
+    except AssertionError as err:
+        raise HTTPException(status_code=404, detail=f'evaluate: {err}')
+    except Exception as err:
+        logging.exception(err)
+        raise HTTPException(status_code=500, detail=f'server error: {err}')
@@ -0,0 +1,224 @@
+#
+# Compact, shared copy of a project's barrier and passability data
+#
+# The data is converted to numeric arrays and saved as .npy files in a
+# cache folder.  The first server process that starts after the data
+# changes writes the files; every process then opens them as memory-mapped
+# read-only arrays, so all the worker processes share one copy of the
+# data in the OS page cache.
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+from .tables import Table, to_float
+
+ARRAYS = ['ids', 'region', 'dsid', 'cost', 'nproj', 'x', 'y', 'passability']
+
+# Part of the name of a model folder; changing the format of the arrays
+# changes this number so models saved in an older format are not used
+FORMAT = 2
+
+class ProjectModel:
+    '''
+    An instance of this class has the barrier and passability data for a
+    project, stored in arrays with one row per barrier:
+
+    * `ids`: the barrier IDs (the interned ID table; other arrays refer to barriers by row number)
+    * `region`: int32 index into the list of region names
+    * `dsid`: int32 row number of the downstream barrier, -1 for a barrier at a river mouth
+    * `cost`, `x`, `y`: float64, NaN for missing values
+    * `nproj`: int32
+    * `passability`: one column for each column in the passability file, float32
+      if every value is the same after converting it to float32 and back (see
+      `frames`), otherwise float64
+
+    The arrays are read-only.
+    '''
+
+    def __init__(self, path: Path):
+        '''
+        Attach to a model that has been published.
+
+        Arguments:
+          path: the folder with the model files
+        '''
+        self.path = Path(path)
+        with open(self.path / 'model.json') as f:
+            meta = json.load(f)
+        self.project = meta['project']
+        self.version = meta['version']
+        self.regions = meta['regions']
+        self.columns = meta['columns']
+        for name in ARRAYS:
+            setattr(self, name, np.load(self.path / f'{name}.npy', mmap_mode='r'))
+        self.index = { x: i for i, x in enumerate(self.ids.tolist()) }
+        self.column_index = { c: j for j, c in enumerate(self.columns) }
+        self.exact = { }
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def publish(cls, project: str, barrier_path: Path, cache: Path):
+        '''
+        Find the model for the current version of a project's data, making it if
+        it doesn't exist yet.  The files are written to a temporary folder that is
+        renamed when it is complete, so other processes never see a partial model.
+
+        Arguments:
+          project: the project name
+          barrier_path: folder with barriers.csv and passability.csv
+          cache: folder where models are saved
+
+        Returns:
+          a new ProjectModel object attached to the saved model
+        '''
+        barrier_file = Path(barrier_path) / 'barriers.csv'
+        passability_file = Path(barrier_path) / 'passability.csv'
+        version = data_version([barrier_file, passability_file])
+        dest = Path(cache) / f'{project}-{version}-{FORMAT}'
+        if not dest.is_dir():
+            logging.info(f'publishing model: {dest}')
+            Path(cache).mkdir(parents=True, exist_ok=True)
+            tmp = Path(tempfile.mkdtemp(prefix=f'.{project}', dir=cache))
+            try:
+                arrays, meta = cls._convert(Table.read(barrier_file), Table.read(passability_file))
+                meta |= {'project': project, 'version': version}
+                for name in ARRAYS:
+                    np.save(tmp / f'{name}.npy', arrays[name], allow_pickle=False)
+                with open(tmp / 'model.json', 'w') as f:
+                    json.dump(meta, f)
+                os.rename(tmp, dest)
+            except OSError:
+                if not dest.is_dir():
+                    raise
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+            # other versions of this project (but not projects whose names start with this one)
+            pattern = re.compile(re.escape(project) + r'-[0-9a-f]{16}(-\d+)?')
+            for old in Path(cache).iterdir():
+                if old != dest and pattern.fullmatch(old.name):
+                    shutil.rmtree(old, ignore_errors=True)
+        return cls(dest)
+
+    @staticmethod
+    def _convert(barriers: Table, passability: Table) -> tuple[dict, dict]:
+        '''
+        Helper function used by publish -- make the arrays from the parsed CSV files.
+        '''
+        ids = barriers.columns['ID']
+        row = { x: i for i, x in enumerate(ids) }
+        regions = sorted(set(barriers.columns['region']))
+        region = { r: i for i, r in enumerate(regions) }
+        columns = [c for c in passability.header if c != 'ID']
+
+        pmat = np.full((len(ids), len(columns)), np.nan, dtype=np.float64)
+        for k, x in enumerate(passability.columns['ID']):
+            if (i := row.get(x)) is not None:
+                pmat[i] = [to_float(passability.columns[c][k]) for c in columns]
+
+        # use 32-bit floats only if frames will get back the original values
+        small = pmat.astype(np.float32)
+        if np.array_equal(small.astype(str).astype(np.float64), pmat, equal_nan=True):
+            pmat = small
+        else:
+            logging.info('passability values need 64-bit floats')
+
+        arrays = {
+            'ids': np.array(ids, dtype=str),
+            'region': np.array([region[r] for r in barriers.columns['region']], dtype=np.int32),
+            'dsid': np.array([row.get(x, -1) for x in barriers.columns['DSID']], dtype=np.int32),
+            'cost': np.array([to_float(x) for x in barriers.columns['cost']], dtype=np.float64),
+            'nproj': np.nan_to_num([to_float(x) for x in barriers.columns['NPROJ']]).astype(np.int32),
+            'x': np.array([to_float(x) for x in barriers.columns['X']], dtype=np.float64),
+            'y': np.array([to_float(y) for y in barriers.columns['Y']], dtype=np.float64),
+            'passability': pmat,
+        }
+        return arrays, {'regions': regions, 'columns': columns}
+
+    def rows(self, regions: list[str]) -> np.ndarray:
+        '''
+        Find the barriers in a set of regions.
+
+        Arguments:
+          regions: region names
+
+        Returns:
+          the row numbers of the barriers, in the order they appear in the barrier file
+        '''
+        codes = [self.regions.index(r) for r in regions if r in self.regions]
+        return np.flatnonzero(np.isin(self.region, codes))
+
+    def column(self, name: str) -> np.ndarray:
+        '''
+        Return a passability column as 64-bit floats.  32-bit values are converted
+        by way of their shortest decimal representation; `publish` only saves them
+        as 32-bit floats if this gives back the values in the CSV file, so the
+        column always has the same values as the file.  Converted columns are
+        saved, so each column is converted only once by a process.
+
+        Arguments:
+          name: the name of a column in the passability file
+
+        Returns:
+          an array with one value per barrier
+        '''
+        if name not in self.exact:
+            col = self.passability[:, self.column_index[name]]
+            if col.dtype != np.float64:
+                col = col.astype(str).astype(np.float64)
+            self.exact[name] = col
+        return self.exact[name]
+
+    def frames(self, regions: list[str], columns: list[str] | None = None) -> tuple:
+        '''
+        Make data frames for the barriers in a set of regions, with the columns
+        used by the `OptiPass` class.  Passability values are 64-bit floats with
+        the same values as the ones in the CSV file (see `column`).
+
+        Arguments:
+          regions: region names
+          columns: names of the passability columns to include (optional, the
+            default is all of them)
+
+        Returns:
+          a barrier frame and a passability frame, both with one row per barrier
+        '''
+        import pandas as pd
+
+        rows = self.rows(regions)
+        ids = self.ids[rows].tolist()
+        bf = pd.DataFrame({
+            'ID': ids,
+            'region': [self.regions[r] for r in self.region[rows]],
+            'DSID': [str(self.ids[d]) if d >= 0 else np.nan for d in self.dsid[rows]],
+            'cost': self.cost[rows],
+            'NPROJ': self.nproj[rows],
+        })
+        columns = self.columns if columns is None else [c for c in self.columns if c in set(columns)]
+        pf = pd.DataFrame({ c: self.column(c)[rows] for c in columns }, columns=columns)
+        pf.insert(0, 'ID', ids)
+        return bf, pf
+
+def data_version(files: list[Path]) -> str:
+    '''
+    Compute a version string for a set of data files, based on their contents.
+
+    Arguments:
+      files: paths to the files
+
+    Returns:
+      a string with 16 hex digits
+    '''
+    h = hashlib.sha1()
+    for p in files:
+        h.update(Path(p).read_bytes())
+    return h.hexdigest()[:16]
@@ -2,18 +2,35 @@
 # Interface to OptiPass.exe (command line version of OptiPass)
 #
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from math import prod
-import networkx as nx
 import numpy as np
 import os
 import pandas as pd
 from pathlib import Path
 import platform
 import re
+import shutil
 import subprocess
 import tempfile
 
+from .model import ProjectModel
+
+# The parts of the result tables a client can ask for (see `OptiPass.build_results`)
+
+COMPONENTS = ['summary', 'matrix', 'habitat', 'gains']
+
+def optipass_command() -> str:
+    '''
+    The shell command that runs OptiPass.  The default is the executable in
+    the `bin` folder; setting the environment variable OPTIPASS replaces it
+    with a different program (e.g. the stand-in used for load testing).
+
+    Returns:
+       the command, without any arguments
+    '''
+    return os.environ.get('OPTIPASS') or 'bin\\OptiPassMain.exe'
+
 def optipass_is_installed() -> bool:
     '''
     Make sure OptiPass is installed.
@@ -21,10 +38,12 @@ def optipass_is_installed() -> bool:
     Returns:
        True if OptiPass is installed and this host can run it.
     '''
+    if os.environ.get('OPTIPASS'):
+        return True
     return Path('./bin/OptiPassMain.exe') and ((platform.system() == 'Windows') or os.environ.get('WINEARCH'))
 
 def run_optipass(
-        barrier_path: str, 
+        barrier_path: str | ProjectModel, 
         target_file: str,
         mapping_file: str, 
         regions: list[str],
@@ -32,6 +51,7 @@ def run_optipass(
         targets: list[str], 
         weights: list[int],
         tmpdir: Path | None = None,
+        components: list[str] | None = None,
     ) -> tuple:
     '''
     Run OptiPass using the specified arguments.  Instantiates an OP object
@@ -39,7 +59,7 @@ def run_optipass(
     run the optimizer, and gather the results.
 
     Arguments:
-        barrier_path: name of directory with CSVs files for tide gate data
+        barrier_path: name of directory with CSVs files for tide gate data, or a model with the same data
         target_file: name of a CSV file with restoration target descriptions
         mapping_file: name of CSV file with barrier passabilities
         regions: a list of geographic regions (river names) to use
@@ -47,15 +67,229 @@ def run_optipass(
         targets: a list of IDs of targets to use
         weights: a list of target weights
         tmpdir: name of directory that has existing results (used for testing)
+        components: the parts of the tables to make (optional, see `OptiPass.build_results`)
 
     Returns:
         a tuple containing two data frames, a budget table and a gate matrix
     '''
     op = OptiPass(barrier_path, target_file, mapping_file, regions, targets, weights, tmpdir)
     op.create_input_frame()
-    op.create_paths()
     op.run(*budgets)
-    return op.collect_results()
+    return op.collect_results(components)
+
+# Models opened by a worker process, indexed by path, kept so later jobs
+# for the same project don't have to open the files again
+
+worker_models = { }
+
+def optipass_job(
+        model_path: str,
+        target_file: str,
+        mapping_file: str, 
+        regions: list[str],
+        budgets: list[int],
+        targets: list[str], 
+        weights: list[int],
+        tmpdir: Path | None = None,
+        frontiers: dict | None = None,
+        key: tuple = (),
+        components: list[str] | None = None,
+    ) -> tuple:
+    '''
+    Run OptiPass in a worker process.  The arguments and results are plain
+    Python values so they can be passed between processes quickly:  the barrier
+    data is specified by the path to a published `ProjectModel`, and the tables
+    are returned in CSV format.
+
+    Arguments:
+        model_path: the folder with a published model for the project
+        target_file: name of a CSV file with restoration target descriptions
+        mapping_file: name of CSV file with barrier passabilities
+        regions: a list of geographic regions (river names) to use
+        budgets: a list with starting budget, budget increment, and number of budgets
+        targets: a list of IDs of targets to use
+        weights: a list of target weights
+        tmpdir: name of directory that has existing results (used for testing)
+        frontiers: saved results for groups of regions; if this argument is not None OptiPass is run with `run_decomposed`
+        key: values that identify the data, targets, and weights used to make the saved results
+        components: the parts of the tables to make (optional, see `OptiPass.build_results`)
+
+    Returns:
+        a tuple with the budget table and the gate matrix, as CSV strings (None if the
+        table was not requested), the budget, habitat, and gates for each budget level,
+        and the saved results for groups of regions, including any new ones
+    '''
+    model = worker_model(model_path)
+    if frontiers is not None:
+        summary, matrix = run_decomposed(model, target_file, mapping_file, regions, budgets, targets, weights, frontiers, key, components)
+    else:
+        summary, matrix = run_optipass(model, target_file, mapping_file, regions, budgets, targets, weights, tmpdir, components)
+    levels = { x: summary[x].tolist() for x in ['budget', 'habitat', 'gates'] }
+    return *compact_results(summary, matrix, components), levels, frontiers
+
+def rebuild_job(
+        model_path: str,
+        target_file: str,
+        mapping_file: str, 
+        regions: list[str],
+        targets: list[str], 
+        weights: list[int],
+        levels: dict,
+        components: list[str] | None = None,
+    ) -> tuple:
+    '''
+    Make the result tables for a saved run in a worker process, without running OptiPass.
+
+    Arguments:
+        model_path: the folder with a published model for the project
+        target_file: name of a CSV file with restoration target descriptions
+        mapping_file: name of CSV file with barrier passabilities
+        regions: a list of geographic regions (river names) to use
+        targets: a list of IDs of targets to use
+        weights: a list of target weights
+        levels: a dictionary with lists of budget, habitat, and gate values, one per budget level
+        components: the parts of the tables to make (optional, see `OptiPass.build_results`)
+
+    Returns:
+        a tuple with the budget table and the gate matrix, as CSV strings (None if the
+        table was not requested)
+    '''
+    op = OptiPass(worker_model(model_path), target_file, mapping_file, regions, targets, weights)
+    op.create_input_frame()
+    return compact_results(*op.build_results(levels, components), components)
+
+def worker_model(model_path: str) -> ProjectModel:
+    '''
+    Find the model for a project in the worker's cache, opening it if it 
+    isn't there.  An older version of the same project is removed from the cache.
+    '''
+    model = worker_models.get(model_path)
+    if model is None:
+        model = ProjectModel(model_path)
+        for p in [p for p, m in worker_models.items() if m.project == model.project]:
+            del worker_models[p]
+        worker_models[model_path] = model
+    return model
+
+def compact_results(summary: pd.DataFrame, matrix: pd.DataFrame, components: list[str] | None) -> tuple:
+    '''
+    Convert the result tables to CSV strings.  A table is None if none of
+    the components it contains were requested.
+    '''
+    components = COMPONENTS if components is None else components
+    return (
+        summary.to_csv() if {'summary', 'habitat'} & set(components) else None,
+        matrix.to_csv() if {'matrix', 'gains'} & set(components) else None,
+    )
+
+def run_decomposed(
+        barrier_path: str | ProjectModel, 
+        target_file: str,
+        mapping_file: str, 
+        regions: list[str],
+        budgets: list[int],
+        targets: list[str], 
+        weights: list[int],
+        cache: dict | None = None,
+        key: tuple = (),
+        components: list[str] | None = None,
+    ) -> tuple:
+    '''
+    Run OptiPass separately on each independent group of regions (see
+    `OptiPass.region_groups`), then combine the results.  The groups are run
+    in parallel.  The result for a group at a given budget level is saved in
+    the cache, so it can be reused by a later request that includes the
+    group, even if the other regions are different.
+
+    The combined portfolio for a budget is the best way to divide the budget
+    among the groups, using the amount each group actually spent.  Because
+    OptiPass only finds portfolios at the budget levels, the combined result
+    is a feasible portfolio but is not guaranteed to be optimal.
+
+    Arguments:
+        barrier_path: name of directory with CSVs files for tide gate data, or a model with the same data
+        target_file: name of a CSV file with restoration target descriptions
+        mapping_file: name of CSV file with barrier passabilities
+        regions: a list of geographic regions (river names) to use
+        budgets: a list with starting budget, budget increment, and number of budgets
+        targets: a list of IDs of targets to use
+        weights: a list of target weights
+        cache: results for groups of regions (optional)
+        key: values that identify the data, targets, and weights used to make cached results
+        components: the parts of the tables to make (optional, see `OptiPass.build_results`)
+
+    Returns:
+        a tuple containing two data frames, a budget table and a gate matrix
+    '''
+    op = OptiPass(barrier_path, target_file, mapping_file, regions, targets, weights)
+    op.create_input_frame()
+
+    bmin, bdelta, bcount = budgets
+    levels = [bmin + i * bdelta for i in range(bcount+1)]
+    cache = {} if cache is None else cache
+
+    def frontier(group):
+        wanted = sorted({0, *levels})
+        missing = [b for b in wanted if (key, tuple(group), b) not in cache]
+        if missing:
+            sub = OptiPass(barrier_path, target_file, mapping_file, group, targets, weights)
+            sub.create_input_frame()
+            sub.write_input_file()
+            costs = dict(zip(sub.barriers.ID, sub.barriers.cost))
+            try:
+                for i, b in enumerate(missing):
+                    cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+                    sub.parse_output(sub.run_level(i, b), cols)
+                    gates = cols['gates'][0]
+                    cache[(key, tuple(group), b)] = (float(sum(costs[g] for g in gates)), cols['habitat'][0], gates)
+            finally:
+                # the group's input and output files are only needed to parse the results
+                shutil.rmtree(sub.tmpdir, ignore_errors=True)
+        return [cache[(key, tuple(group), b)] for b in wanted]
+
+    groups = op.region_groups()
+    logging.info(f'region groups: {groups}')
+    with ThreadPoolExecutor(max_workers=min(len(groups), os.cpu_count() or 1) or 1) as pool:
+        frontiers = list(pool.map(frontier, groups))
+
+    return op.build_results(merge_frontiers(frontiers, levels), components)
+
+def merge_frontiers(frontiers: list[list[tuple]], levels: list[int]) -> dict:
+    '''
+    Combine results for independent groups of regions.  The total habitat is
+    the sum of the habitat of each group, so the best combination for a budget
+    can be found by dynamic programming over the amount spent, keeping only
+    combinations that have more habitat than every cheaper combination.
+
+    Arguments:
+        frontiers: for each group, a list of (cost, habitat, gates) tuples
+        levels: the budget levels
+
+    Returns:
+        a dictionary with lists of budget, habitat, and gate values, in the form
+        used by `OptiPass.build_results`
+    '''
+    limit = max(levels)
+    best = [(0.0, 0.0, [])]
+    for pts in frontiers:
+        combos = sorted(
+            (cost + c, hab + h, gates + g)
+            for cost, hab, gates in best
+            for c, h, g in pts
+            if cost + c <= limit
+        )
+        best = []
+        for combo in combos:
+            if not best or combo[1] > best[-1][1]:
+                best.append(combo)
+
+    cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+    for b in levels:
+        _, hab, gates = max((c for c in best if c[0] <= b), key=lambda c: c[1])
+        cols['budget'].append(float(b))
+        cols['habitat'].append(hab)
+        cols['gates'].append(gates)
+    return cols
 
 class OptiPass:
     '''
@@ -81,7 +315,7 @@ class OptiPass:
     '''
 
     def __init__(self, 
-            barriers: str, 
+            barriers: str | ProjectModel, 
             tfile: str, 
             mfile: str, 
             rlist: list[str], 
@@ -92,7 +326,7 @@ class OptiPass:
         Instantiate a new OP object.
 
         Arguments:
-          barriers: folder with barrier definitions
+          barriers: folder with barrier definitions, or a ProjectModel with the barrier data
           tfile: name of file with target descriptions
           mfile: name of file with target benefits
           rlist: list of region names
@@ -101,12 +335,6 @@ class OptiPass:
           tmpdir:  path to output files (optional, used by unit tests)
         '''
 
-        bf = pd.read_csv(barriers/'barriers.csv')
-        self.barriers = bf[bf.region.isin(rlist)]
-
-        pf = pd.read_csv(barriers/'passability.csv')
-        self.passability = pf[pf.ID.isin(self.barriers.ID)]
-
         tf = pd.read_csv(tfile).set_index('abbrev')
         assert all(t in tf.index for t in tlist), f'unknown target name in {tlist}'
         self.targets = tf[tf.index.isin(tlist)]
@@ -114,6 +342,17 @@ class OptiPass:
         mf = pd.read_csv(mfile).set_index('abbrev')
         self.mapping = mf[mf.index.isin(tlist)]
 
+        if isinstance(barriers, ProjectModel):
+            # only the passability columns named in the mapping are used
+            columns = { c for col in ['habitat', 'prepass', 'postpass', 'unscaled'] for c in self.mapping[col] }
+            self.barriers, self.passability = barriers.frames(rlist, columns)
+        else:
+            bf = pd.read_csv(barriers/'barriers.csv')
+            self.barriers = bf[bf.region.isin(rlist)]
+
+            pf = pd.read_csv(barriers/'passability.csv')
+            self.passability = pf[pf.ID.isin(self.barriers.ID)]
+
         self.set_target_weights(weights)
        
         self.tmpdir = Path(tmpdir) if tmpdir else None
@@ -181,10 +420,13 @@ class OptiPass:
 
     def create_paths(self):
         '''
-        Create paths downstream from each gate (the paths will be 
-        used to compute cumulative passability).  The paths are
-        saved in an instance variable.
+        Create paths downstream from each gate.  The paths are saved in an
+        instance variable.  They are not needed to run OptiPass or to compute
+        potential habitat (see `HabitatModel`), but they are useful for checking
+        the structure of a river network.
         '''
+        import networkx as nx
+
         df = self.input_frame
 
         G = nx.from_pandas_edgelist(
@@ -198,7 +440,7 @@ class OptiPass:
             G.add_node(x)
         self.paths = { n: self.path_from(n,G) for n in G.nodes }
 
-    def path_from(self, x: str, graph: nx.DiGraph) -> list:
+    def path_from(self, x: str, graph: 'nx.DiGraph') -> list:
         '''
         Helper function used to create paths -- return a list of nodes in the path 
         from `x` to a downstream barrier that has no descendants.
@@ -210,8 +452,37 @@ class OptiPass:
         Returns:
           a list of all barriers downstream from x
         '''
+        import networkx as nx
+
         return [x] + [child for _, child in nx.dfs_edges(graph,x)]
 
+    def region_groups(self) -> list[list[str]]:
+        '''
+        Partition the regions into groups that are independent river systems.
+        Two regions are in the same group if a barrier in one has a downstream
+        barrier in the other.  OptiPass can be run separately on each group.
+
+        Returns:
+          a list of groups, each a sorted list of region names
+        '''
+        region = dict(zip(self.barriers.ID, self.barriers.region))
+        parent = { r: r for r in region.values() }
+
+        def find(r):
+            while parent[r] != r:
+                parent[r] = parent[parent[r]]
+                r = parent[r]
+            return r
+
+        for x, d in zip(self.barriers.ID, self.barriers.DSID):
+            if d in region:
+                parent[find(region[x])] = find(region[d])
+
+        groups = { }
+        for r in parent:
+            groups.setdefault(find(r), []).append(r)
+        return sorted(sorted(g) for g in groups.values())
+
     def set_target_weights(self, weights: list[int] | None):
         '''
         Create the target weight values that will be passed on the command line when
@@ -247,54 +518,168 @@ class OptiPass:
             logging.info(f'Using saved results in {self.tmpdir}')
             return
        
-        if not optipass_is_installed():
-            raise NotImplementedError('OptiPassMain.exe not found')
-        
-        self.tmpdir = Path(tempfile.mkdtemp(prefix='op', dir='tmp'))
-        barrier_file = self.tmpdir / 'input.txt'
-        self.input_frame.to_csv(barrier_file, index=False, sep='\t', lineterminator=os.linesep, na_rep='NA')
-
-        template = 'bin\\OptiPassMain.exe -f {bf} -o {of} -b {n}'
+        self.write_input_file()
 
         budget = bmin
         for i in range(bcount+1):
-            outfile = self.tmpdir / f'output_{i}.txt'
-            cmnd = template.format(bf=barrier_file, of=outfile, n=budget)
-            if (num_targets := len(self.targets)) > 1:
-                cmnd += ' -t {}'.format(num_targets)
-                cmnd += ' -w ' + ', '.join([str(n) for n in self.weights])
-            res = subprocess.run(cmnd, shell=True, capture_output=True)
-            logging.info(cmnd)
-            resp = res.stdout.decode()
-            if re.search(r'error', resp, re.I):
-                logging.error(f'OptiPassMain.exe: {resp}')
-                raise RuntimeError(resp)
+            self.run_level(i, budget)
             budget += bdelta
         
         n = len(list(self.tmpdir.glob('output*.txt'))) 
         if n < bcount+1:
             raise RuntimeError(f'No output for {bcount-n} of {bcount} optimizations')
 
-    def collect_results(self) -> tuple:
+    def write_input_file(self):
+        '''
+        Make a temp directory for the OptiPass input and output files and write 
+        the input frame to the input file.
+        '''
+        if not optipass_is_installed():
+            raise NotImplementedError('OptiPassMain.exe not found')
+        
+        os.makedirs('tmp', exist_ok=True)
+        self.tmpdir = Path(tempfile.mkdtemp(prefix='op', dir='tmp'))
+        barrier_file = self.tmpdir / 'input.txt'
+        self.input_frame.to_csv(barrier_file, index=False, sep='\t', lineterminator=os.linesep, na_rep='NA')
+
+    def run_level(self, i: int, budget: int) -> Path:
+        '''
+        Run OptiPass for one budget level, using the input file made by `write_input_file`.
+
+        Arguments:
+          i:  the budget level number (used to name the output file)
+          budget:  the budget for this run
+
+        Returns:
+          the path to the output file
+        '''
+        barrier_file = self.tmpdir / 'input.txt'
+        outfile = self.tmpdir / f'output_{i}.txt'
+        template = optipass_command() + ' -f {bf} -o {of} -b {n}'
+        cmnd = template.format(bf=barrier_file, of=outfile, n=budget)
+        if (num_targets := len(self.targets)) > 1:
+            cmnd += ' -t {}'.format(num_targets)
+            cmnd += ' -w ' + ', '.join([str(n) for n in self.weights])
+        res = subprocess.run(cmnd, shell=True, capture_output=True)
+        logging.info(cmnd)
+        resp = res.stdout.decode()
+        if re.search(r'error', resp, re.I):
+            logging.error(f'OptiPassMain.exe: {resp}')
+            raise RuntimeError(resp)
+        return outfile
+
+    def run_progressive(self, bmin: int, bdelta: int, bcount: int, components: list[str] | None = None):
+        '''
+        Generate results for each budget level in two passes.  The first pass
+        uses a greedy heuristic (see `HabitatModel.greedy`) to make provisional
+        results for all the levels, which takes much less time than running 
+        OptiPass.  The second pass runs OptiPass once for each level; the exact
+        result for a level is generated as soon as that run finishes.  After the 
+        last level the complete summary and matrix tables are generated.
+
+        Arguments:
+          bmin:  starting budget level
+          bdelta:  budget increment
+          bcount:  number of budgets
+          components: the parts of the tables to make at the end (optional, see `build_results`)
+
+        Returns:
+          a generator that produces one dictionary for each result.  Provisional
+          results have a `gap` entry, an upper bound on the fraction of the weighted
+          potential habitat that the heuristic might be missing.
+        '''
+        from .habitat import HabitatModel
+
+        model = HabitatModel.from_frames(self.barriers, self.passability, self.mapping, self.weights)
+        levels = [bmin + i * bdelta for i in range(bcount+1)]
+
+        for i, budget in enumerate(levels):
+            gates = model.greedy(budget)
+            _, wph = model.evaluate(gates)
+            bound = model.upper_bound(budget)
+            yield {
+                'level': i,
+                'budget': float(budget),
+                'provisional': True,
+                'wph': float(wph),
+                'gap': float((bound - wph) / bound) if bound > 0 else 0.0,
+                'gates': gates,
+            }
+
+        saved = self.tmpdir is not None
+        if not saved:
+            self.write_input_file()
+        for i, budget in enumerate(levels):
+            outfile = self.tmpdir / f'output_{i}.txt' if saved else self.run_level(i, budget)
+            cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+            self.parse_output(outfile, cols)
+            _, wph = model.evaluate(cols['gates'][0])
+            yield {
+                'level': i,
+                'budget': cols['budget'][0],
+                'provisional': False,
+                'habitat': cols['habitat'][0],
+                'wph': float(wph),
+                'gates': cols['gates'][0],
+            }
+
+        summary, matrix = compact_results(*self.collect_results(components), components)
+        res = { }
+        if summary is not None:
+            res['summary'] = summary
+        if matrix is not None:
+            res['matrix'] = matrix
+        yield res
+
+    def collect_results(self, components: list[str] | None = None) -> tuple:
         '''
         OptiPass makes one output file for each budget level.  Iterate
         over those files to gather results into a pair of data frames. 
 
+        Arguments:
+          components: the parts of the tables to make (optional, see `build_results`)
+
         Returns:
           a tuple with two data frames, one for budgets, the other for barriers 
         '''
         cols = { x: [] for x in ['budget', 'habitat', 'gates']}
         for fn in sorted(self.tmpdir.glob('output_*.txt'), key=lambda p: int(p.stem[7:])):
             self.parse_output(fn, cols)
+        return self.build_results(cols, components)
+
+    def build_results(self, cols: dict, components: list[str] | None = None) -> tuple:
+        '''
+        Make the budget and barrier tables from values parsed from output files.
+        Only the parts of the tables named in `components` are made:
+
+        * `summary`: the budget, habitat, gates, and net gain columns of the budget table
+        * `habitat`: the potential habitat for each target and the weighted total, added to the budget table
+        * `matrix`: the selection matrix, with a column for each budget and a count of the times each gate was selected
+        * `gains`: the unscaled habitat and habitat gain for each target, added to the barrier table
+
+        Arguments:
+          cols: a dictionary with lists of budget, habitat, and gate values, one per budget level
+          components: the parts of the tables to make (optional, the default is all of them)
+
+        Returns:
+          a tuple with two data frames, one for budgets, the other for barriers 
+        '''
+        components = COMPONENTS if components is None else components
         self.summary = pd.DataFrame(cols)
-        
-        dct = {}
-        for i in range(len(self.summary)):
-            b = int(self.summary.budget[i])
-            dct[b] = [ 1 if g in self.summary.gates[i] else 0 for g in self.input_frame.ID]
-        self.matrix = pd.DataFrame(dct, index=self.input_frame.ID)
-        self.matrix['count'] = self.matrix.sum(axis=1)
-        self.add_potential_habitat()
+        self.matrix = pd.DataFrame(index=self.input_frame.ID)
+
+        if 'matrix' in components:
+            dct = {}
+            for i in range(len(self.summary)):
+                b = int(self.summary.budget[i])
+                dct[b] = [ 1 if g in self.summary.gates[i] else 0 for g in self.input_frame.ID]
+            self.matrix = pd.DataFrame(dct, index=self.input_frame.ID)
+            self.matrix['count'] = self.matrix.sum(axis=1)
+        if 'habitat' in components:
+            self.add_potential_habitat()
+        if 'gains' in components:
+            self.add_gains()
+        self.summary['netgain'] = self.summary.habitat - self.summary.habitat[0]
 
         return self.summary, self.matrix
 
@@ -349,42 +734,44 @@ class OptiPass:
     def add_potential_habitat(self):
         '''
         Compute the potential habitat available after restoration, using
-        the original unscaled habitat values.  Adds a new table named summary:
-        one column for each target, showing the potential habitat gain at each 
-        budget level, then the weighted potential habitat over all targets, and
-        finally the net gain.
+        the original unscaled habitat values.  Adds new columns to the summary
+        table:  one column for each target, showing the potential habitat at each 
+        budget level, then the weighted potential habitat over all targets.
+
+        The values are computed by a `HabitatModel`.  The first budget level is
+        evaluated in full; at each following level the model only updates the
+        subtrees above the gates that were added or removed.
         '''
-        # make a copy of the passability data with NaN replaced by 0s and using the
-        # barrier ID as the index
-        df = self.passability.fillna(0).set_index('ID')
+        from .habitat import HabitatModel
+
+        model = HabitatModel.from_frames(self.barriers, self.passability, self.mapping, self.weights)
+        hab = np.zeros((len(self.summary), len(self.targets)))
+        for i, gates in enumerate(self.summary.gates):
+            hab[i], _ = model.evaluate(gates)
         wph = np.zeros(len(self.summary))
         for i in range(len(self.targets)):
             t = self.mapping.iloc[i]
-            cp = self._ah(t, df) * self.weights[i]
+            cp = hab[:,i]
             wph += cp
             col = pd.DataFrame({t.name: cp})
             self.summary = pd.concat([self.summary, col], axis=1)
+        self.summary = pd.concat([self.summary, pd.DataFrame({'wph': wph})], axis = 1)
+
+    def add_gains(self):
+        '''
+        Add two columns to the barrier table for each target: the unscaled habitat
+        above each barrier and the gain in habitat if the barrier is restored.
+        '''
+        # make a copy of the passability data with NaN replaced by 0s and using the
+        # barrier ID as the index
+        df = self.passability.fillna(0).set_index('ID')
+        for i in range(len(self.targets)):
+            t = self.mapping.iloc[i]
             gain = self._gain(t.name, t, df)
             mcol = df[t.unscaled]
             mcol.name = t.name
             self.matrix = pd.concat([self.matrix, mcol, gain], axis=1)
-        self.summary = pd.concat([self.summary, pd.DataFrame({'wph': wph})], axis = 1)
-        self.summary['netgain'] = self.summary.habitat - self.summary.habitat[0]
  
-    # Private method: compute the available habitat for a target, in the form of
-    # a vector of habitat values for each budget level
-
-    def _ah(self, target, data):
-        budgets = self.summary.budget
-        m = self.matrix
-        res = np.zeros(len(budgets))
-        for i in range(len(res)):
-            action = m.iloc[:,i]
-            pvec = data[target.postpass].where(action == 1, data[target.prepass])
-            habitat = data[target.unscaled]
-            res[i] = sum(prod(pvec[x] for x in self.paths[b]) * habitat[b] for b in m.index)
-        return res
-    
     def _gain(self, colname, target, data):
         col = (data[target.postpass] - data[target.prepass]) * data[target.unscaled]
         return col.to_frame(name=f'GAIN_{colname}')
@@ -0,0 +1,108 @@
+#
+# Default scenarios
+#
+# A project can have a file that lists the scenarios users are likely to
+# ask for first.  The server runs them in the background, at low priority,
+# and saves the results in the run archive so the first requests for
+# those scenarios are answered immediately.
+#
+# The file is a JSON object with an optional set of default parameter
+# values and a list of scenarios, e.g.
+#
+#   {
+#     "defaults": { "budgets": [0, 100000, 5], "targets": "all" },
+#     "scenarios": [
+#       { "regions": "each" },
+#       { "regions": ["Trident", "Red Fork"], "targets": ["T1", "T2"], "weights": [3, 1] }
+#     ]
+#   }
+#
+# "each" in place of a list of regions means one scenario for each region,
+# "all" means every region, and "all" in place of a list of targets means
+# every target defined for the project.
+
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+
+PARAMS = ['regions', 'targets', 'budgets', 'weights', 'mapping']
+
+def read_scenarios(path: Path, regions: list[str], targets: list[str]) -> list[dict]:
+    '''
+    Read a file of default scenarios.
+
+    Arguments:
+      path: the name of the file
+      regions: names of the regions in the project
+      targets: names of the targets defined for the project
+
+    Returns:
+      a list of dictionaries with regions, targets, budgets, weights, and mapping
+      parameters, in the order they should be run
+    '''
+    with open(path) as f:
+        spec = json.load(f)
+    defaults = spec.get('defaults', { })
+
+    res = [ ]
+    for s in spec.get('scenarios', []):
+        unknown = [p for p in defaults | s if p not in PARAMS]
+        assert not unknown, f'{path}: unknown parameters: {unknown}'
+        s = { p: s.get(p, defaults.get(p)) for p in PARAMS }
+        assert s['budgets'] and len(s['budgets']) == 3, f'{path}: scenario needs three budget values'
+        if s['targets'] == 'all':
+            s['targets'] = list(targets)
+        assert s['targets'], f'{path}: scenario needs targets'
+        if s['regions'] == 'each':
+            res += [s | {'regions': [r]} for r in sorted(regions)]
+        elif s['regions'] == 'all':
+            res.append(s | {'regions': sorted(regions)})
+        else:
+            assert s['regions'], f'{path}: scenario needs regions'
+            res.append(s)
+    return res
+
+def claim(path: Path):
+    '''
+    Try to take an exclusive lock on a file, so only one of the server's
+    processes runs default scenarios.  The lock is released when the file
+    is closed or the process exits.
+
+    Arguments:
+      path: the name of the lock file (it is created if it doesn't exist)
+
+    Returns:
+      the open lock file, which has to be kept open to hold the lock, or None
+      if another process has the lock
+    '''
+    f = open(path, 'a+')
+    try:
+        if sys.platform == 'win32':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def lower_priority():
+    '''
+    Lower the scheduling priority of the current process, so OptiPass runs
+    started by it (which inherit the priority) don't slow down responses to
+    users.  Used to initialize the worker process that runs default scenarios.
+    On Windows, where `os.nice` is not available, the process is put in the
+    below normal priority class.
+    '''
+    if hasattr(os, 'nice'):
+        os.nice(10)
+    elif sys.platform == 'win32':
+        import psutil
+        psutil.Process().nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+    else:
+        logging.info('prewarm: process priority not changed')
@@ -0,0 +1,115 @@
+#
+# Ranking gates by standalone benefit
+#
+# The benefit of restoring a single gate, with no other gates restored,
+# is computed for every gate and every target when a project is loaded.
+# A ranking for a set of targets and weights is then a weighted sum of
+# precomputed columns, so it can be made without running OptiPass.
+
+import numpy as np
+
+from .habitat import HabitatModel
+from .model import ProjectModel
+from .tables import Table
+
+class GateRanking:
+    '''
+    An instance of this class has the standalone gain of every gate in a
+    project for each target defined in one mapping (colnames) file.
+
+    The gain for a gate g and a target is (post - pre) * D * U, where D is the
+    cumulative passability of the barriers downstream from g and U is the
+    habitat above g, discounted by the passability of the barriers in between.
+    The gains are computed by `HabitatModel.standalone_gains`, so they are the
+    same as the change in potential habitat when g is the only gate restored.
+    Gains are computed for the whole river network, so a gate's downstream
+    barriers are included even if they are in a different region.
+
+    Gates that can't be restored (NPROJ is not 1 or the cost is missing) are
+    not ranked.  For each target there is an index of the gates sorted by gain
+    per dollar.
+    '''
+
+    def __init__(self, model: ProjectModel, mapping: Table):
+        '''
+        Compute the gains.
+
+        Arguments:
+          model: the barrier and passability data for the project
+          mapping: a mapping file, with abbrev, prepass, postpass, and unscaled columns
+        '''
+        self.model = model
+        self.targets = mapping.columns['abbrev']
+        self.target_index = { t: j for j, t in enumerate(self.targets) }
+
+        def columns(name):
+            return np.nan_to_num(np.column_stack([model.column(c) for c in mapping.columns[name]]))
+
+        # barriers are identified by row number, with -1 at a river mouth
+        network = HabitatModel(
+            range(len(model)),
+            model.dsid.tolist(),
+            columns('prepass'),
+            columns('postpass'),
+            columns('unscaled'),
+        )
+        self.gains = network.standalone_gains()
+
+        self.gates = np.flatnonzero((model.nproj == 1) & np.isfinite(model.cost))
+        self.costs = model.cost[self.gates]
+        self.sorted = { }
+        for t, j in self.target_index.items():
+            ratios = per_dollar(self.gains[self.gates, j], self.costs)
+            self.sorted[t] = self.gates[np.argsort(-ratios, kind='stable')]
+
+    def top(self,
+            targets: list[str],
+            weights: list[int] | None = None,
+            regions: list[str] | None = None,
+            k: int | None = None) -> tuple:
+        '''
+        Rank gates by weighted gain per dollar.
+
+        Arguments:
+          targets: names of targets to include
+          weights: target weights (optional, default is 1 for each target)
+          regions: names of regions to include (optional, the default is all regions)
+          k: the number of gates to return (optional, the default is all of them)
+
+        Returns:
+          a tuple with the row numbers of the gates, their weighted gains, and the
+          gains per dollar, all in order of decreasing gain per dollar
+        '''
+        unknown = [t for t in targets if t not in self.target_index]
+        assert not unknown, f'unknown targets: {unknown}'
+        weights = weights or [1] * len(targets)
+        assert len(weights) == len(targets), 'need one weight for each target'
+
+        if regions is None:
+            selected = np.ones(len(self.model), dtype=bool)
+        else:
+            selected = np.zeros(len(self.model), dtype=bool)
+            selected[self.model.rows(regions)] = True
+
+        if len(targets) == 1:
+            rows = self.sorted[targets[0]]
+            rows = rows[selected[rows]][:k]
+            gains = self.gains[rows, self.target_index[targets[0]]] * weights[0]
+        else:
+            cols = [self.target_index[t] for t in targets]
+            mask = selected[self.gates]
+            rows = self.gates[mask]
+            gains = self.gains[rows][:, cols] @ np.asarray(weights, dtype=np.float64)
+            order = np.argsort(-per_dollar(gains, self.costs[mask]), kind='stable')[:k]
+            rows, gains = rows[order], gains[order]
+
+        return rows, gains, per_dollar(gains, self.model.cost[rows])
+
+def per_dollar(gains: np.ndarray, costs: np.ndarray) -> np.ndarray:
+    '''
+    Divide gains by costs.  A gate that costs nothing has an infinite
+    ratio if it has any gain.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res = gains / costs
+    return np.where(costs > 0, res, np.where(gains > 0, np.inf, 0.0))
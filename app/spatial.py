@@ -0,0 +1,129 @@
+#
+# Spatial index for barrier locations
+#
+# Barriers are put in the cells of a uniform grid so the server can find
+# the barriers inside a map viewport, or the barriers closest to a point,
+# without looking at every barrier in a project.
+
+from math import ceil, floor, hypot, isfinite, sqrt
+
+class GridIndex:
+    '''
+    An instance of this class is a grid of square cells covering a set of
+    points.  Each cell has a list of the points inside it.  Points are
+    identified by their position in the lists passed to the constructor.
+    '''
+
+    def __init__(self, xs: list[float], ys: list[float], cell_size: float | None = None):
+        '''
+        Put a set of points in a grid.  Points with missing coordinates
+        are not included.
+
+        Arguments:
+          xs: x coordinates
+          ys: y coordinates
+          cell_size: width and height of a cell (optional, the default
+            makes a grid with about one point per cell)
+        '''
+        self.xs = list(xs)
+        self.ys = list(ys)
+        points = [i for i in range(len(self.xs)) if isfinite(self.xs[i]) and isfinite(self.ys[i])]
+
+        self.x0 = min((self.xs[i] for i in points), default=0.0)
+        self.y0 = min((self.ys[i] for i in points), default=0.0)
+        width = max((self.xs[i] for i in points), default=0.0) - self.x0
+        height = max((self.ys[i] for i in points), default=0.0) - self.y0
+        if cell_size is None:
+            cell_size = max(width, height) / max(1, ceil(sqrt(len(points))))
+        self.cell_size = cell_size or 1.0
+        self.ncols = floor(width / self.cell_size) + 1
+        self.nrows = floor(height / self.cell_size) + 1
+
+        self.cells = { }
+        for i in points:
+            self.cells.setdefault(self._cell(self.xs[i], self.ys[i]), []).append(i)
+
+    def __len__(self):
+        return sum(len(lst) for lst in self.cells.values())
+
+    def within(self, xmin: float, ymin: float, xmax: float, ymax: float) -> list[int]:
+        '''
+        Find the points inside a rectangle (including points on the edges).
+
+        Arguments:
+          xmin, ymin: the lower left corner of the rectangle
+          xmax, ymax: the upper right corner
+
+        Returns:
+          the indexes of the points, in the order they were passed to the constructor
+          (a ValueError is raised if a coordinate is NaN or infinite)
+        '''
+        self._check(xmin, ymin, xmax, ymax)
+        c0, r0 = self._cell(xmin, ymin)
+        c1, r1 = self._cell(xmax, ymax)
+        res = []
+        for c in range(max(c0, 0), min(c1, self.ncols-1) + 1):
+            for r in range(max(r0, 0), min(r1, self.nrows-1) + 1):
+                for i in self.cells.get((c,r), []):
+                    if xmin <= self.xs[i] <= xmax and ymin <= self.ys[i] <= ymax:
+                        res.append(i)
+        return sorted(res)
+
+    def nearest(self, x: float, y: float, n: int) -> list[int]:
+        '''
+        Find the points closest to a location.  Cells are searched in rings
+        around the cell containing the location, stopping when the next ring
+        can't have a point closer than the n'th point found so far.  If the
+        location is outside the grid the search starts at the first ring that
+        overlaps the grid, and only the parts of rings inside the grid are
+        searched, so the time doesn't depend on how far away the location is.
+
+        Arguments:
+          x, y: the location
+          n: the number of points to return
+
+        Returns:
+          the indexes of the points, closest first (a ValueError is raised
+          if a coordinate is NaN or infinite)
+        '''
+        self._check(x, y)
+        if n <= 0:
+            return []
+        c, r = self._cell(x, y)
+        first = max(0, -c, c-(self.ncols-1), -r, r-(self.nrows-1))
+        rings = max(abs(c), abs(self.ncols-1-c), abs(r), abs(self.nrows-1-r))
+        found = []
+        for k in range(first, rings + 1):
+            for cell in self._ring(c, r, k):
+                for i in self.cells.get(cell, []):
+                    found.append((hypot(self.xs[i]-x, self.ys[i]-y), i))
+            found.sort()
+            del found[n:]
+            if len(found) == n and found[-1][0] <= k * self.cell_size:
+                break
+        return [i for _, i in found]
+
+    def _check(self, *coords):
+        if not all(isfinite(v) for v in coords):
+            raise ValueError(f'coordinates must be finite numbers: {coords}')
+
+    def _cell(self, x, y):
+        return floor((x - self.x0) / self.cell_size), floor((y - self.y0) / self.cell_size)
+
+    def _ring(self, c, r, k):
+        '''
+        Generate the cells in the grid at distance k (measured in cells) from a cell.
+        '''
+        if k == 0:
+            yield (c, r)
+            return
+        cols = range(max(c-k, 0), min(c+k, self.ncols-1) + 1)
+        rows = range(max(r-k+1, 0), min(r+k-1, self.nrows-1) + 1)
+        for j in (r-k, r+k):
+            if 0 <= j < self.nrows:
+                for i in cols:
+                    yield (i, j)
+        for i in (c-k, c+k):
+            if 0 <= i < self.ncols:
+                for j in rows:
+                    yield (i, j)
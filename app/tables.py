@@ -0,0 +1,114 @@
+#
+# In-memory versions of the CSV files in the static folders
+#
+# A table is parsed once, when the server starts, and kept as a set of
+# columns of strings, along with the text of the file.  Values are not
+# converted, and a request for the whole table gets the original text.
+
+import csv
+from io import StringIO
+from pathlib import Path
+
+class Table:
+    '''
+    An instance of this class has the header and columns from a CSV file,
+    and optional indexes for finding the rows that have a given value in a
+    column.
+    '''
+
+    def __init__(self, header: list[str], records: list[list[str]]):
+        '''
+        Make a table from a list of records.
+
+        Arguments:
+          header: column names
+          records: lists of field values, one per row
+        '''
+        self.header = header
+        self.columns = { name: [rec[j] if j < len(rec) else '' for rec in records] for j, name in enumerate(header) }
+        self.nrows = len(records)
+        self.indexes = { }
+        self.text = None
+
+    @classmethod
+    def read(cls, path: Path):
+        '''
+        Parse a CSV file.
+
+        Arguments:
+          path: the name of the file
+
+        Returns:
+          a new Table object
+        '''
+        with open(path, newline='') as f:
+            text = f.read()
+        header, *records = [rec for rec in csv.reader(StringIO(text)) if rec]
+        table = cls(header, records)
+        # same as reading the file in text mode
+        table.text = text.replace('\r\n', '\n').replace('\r', '\n').rstrip()
+        return table
+
+    def __len__(self):
+        return self.nrows
+
+    def add_index(self, name: str, keys: list[str] | None = None):
+        '''
+        Make an index that maps a value to the rows that have that value.
+
+        Arguments:
+          name: the name of the index
+          keys: the value for each row (optional, the default is the column with the same name as the index)
+        '''
+        keys = self.columns[name] if keys is None else keys
+        dct = { }
+        for i, k in enumerate(keys):
+            dct.setdefault(k, []).append(i)
+        self.indexes[name] = dct
+
+    def find(self, name: str, values: list[str]) -> list[int]:
+        '''
+        Use an index to find rows.
+
+        Arguments:
+          name: the name of the index
+          values: the values to look for
+
+        Returns:
+          the numbers of the rows that have any of the values, in order
+        '''
+        dct = self.indexes[name]
+        return sorted(i for v in set(values) for i in dct.get(v, []))
+
+    def to_csv(self, rows: list[int] | None = None, columns: list[str] | None = None) -> str:
+        '''
+        Write a subset of the table in CSV format.  If the table was read from a
+        file and all the rows and columns are selected the result is the text of
+        the file, with trailing white space removed.
+
+        Arguments:
+          rows: the numbers of the rows to include (optional, the default is all rows)
+          columns: the names of the columns to include (optional, the default is all columns)
+
+        Returns:
+          the header line and the selected rows, as one long string
+        '''
+        if rows is None and columns is None and self.text is not None:
+            return self.text
+        rows = range(self.nrows) if rows is None else rows
+        columns = self.header if columns is None else columns
+        cols = [self.columns[c] for c in columns]
+        buf = StringIO()
+        w = csv.writer(buf, lineterminator='\n')
+        w.writerow(columns)
+        w.writerows([col[i] for col in cols] for i in rows)
+        return buf.getvalue().rstrip('\n')
+
+def to_float(s: str) -> float:
+    '''
+    Convert a string from a CSV file to a float, using NaN for missing values.
+    '''
+    try:
+        return float(s)
+    except ValueError:
+        return float('nan')
@@ -0,0 +1,170 @@
+#
+# Multi-resolution versions of static map images
+#
+# A map image is divided into a pyramid of levels.  The top level (the
+# highest zoom) is the original image, and each level below it is half
+# the width and height of the one above.  Each level is cut into square
+# tiles.  Levels and tiles are made the first time they are requested
+# and saved in memory, up to a limit; when the limit is reached the least
+# recently used ones are removed.  The server makes them in worker threads,
+# so a lock for each level or tile makes sure it is only made once, while
+# other threads go on making (or encoding) different ones.
+
+from collections import OrderedDict
+from email.utils import formatdate
+from io import BytesIO
+from math import ceil, log2
+from pathlib import Path
+import threading
+
+from PIL import Image
+
+TILE_SIZE = 256
+
+# The number of levels and the number of PNG images (tiles and scaled maps)
+# kept in memory for each map
+MAX_LEVELS = 3
+MAX_IMAGES = 256
+
+class MapPyramid:
+    '''
+    An instance of this class holds the scaled versions and tiles for
+    one map image.
+    '''
+
+    def __init__(self, path: Path, tile_size: int = TILE_SIZE):
+        '''
+        Read the size of an image and compute the number of levels.  The
+        image itself is not loaded until a level or tile is requested.
+
+        Arguments:
+          path: the path to the image file
+          tile_size: width and height of a tile, in pixels
+        '''
+        self.path = Path(path)
+        self.tile_size = tile_size
+
+        st = self.path.stat()
+        self.version = f'{st.st_mtime_ns:x}-{st.st_size:x}'
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+        with Image.open(self.path) as img:
+            self.width, self.height = img.size
+        self.max_zoom = max(0, ceil(log2(max(self.width, self.height) / tile_size)))
+
+        self.levels = OrderedDict()
+        self.images = OrderedDict()
+        self.max_levels = MAX_LEVELS
+        self.max_images = MAX_IMAGES
+        self.lock = threading.Lock()
+        self.pending = { }
+
+    def info(self) -> dict:
+        '''
+        Describe the pyramid.
+
+        Returns:
+          a dictionary with the image size, the tile size, and the size of each level
+        '''
+        return {
+            'width': self.width,
+            'height': self.height,
+            'tile_size': self.tile_size,
+            'max_zoom': self.max_zoom,
+            'levels': [self.level_size(z) for z in range(self.max_zoom+1)],
+        }
+
+    def level_size(self, z: int) -> tuple[int,int]:
+        '''
+        Compute the width and height of the image at a zoom level.
+
+        Arguments:
+          z: the zoom level, from 0 to max_zoom
+
+        Returns:
+          the width and height, in pixels
+        '''
+        scale = 2 ** (self.max_zoom - z)
+        return ceil(self.width / scale), ceil(self.height / scale)
+
+    def level(self, z: int) -> Image.Image:
+        '''
+        Return the image for a zoom level, making it from the level above
+        if it hasn't been made yet.
+
+        Arguments:
+          z: the zoom level, from 0 to max_zoom
+        '''
+        def make():
+            if z == self.max_zoom:
+                with Image.open(self.path) as img:
+                    img.load()
+                    return img
+            return self.level(z+1).resize(self.level_size(z), Image.LANCZOS)
+        return self._cached(self.levels, z, make, self.max_levels)
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        '''
+        Return a PNG image for a tile.  Tiles on the right and bottom edges
+        are smaller than the tile size when a level is not an exact multiple
+        of the tile size.
+
+        Arguments:
+          z: the zoom level, from 0 to max_zoom
+          x: column number, from 0 at the left edge
+          y: row number, from 0 at the top
+
+        Returns:
+          the tile, in PNG format
+        '''
+        assert 0 <= z <= self.max_zoom, f'zoom level must be between 0 and {self.max_zoom}'
+        w, h = self.level_size(z)
+        n = self.tile_size
+        assert 0 <= x < ceil(w / n) and 0 <= y < ceil(h / n), f'no tile at {z}/{x}/{y}'
+        box = (x * n, y * n, min(w, (x+1) * n), min(h, (y+1) * n))
+        return self._cached(self.images, (z, x, y), lambda: self._png(self.level(z).crop(box)), self.max_images)
+
+    def scaled(self, width: int) -> tuple[int, bytes]:
+        '''
+        Return the smallest level that is at least as wide as a requested width.
+
+        Arguments:
+          width: the width the client will display, in pixels
+
+        Returns:
+          the zoom level and the image for that level, in PNG format
+        '''
+        z = self.max_zoom
+        while z > 0 and self.level_size(z-1)[0] >= width:
+            z -= 1
+        return z, self._cached(self.images, z, lambda: self._png(self.level(z)), self.max_images)
+
+    def _cached(self, cache, key, make, limit):
+        '''
+        Look up a level or image, calling make to make it if it isn't in the
+        cache.  Only one thread makes a given key; other threads asking for
+        the same key wait for it, but the pyramid lock is not held while it is
+        being made.
+        '''
+        with self.lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+            pending = self.pending.setdefault((id(cache), key), threading.Lock())
+        with pending:
+            with self.lock:
+                if key in cache:
+                    cache.move_to_end(key)
+                    return cache[key]
+            value = make()
+            with self.lock:
+                cache[key] = value
+                while len(cache) > limit:
+                    cache.popitem(last=False)
+                self.pending.pop((id(cache), key), None)
+        return value
+
+    def _png(self, img: Image.Image) -> bytes:
+        buf = BytesIO()
+        img.save(buf, format='PNG', optimize=True)
+        return buf.getvalue()
@@ -0,0 +1,218 @@
+#
+# Load generator for the OptiPass server
+#
+# Sends a mix of the requests a GUI makes when a user opens a project and
+# runs the optimizer, with a fixed number of requests in flight, and
+# reports throughput, latency percentiles, and error rates.
+#
+# Example (after starting a server that uses the stand-in optimizer):
+#
+#   $ python -m loadtest.loadgen --url http://localhost:8000 --project demo \
+#       --concurrency 20 --requests 1000 --mix barriers=4 targets=2 mapinfo=2 optipass=1
+
+import argparse
+import asyncio
+from io import StringIO
+import csv
+import random
+import time
+
+import httpx
+
+DEFAULT_MIX = { 'barriers': 4, 'targets': 2, 'mapinfo': 2, 'optipass': 1 }
+
+class Scenario:
+    '''
+    An instance of this class makes the URLs for each kind of request.  The
+    region and target names for `optipass` requests are fetched from the
+    server when the scenario is set up.
+    '''
+
+    def __init__(self, project: str, budgets: list[int], seed: int | None = None):
+        self.project = project
+        self.budgets = budgets
+        self.rng = random.Random(seed)
+        self.regions = []
+        self.targets = []
+
+    async def setup(self, client: httpx.AsyncClient):
+        '''
+        Fetch the region and target names for the project.
+        '''
+        resp = await client.get(f'/barriers/{self.project}')
+        resp.raise_for_status()
+        self.regions = sorted({ rec['region'] for rec in csv.DictReader(StringIO(resp.json()['barriers'])) })
+        resp = await client.get(f'/targets/{self.project}')
+        resp.raise_for_status()
+        self.targets = [rec['abbrev'] for rec in csv.DictReader(StringIO(resp.json()['targets']))]
+
+    def request(self, kind: str) -> tuple[str, dict | None]:
+        '''
+        Make the path and query parameters for a request.
+
+        Arguments:
+          kind: the name of a command (barriers, targets, mapinfo, or optipass)
+
+        Returns:
+          the path and a dictionary of query parameters (or None)
+        '''
+        if kind != 'optipass':
+            return f'/{kind}/{self.project}', None
+        regions = self.rng.sample(self.regions, self.rng.randint(1, len(self.regions)))
+        targets = self.rng.sample(self.targets, self.rng.randint(1, len(self.targets)))
+        params = {
+            'regions': regions,
+            'targets': targets,
+            'budgets': self.budgets,
+        }
+        if len(targets) > 1:
+            params['weights'] = [self.rng.randint(1, 5) for _ in targets]
+        return f'/optipass/{self.project}', params
+
+async def run(
+        client: httpx.AsyncClient,
+        scenario: Scenario,
+        mix: dict[str, int],
+        concurrency: int,
+        requests: int | None = None,
+        duration: float | None = None,
+    ) -> dict:
+    '''
+    Send requests until the request count or the time limit is reached.
+
+    Arguments:
+      client: the client used to connect to the server
+      scenario: makes the URLs
+      mix: relative frequency of each kind of request
+      concurrency: number of requests in flight at the same time
+      requests: total number of requests to send (optional)
+      duration: number of seconds to send requests (optional)
+
+    Returns:
+      the summary made by `summarize`
+    '''
+    kinds = list(mix)
+    freqs = [mix[k] for k in kinds]
+    results = []
+    sent = 0
+    start = time.perf_counter()
+
+    def more():
+        if requests is not None and sent >= requests:
+            return False
+        if duration is not None and time.perf_counter() - start >= duration:
+            return False
+        return True
+
+    async def worker():
+        nonlocal sent
+        while more():
+            sent += 1
+            kind = scenario.rng.choices(kinds, freqs)[0]
+            path, params = scenario.request(kind)
+            t0 = time.perf_counter()
+            try:
+                resp = await client.get(path, params=params)
+                ok = resp.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            results.append((kind, time.perf_counter() - t0, ok))
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(results, time.perf_counter() - start)
+
+def percentile(values: list[float], p: float) -> float:
+    '''
+    Compute a percentile using the nearest-rank method.
+
+    Arguments:
+      values: the data
+      p: the percentile, from 0 to 100
+
+    Returns:
+      the smallest value that is at least as large as p percent of the data
+    '''
+    if not values:
+        return float('nan')
+    data = sorted(values)
+    k = max(0, min(len(data) - 1, -(-len(data) * p // 100) - 1))
+    return data[int(k)]
+
+def summarize(results: list[tuple], elapsed: float) -> dict:
+    '''
+    Collect statistics for each kind of request and for all requests.
+
+    Arguments:
+      results: a list of tuples with the kind of request, the latency in seconds, and a success flag
+      elapsed: total time for the test, in seconds
+
+    Returns:
+      a dictionary with an entry for each kind of request and one named "all"; each
+      entry has a request count, throughput, error rate, and latency percentiles
+    '''
+    groups = { 'all': results }
+    for r in results:
+        groups.setdefault(r[0], []).append(r)
+    res = { }
+    for kind, lst in groups.items():
+        lat = [r[1] for r in lst]
+        errors = sum(1 for r in lst if not r[2])
+        res[kind] = {
+            'count': len(lst),
+            'throughput': len(lst) / elapsed if elapsed > 0 else float('nan'),
+            'error_rate': errors / len(lst) if lst else 0.0,
+            'p50': percentile(lat, 50),
+            'p90': percentile(lat, 90),
+            'p99': percentile(lat, 99),
+            'max': max(lat, default=float('nan')),
+        }
+    return res
+
+def print_report(summary: dict):
+    '''
+    Print a table with one line for each kind of request.  Latencies are in milliseconds.
+    '''
+    print(f'{"request":<10} {"count":>7} {"req/s":>8} {"errors":>7} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}')
+    for kind in sorted(summary, key=lambda k: (k == 'all', k)):
+        s = summary[kind]
+        ms = [1000 * s[k] for k in ['p50', 'p90', 'p99', 'max']]
+        print(f'{kind:<10} {s["count"]:>7} {s["throughput"]:>8.1f} {s["error_rate"]:>7.1%} ' + ' '.join(f'{x:>9.1f}' for x in ms))
+
+def parse_mix(specs: list[str]) -> dict[str, int]:
+    '''
+    Convert a list of strings of the form kind=weight into a dictionary.
+    '''
+    mix = { }
+    for spec in specs:
+        kind, _, weight = spec.partition('=')
+        assert kind in DEFAULT_MIX, f'unknown request type: {kind}'
+        mix[kind] = int(weight or 1)
+    return mix
+
+def init_cli():
+    parser = argparse.ArgumentParser(description='Load generator for the OptiPass server')
+    parser.add_argument('--url', default='http://localhost:8000', help='server URL')
+    parser.add_argument('--project', default='demo', help='project name')
+    parser.add_argument('--concurrency', type=int, default=10, help='requests in flight')
+    parser.add_argument('--requests', type=int, help='total number of requests')
+    parser.add_argument('--duration', type=float, help='number of seconds to run')
+    parser.add_argument('--mix', nargs='+', metavar='kind=weight', help='relative frequency of each request type')
+    parser.add_argument('--budgets', type=int, nargs=3, default=[0, 100000, 5], metavar='n', help='starting budget, increment, and count')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds to wait for a response')
+    parser.add_argument('--seed', type=int, help='random number seed')
+    args = parser.parse_args()
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+    return args
+
+async def main():
+    args = init_cli()
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    scenario = Scenario(args.project, args.budgets, args.seed)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        await scenario.setup(client)
+        summary = await run(client, scenario, mix, args.concurrency, args.requests, args.duration)
+    print_report(summary)
+
+if __name__ == '__main__':
+    asyncio.run(main())
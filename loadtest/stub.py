@@ -0,0 +1,171 @@
+#
+# Stand-in for OptiPassMain.exe
+#
+# Reads an OptiPass barrier file and writes an output file in the same
+# format as OptiPass, after waiting for a configurable amount of time.
+# Gates are chosen by a simple greedy rule (largest benefit per dollar
+# first), so the results are plausible but not optimal.
+#
+# Use it by setting the OPTIPASS environment variable before starting
+# the server, e.g.
+#
+#   $ OPTIPASS='python -m loadtest.stub --latency 2' uvicorn app.main:app
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from app.habitat import HabitatModel
+
+def read_barrier_file(fn: str) -> dict:
+    '''
+    Read a barrier file written by `OptiPass.run`.
+
+    Arguments:
+      fn: the name of the file
+
+    Returns:
+      a dictionary with a list of values for each column; numbers are
+      converted to floats, with NA converted to None
+    '''
+    with open(fn) as f:
+        header = f.readline().strip().split('\t')
+        cols = { name: [] for name in header }
+        for line in f:
+            if not line.strip():
+                continue
+            for name, val in zip(header, line.rstrip('\r\n').split('\t')):
+                if name not in ['ID', 'REG', 'DSID']:
+                    val = None if val == 'NA' else float(val)
+                cols[name].append(val)
+    return cols
+
+def habitat_model(cols: dict, targets: list[str]) -> HabitatModel:
+    '''
+    Make the habitat model the server uses for provisional results from the
+    columns of a barrier file.  Missing values are replaced by 0.
+
+    Arguments:
+      cols: the barrier file
+      targets: target names (the suffixes of the HAB_, PRE_, and POST_ columns)
+
+    Returns:
+      a new HabitatModel object, with no gates selected
+    '''
+    def columns(prefix):
+        return [[x or 0.0 for x in cols[prefix + t]] for t in targets]
+
+    return HabitatModel(
+        cols['ID'],
+        cols['DSID'],
+        np.transpose(columns('PRE_')),
+        np.transpose(columns('POST_')),
+        np.transpose(columns('HAB_')),
+    )
+
+def potential_habitat(cols: dict, targets: list[str], selected: set[int]) -> list[float]:
+    '''
+    Compute the potential habitat for each target when a set of gates is restored.
+
+    Arguments:
+      cols: the barrier file
+      targets: target names (the suffixes of the HAB_, PRE_, and POST_ columns)
+      selected: row numbers of restored gates
+
+    Returns:
+      the potential habitat for each target
+    '''
+    hab, _ = habitat_model(cols, targets).evaluate([cols['ID'][i] for i in selected])
+    return hab.tolist()
+
+def standalone_gains(cols: dict, targets: list[str], weights: list[float]) -> list[float]:
+    '''
+    Compute the weighted change in potential habitat when a gate is the only
+    gate restored (see `HabitatModel.standalone_gains`).
+    '''
+    gains = habitat_model(cols, targets).standalone_gains()
+    return (gains @ np.asarray(weights, dtype=float)).tolist()
+
+def choose_gates(cols: dict, targets: list[str], weights: list[float], budget: float) -> set[int]:
+    '''
+    Pick gates in order of weighted standalone benefit per dollar.  Gates that
+    don't fit in the remaining budget are skipped.
+
+    Returns:
+      the row numbers of the selected gates
+    '''
+    gains = standalone_gains(cols, targets, weights)
+    candidates = []
+    for i, gain in enumerate(gains):
+        cost = cols['COST'][i]
+        if cols['NPROJ'][i] != 1 or cost is None:
+            continue
+        candidates.append((-gain / max(cost, 1e-9), i))
+    selected = set()
+    spent = 0.0
+    for _, i in sorted(candidates):
+        if spent + cols['COST'][i] <= budget:
+            selected.add(i)
+            spent += cols['COST'][i]
+    return selected
+
+def write_output(fn: str, cols: dict, targets: list[str], weights: list[float], budget: float, selected: set[int]):
+    '''
+    Write an output file in the format used by OptiPass.
+    '''
+    hab = potential_habitat(cols, targets, selected)
+    base = potential_habitat(cols, targets, set())
+    with open(fn, 'w') as f:
+        print(f'BUDGET:\t{budget:.2f}', file=f)
+        print('STATUS:\tOPT', file=f)
+        print('%OPTGAP:\t0.00', file=f)
+        if len(targets) == 1:
+            print(f'PTNL_HABITAT:\t{hab[0]:.4f}', file=f)
+            print(f'NETGAIN:\t{hab[0]-base[0]:.4f}', file=f)
+        else:
+            print('WEIGHTS', file=f)
+            for i, w in enumerate(weights):
+                print(f'TARGET{i+1}:\t{w:.4f}', file=f)
+            print('PTNL_HABITAT', file=f)
+            for i, h in enumerate(hab):
+                print(f'TARGET{i+1}:\t{h:.4f}', file=f)
+            wph = sum(w * h for w, h in zip(weights, hab))
+            print(f'WT_PTNL_HABITAT:\t{wph:.4f}', file=f)
+            print(f'WT_NETGAIN:\t{wph - sum(w * b for w, b in zip(weights, base)):.4f}', file=f)
+        print(file=f)
+        print('BARID\tACTION', file=f)
+        for i, x in enumerate(cols['ID']):
+            print(f'{x}\t{1 if i in selected else 0}', file=f)
+
+def init_cli():
+    '''
+    Parse the command line.  The options are the ones OptiPass uses, plus
+    options that control how long the program takes.  Weights are written
+    by `OptiPass.run` as a comma separated list that can have spaces.
+    '''
+    parser = argparse.ArgumentParser(description='Stand-in for OptiPassMain.exe')
+    parser.add_argument('-f', metavar='file', required=True, help='barrier file')
+    parser.add_argument('-o', metavar='file', required=True, help='output file')
+    parser.add_argument('-b', metavar='n', type=float, required=True, help='budget')
+    parser.add_argument('-t', metavar='n', type=int, default=1, help='number of targets')
+    parser.add_argument('-w', metavar='x', nargs='+', default=[], help='target weights')
+    parser.add_argument('--latency', metavar='sec', type=float, default=1.0, help='time to spend on each run')
+    parser.add_argument('--jitter', metavar='frac', type=float, default=0.0, help='random variation in latency, as a fraction')
+    return parser.parse_args()
+
+def main():
+    args = init_cli()
+    cols = read_barrier_file(args.f)
+    targets = [c[4:] for c in cols if c.startswith('HAB_')]
+    weights = [float(x) for w in args.w for x in w.split(',') if x] or [1.0] * len(targets)
+
+    delay = args.latency * random.uniform(1 - args.jitter, 1 + args.jitter)
+    time.sleep(max(0.0, delay))
+
+    selected = choose_gates(cols, targets, weights, args.b)
+    write_output(args.o, cols, targets, weights, args.b, selected)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#
+# Unit tests for the run archive
+#
+
+from importlib import import_module
+
+TestClient = import_module("fastapi.testclient").TestClient
+
+main = import_module("app.main","ip-server")
+app = main.app
+
+archive = import_module("app.archive","ip-server")
+RunArchive = archive.RunArchive
+
+import pytest
+
+from contextlib import closing
+import shutil
+import sys
+from pathlib import Path
+
+STUB = f'{sys.executable} -m loadtest.stub --latency 0'
+
+LEVELS = {
+    'budget': [0.0, 100000.0],
+    'habitat': [5.4906, 6.369],
+    'gates': [[], ['E']],
+}
+
+@pytest.fixture
+def runs(tmp_path):
+    return RunArchive(tmp_path / 'runs.db')
+
+def test_scenario_key():
+    '''
+    The order of the regions doesn't matter, but the order of the targets does
+    '''
+    p1 = archive.scenario_params('demo', ['Trident', 'Red Fork'], [0, 100000, 1], ['T1','T2'], [3,1], None)
+    p2 = archive.scenario_params('demo', ['Red Fork', 'Trident'], [0, 100000, 1], ['T1','T2'], [3,1], None)
+    p3 = archive.scenario_params('demo', ['Red Fork', 'Trident'], [0, 100000, 1], ['T2','T1'], [3,1], None)
+    assert archive.scenario_key(p1) == archive.scenario_key(p2)
+    assert archive.scenario_key(p1) != archive.scenario_key(p3)
+
+def test_optimizer_key():
+    '''
+    Runs made by a different optimizer command have a different key
+    '''
+    p1 = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None, optimizer='bin\\OptiPassMain.exe')
+    p2 = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None, optimizer=STUB)
+    assert archive.scenario_key(p1) != archive.scenario_key(p2)
+
+def test_save_and_lookup(runs):
+    '''
+    A saved run can be found with its key and data version
+    '''
+    params = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    key = archive.scenario_key(params)
+    assert runs.lookup(key, 'v1') is None
+    runs.save('v1', params, LEVELS)
+    assert runs.lookup(key, 'v1') == LEVELS
+    assert runs.lookup(key, 'v2') is None
+    assert runs.params(key, 'v1') == params
+    lst = runs.runs('demo')
+    assert len(lst) == 1 and lst[0]['key'] == key and lst[0]['version'] == 'v1'
+    assert runs.runs('other') == []
+
+def test_gate_ids(runs):
+    '''
+    Barrier IDs can have spaces in them
+    '''
+    params = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    levels = LEVELS | {'gates': [[], ['Gate 7', 'E']]}
+    runs.save('v1', params, levels)
+    assert runs.lookup(archive.scenario_key(params), 'v1') == levels
+
+def test_prune(runs):
+    '''
+    Pruning removes a project's runs for other data versions and leaves
+    other projects alone
+    '''
+    p1 = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    p2 = archive.scenario_params('other', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    runs.save('v1', p1, LEVELS)
+    runs.save('v2', p1, LEVELS)
+    runs.save('v1', p2, LEVELS)
+    assert runs.prune('demo', ['v2']) == 1
+    assert [r['version'] for r in runs.runs('demo')] == ['v2']
+    assert runs.lookup(archive.scenario_key(p1), 'v1') is None
+    assert len(runs.runs('other')) == 1
+
+def test_prune_on_load(monkeypatch, tmp_path):
+    '''
+    Loading a project removes archived runs made with older data
+    '''
+    main.init()
+    runs = RunArchive(tmp_path / 'runs.db')
+    monkeypatch.setattr(main, 'run_archive', runs)
+    params = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    runs.save('old', params, LEVELS)
+    runs.save(main.run_version('demo', None), params, LEVELS)
+    main.load_project('demo')
+    assert [r['version'] for r in runs.runs('demo')] == [main.run_version('demo', None)]
+
+def test_shared_database(runs):
+    '''
+    The database uses write-ahead logging, and a second archive object
+    opened on the same file sees runs saved by the first
+    '''
+    with closing(runs.connect()) as db:
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    params = archive.scenario_params('demo', ['Trident'], [0, 100000, 1], ['T1'], None, None)
+    runs.save('v1', params, LEVELS)
+    other = RunArchive(runs.path)
+    assert other.lookup(archive.scenario_key(params), 'v1') == LEVELS
+
+def test_archived_requests(monkeypatch, tmp_path):
+    '''
+    Run a scenario with the stand-in optimizer, then make sure the same request
+    (with regions in a different order) uses the archived results, and that the
+    run can be listed and replayed
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    monkeypatch.setenv('OPTIPASS_PREWARM', '0')
+    before = set(Path('tmp').glob('op*'))
+    args = 'targets=T1&targets=T2&weights=3&weights=1&budgets=0&budgets=100000&budgets=2'
+    try:
+        with TestClient(app) as client:
+            monkeypatch.setattr(main, 'run_archive', RunArchive(tmp_path / 'runs.db'))
+            first = client.get(f'/optipass/demo?regions=Trident&regions=Red+Fork&{args}').json()
+            made = set(Path('tmp').glob('op*')) - before
+            assert len(made) == 1
+            second = client.get(f'/optipass/demo?regions=Red+Fork&regions=Trident&{args}').json()
+            assert set(Path('tmp').glob('op*')) - before == made
+            assert second == first
+
+            lst = client.get('/runs/demo').json()['runs']
+            assert [r['key'] for r in lst] == [first['run']]
+            assert lst[0]['current']
+            replay = client.get(f'/runs/demo/{first["run"]}').json()
+            assert replay['summary'] == first['summary']
+            assert replay['matrix'] == first['matrix']
+            assert replay['params']['regions'] == ['Red Fork', 'Trident']
+            assert replay['params']['optimizer'] == STUB
+            replay = client.get(f'/runs/demo/{first["run"]}?components=summary').json()
+            assert 'matrix' not in replay
+            assert client.get('/runs/demo/0123456789abcdef').status_code == 404
+
+            # a run made with a different target file is not current
+            monkeypatch.setattr(main, 'run_version', lambda project, mapping: 'other')
+            assert not client.get('/runs/demo').json()['runs'][0]['current']
+            assert client.get(f'/runs/demo/{first["run"]}').status_code == 404
+    finally:
+        for p in set(Path('tmp').glob('op*')) - before:
+            shutil.rmtree(p)
@@ -0,0 +1,119 @@
+#
+# Unit tests for the potential habitat model
+#
+
+from importlib import import_module
+
+op = import_module("app.optipass","ip-server")
+OptiPass = op.OptiPass
+
+habitat = import_module("app.habitat","ip-server")
+HabitatModel = habitat.HabitatModel
+
+import pytest
+
+import os
+from pathlib import Path
+
+@pytest.fixture
+def barriers():
+    return Path(os.path.dirname(__file__)) / 'fixtures'
+
+@pytest.fixture
+def targets():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'targets.csv'
+
+@pytest.fixture
+def colnames():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'colnames.csv'
+
+def make_model(barriers, targets, colnames, tlist, weights=None):
+    op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], tlist, weights)
+    return HabitatModel.from_frames(op.barriers, op.passability, op.mapping, op.weights)
+
+def test_tree(barriers, targets, colnames):
+    '''
+    Check the downstream links and depths built by the constructor
+    '''
+    m = make_model(barriers, targets, colnames, ['T1'])
+    assert m.ids == ['A','B','C','D','E','F']
+    assert [m.ids[p] if p >= 0 else None for p in m.parent] == [None,'A','B','A','D','D']
+    assert list(m.depth) == [0,1,2,1,2,2]
+    assert m.targets == ['T1']
+
+def test_no_gates(barriers, targets, colnames):
+    '''
+    With no gates selected the potential habitat should match the
+    PTNL_HABITAT value for the $0 budget in Example 1 (Box 9)
+    '''
+    m = make_model(barriers, targets, colnames, ['T1'])
+    hab, wph = m.evaluate([])
+    assert round(wph, 3) == 1.238
+    assert round(hab[0], 3) == 1.238
+
+def test_weighted_portfolios(barriers, targets, colnames):
+    '''
+    Evaluate the portfolios selected for Example 4 (Box 11)
+    '''
+    m = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+    assert round(m.evaluate([])[1], 3) == 5.491
+    assert round(m.evaluate(['A','B'])[1], 3) == 21.084
+    hab, wph = m.evaluate(['B','C','E'])
+    assert round(hab[0], 4) == round(3 * 3.5100, 4)
+    assert round(hab[1], 4) == 4.5750
+
+def test_incremental(barriers, targets, colnames):
+    '''
+    Evaluating a portfolio after a sequence of changes should give the
+    same result as evaluating it with a new model
+    '''
+    m = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+    for gates in [['A'], ['A','F'], ['E','F'], ['B','C','E','F'], ['A','B','C','E','F'], []]:
+        hab, wph = m.evaluate(gates)
+        fresh = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+        fhab, fwph = fresh.evaluate(gates)
+        assert list(m.selected) == list(fresh.selected)
+        assert wph == pytest.approx(fwph)
+        assert list(hab) == pytest.approx(list(fhab))
+
+def test_greedy(barriers, targets, colnames):
+    '''
+    The greedy heuristic should find the optimal portfolios for Example 4
+    except at the $400K level, where the best portfolio costs more than
+    the gates with the highest benefit per dollar
+    '''
+    m = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+    optimal = [5.4906, 6.3690, 14.2266, 15.1050, 21.0840, 32.9360]
+    for i, wph in enumerate(optimal):
+        _, res = m.evaluate(m.greedy(i * 100000))
+        if i == 4:
+            assert round(res, 4) == 15.5280
+        else:
+            assert round(res, 4) == wph
+    assert m.greedy(0) == []
+    assert m.greedy(200000) == ['B','C']
+
+def test_upper_bound(barriers, targets, colnames):
+    '''
+    The upper bound should never be less than the optimal result from OptiPass
+    '''
+    m = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+    optimal = [5.4906, 6.3690, 14.2266, 15.1050, 21.0840, 32.9360]
+    for i, wph in enumerate(optimal):
+        assert m.upper_bound(i * 100000) >= wph
+    assert round(m.upper_bound(0), 4) == 5.4906
+    assert round(m.upper_bound(10**9), 4) == 34.8800
+    assert round(m.upper_bound(100000), 4) == 6.3690
+
+def test_upper_bound_all_portfolios(barriers, targets, colnames):
+    '''
+    The upper bound should be at least the value of every portfolio that
+    fits in the budget
+    '''
+    m = make_model(barriers, targets, colnames, ['T1','T2'], [3,1])
+    gates = [g for g in m.ids if m.costs[m.index[g]] >= 0]
+    portfolios = [[g for k, g in enumerate(gates) if n & (1 << k)] for n in range(1 << len(gates))]
+    values = [(sum(m.costs[m.index[g]] for g in p), m.evaluate(p)[1]) for p in portfolios]
+    for budget in range(0, 700000, 10000):
+        best = max(wph for cost, wph in values if cost <= budget)
+        assert m.upper_bound(budget) >= best - 1e-9
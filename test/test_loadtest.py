@@ -0,0 +1,130 @@
+#
+# Unit tests for the load testing tools
+#
+
+from importlib import import_module
+
+TestClient = import_module("fastapi.testclient").TestClient
+
+main = import_module("app.main","ip-server")
+app = main.app
+
+RunArchive = import_module("app.archive","ip-server").RunArchive
+
+op = import_module("app.optipass","ip-server")
+OptiPass = op.OptiPass
+
+stub = import_module("loadtest.stub","ip-server")
+loadgen = import_module("loadtest.loadgen","ip-server")
+
+import pytest
+
+import asyncio
+import httpx
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+STUB = f'{sys.executable} -m loadtest.stub --latency 0'
+
+@pytest.fixture
+def barriers():
+    return Path(os.path.dirname(__file__)) / 'fixtures'
+
+@pytest.fixture
+def targets():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'targets.csv'
+
+@pytest.fixture
+def colnames():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'colnames.csv'
+
+def test_stub_output(barriers, targets, colnames, tmp_path):
+    '''
+    The output of the stand-in should be readable by the output parser
+    '''
+    infile = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4' / 'input.txt'
+    outfile = tmp_path / 'output_0.txt'
+    subprocess.run(f'{STUB} -f {infile} -o {outfile} -b 300000 -t 2 -w 3, 1', shell=True, check=True)
+    cols = { x: [] for x in ['budget', 'habitat', 'gates']}
+    op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'])
+    op.parse_output(outfile, cols)
+    assert cols['budget'] == [300000.0]
+    assert cols['gates'] == [['B','E','F']]
+
+def test_stub_habitat():
+    '''
+    With no gates selected the stand-in should compute the same potential
+    habitat as OptiPass (Example 1, Box 9)
+    '''
+    infile = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_1' / 'input.txt'
+    cols = stub.read_barrier_file(infile)
+    assert round(stub.potential_habitat(cols, ['T1'], set())[0], 3) == 1.238
+    assert stub.choose_gates(cols, ['T1'], [1], 0) == set()
+
+def test_run_with_stub(barriers, targets, colnames, monkeypatch):
+    '''
+    Run the whole OptiPass workflow with the stand-in
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    assert op.optipass_is_installed()
+    p = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], weights=[3,1])
+    p.create_input_frame()
+    try:
+        p.run(0, 100000, 5)
+        p.collect_results()
+        assert list(p.summary.budget) == [0, 100000, 200000, 300000, 400000, 500000]
+        assert round(p.summary.wph[0],3) == 5.491
+    finally:
+        shutil.rmtree(p.tmpdir)
+
+def test_percentile():
+    '''
+    Percentiles use the nearest-rank method
+    '''
+    data = list(range(1,101))
+    assert loadgen.percentile(data, 50) == 50
+    assert loadgen.percentile(data, 99) == 99
+    assert loadgen.percentile(data, 100) == 100
+    assert loadgen.percentile([3,1,2], 50) == 2
+
+def test_summarize():
+    '''
+    Statistics are collected for each kind of request and for all requests
+    '''
+    results = [('barriers', 0.1, True), ('barriers', 0.3, True), ('optipass', 2.0, False)]
+    s = loadgen.summarize(results, 2.0)
+    assert s['all']['count'] == 3
+    assert s['all']['throughput'] == 1.5
+    assert s['barriers']['error_rate'] == 0.0
+    assert s['optipass']['error_rate'] == 1.0
+    assert s['barriers']['p50'] == 0.1 and s['barriers']['max'] == 0.3
+
+def test_load_generator(monkeypatch, tmp_path):
+    '''
+    Send a short burst of requests to the app, using the stand-in optimizer
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    monkeypatch.setenv('OPTIPASS_PREWARM', '0')
+    before = set(Path('tmp').glob('op*'))
+
+    async def burst():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            scenario = loadgen.Scenario('demo', [0, 100000, 2], seed=1)
+            await scenario.setup(client)
+            assert scenario.regions == ['Red Fork', 'Trident']
+            assert scenario.targets == ['T1', 'T2']
+            return await loadgen.run(client, scenario, loadgen.DEFAULT_MIX, concurrency=4, requests=20)
+
+    try:
+        with TestClient(app):
+            monkeypatch.setattr(main, 'run_archive', RunArchive(tmp_path / 'runs.db'))
+            summary = asyncio.run(burst())
+    finally:
+        for p in set(Path('tmp').glob('op*')) - before:
+            shutil.rmtree(p)
+    assert summary['all']['count'] == 20
+    assert summary['all']['error_rate'] == 0.0
@@ -5,13 +5,29 @@ TestClient = import_module("fastapi.testclient").TestClient
 main = import_module("app.main","ip-server")
 app = main.app
 
+import pytest
+
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
 #
 # Unit tests for Tidegates web services
 #
 
-client = TestClient(app)
+@pytest.fixture(scope='module')
+def client():
+    '''
+    A client for the app; using it in a with statement runs the lifespan
+    function that initializes the server.
+    '''
+    with TestClient(app) as c:
+        yield c
 
-def test_projects():
+def test_projects(client):
     '''
     Make sure the demo project is one of the projectes.
     '''
@@ -19,7 +35,27 @@ def test_projects():
     lst = resp.json()
     assert 'demo' in lst
 
-def test_html_demo():
+def test_bad_project(monkeypatch):
+    '''
+    A project whose data can't be loaded is left out instead of stopping the server
+    '''
+    load_project = main.load_project
+
+    def load(project):
+        if project == 'demo':
+            raise ValueError('bad data')
+        load_project(project)
+
+    monkeypatch.setattr(main, 'load_project', load)
+    try:
+        main.init()
+        assert 'demo' not in main.project_names
+    finally:
+        monkeypatch.undo()
+        main.init()
+    assert 'demo' in main.project_names
+
+def test_html_demo(client):
     '''
     Fetch the welcome message for the demo project, look for key words
     '''
@@ -29,7 +65,7 @@ def test_html_demo():
     assert s.count('OptiPass') == 9
     assert s.count('FastAPI') == 1
   
-def test_barriers_demo():
+def test_barriers_demo(client):
     '''
     Test the barriers entry point
     '''
@@ -43,7 +79,7 @@ def test_barriers_demo():
     gates = { line.split(',')[0] for line in contents[1:] }
     assert gates == {'A','B','C','D','E','F'}
    
-def test_mapinfo_demo():
+def test_mapinfo_demo(client):
     '''
     Test the mapinfo entry point
     '''
@@ -54,7 +90,7 @@ def test_mapinfo_demo():
     assert info['map_type'] == 'StaticMap'
     assert info['map_file'] == 'Riverlands.png'
 
-def test_targets_demo():
+def test_targets_demo(client):
     '''Test the targets entry point with the demo project'''
     resp = client.get('/targets/demo')
     dct = resp.json()
@@ -68,7 +104,7 @@ def test_targets_demo():
     layout = dct['layout']
     assert layout == 'T1 T2'
 
-def test_colnames_demo():
+def test_colnames_demo(client):
     resp = client.get('colnames/demo')
     dct = resp.json()
     assert 'name' in dct
@@ -76,7 +112,7 @@ def test_colnames_demo():
     assert 'files' in dct
     assert dct['files'] == ['colnames.csv']
 
-def test_unknown_project():
+def test_unknown_project(client):
     '''
     Each of the paths should check for an unknown project name
     '''
@@ -91,7 +127,7 @@ def test_unknown_project():
         resp = client.get(p)
         assert resp.status_code == 404
 
-def test_unknown_files():
+def test_unknown_files(client):
     '''
     Paths that fetch file should return 404 not found responses 
     '''
@@ -105,3 +141,408 @@ def test_unknown_files():
         assert resp.status_code == 404
         assert 'not found' in dct['detail']
 
+
+def test_evaluate_demo(client):
+    '''
+    Evaluate the portfolio selected for the $400K budget in Example 4 
+    '''
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&targets=T2&weights=3&weights=1'
+    resp = client.get(f'/evaluate/demo?{args}&gates=A&gates=B')
+    assert resp.status_code == 200
+    dct = resp.json()
+    assert dct['gates'] == ['A','B']
+    assert set(dct['habitat']) == {'T1','T2'}
+    assert round(dct['wph'],3) == 21.084
+    resp = client.get(f'/evaluate/demo?{args}')
+    assert round(resp.json()['wph'],3) == 5.491
+
+def test_evaluate_target_order(client):
+    '''
+    Weights go with targets in the order they are listed in the request
+    '''
+    args = 'regions=Trident&regions=Red+Fork&gates=A'
+    a = client.get(f'/evaluate/demo?{args}&targets=T1&targets=T2&weights=3&weights=1').json()
+    b = client.get(f'/evaluate/demo?{args}&targets=T2&targets=T1&weights=1&weights=3').json()
+    assert a['habitat'] == pytest.approx(b['habitat'])
+    assert round(a['habitat']['T1'], 3) == 9.285
+    assert a['wph'] == pytest.approx(b['wph'])
+
+def test_evaluate_bad_requests(client):
+    '''
+    Mismatched weights and unknown regions are errors
+    '''
+    args = 'regions=Trident&targets=T1&targets=T2'
+    assert client.get(f'/evaluate/demo?{args}&weights=3').status_code == 400
+    assert client.get('/evaluate/demo?regions=Nowhere&targets=T1').status_code == 404
+
+def test_evaluate_after_reload(client, monkeypatch):
+    '''
+    Habitat models made before a project's data changed are not used again
+    '''
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&targets=T2&weights=3&weights=1&gates=A'
+    client.get(f'/evaluate/demo?{args}')
+    before = set(main.habitat_models)
+    monkeypatch.setattr(main.project_models['demo'], 'version', 'reloaded')
+    resp = client.get(f'/evaluate/demo?{args}')
+    assert resp.status_code == 200
+    made = set(main.habitat_models) - before
+    assert len(made) == 1 and 'reloaded' in next(iter(made))
+
+def test_evaluate_unknown_gate(client):
+    '''
+    A gate that is not in the selected regions is an error
+    '''
+    resp = client.get('/evaluate/demo?regions=Red+Fork&targets=T1&gates=F')
+    assert resp.status_code == 404
+    assert 'unknown gates' in resp.json()['detail']
+
+def test_tiles_demo(client):
+    '''
+    Fetch the tile description and a tile for the demo map, then make sure
+    the tile is not sent again when the client already has it
+    '''
+    resp = client.get('/tiles/demo/Riverlands.png')
+    dct = resp.json()
+    assert dct['max_zoom'] == 2 and dct['tile_size'] == 256
+    resp = client.get('/tiles/demo/Riverlands.png/1/0/0')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'] == 'image/png'
+    etag = resp.headers['etag']
+    resp = client.get('/tiles/demo/Riverlands.png/1/0/0', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert client.get('/tiles/demo/Riverlands.png/1/5/5').status_code == 404
+    assert client.get('/tiles/demo/xxx.png/0/0/0').status_code == 404
+
+def test_scaled_map_demo(client):
+    '''
+    A map request with a width should return a smaller image
+    '''
+    full = client.get('/map/demo/Riverlands.png')
+    small = client.get('/map/demo/Riverlands.png?width=200')
+    assert small.status_code == 200
+    assert len(small.content) < len(full.content)
+    assert 'etag' in small.headers
+
+def test_map_not_an_image(client):
+    '''
+    Scaling or tiling a file in the map folder that isn't an image is an
+    unsupported media type, not a server error
+    '''
+    assert client.get('/map/demo/mapinfo.json?width=200').status_code == 415
+    assert client.get('/tiles/demo/mapinfo.json').status_code == 415
+    resp = client.get('/tiles/demo/mapinfo.json/0/0/0')
+    assert resp.status_code == 415
+    assert 'not an image' in resp.json()['detail']
+    assert client.get('/tiles/demo/nothing.png').status_code == 404
+
+def test_barrier_queries_demo(client):
+    '''
+    Find barriers in a viewport and near a point
+    '''
+    resp = client.get('/barriers/demo/bbox?xmin=90&ymin=400&xmax=200&ymax=500')
+    contents = resp.json()['barriers'].split('\n')
+    assert contents[0].startswith('ID,region')
+    assert { line.split(',')[0] for line in contents[1:] } == {'E','F'}
+    resp = client.get('/barriers/demo/nearest?x=330&y=200&n=2')
+    contents = resp.json()['barriers'].split('\n')
+    assert [line.split(',')[0] for line in contents[1:]] == ['A','B']
+    assert client.get('/barriers/foo/nearest?x=0&y=0').status_code == 404
+
+def test_barrier_queries_bad_coordinates(client):
+    '''
+    Coordinates that aren't finite numbers and empty boxes are rejected
+    '''
+    assert client.get('/barriers/demo/nearest?x=nan&y=200').status_code == 422
+    assert client.get('/barriers/demo/nearest?x=330&y=inf').status_code == 422
+    assert client.get('/barriers/demo/bbox?xmin=-inf&ymin=400&xmax=200&ymax=500').status_code == 422
+    resp = client.get('/barriers/demo/bbox?xmin=200&ymin=400&xmax=90&ymax=500')
+    assert resp.status_code == 422
+    assert 'empty box' in resp.json()['detail']
+
+def test_barrier_filters_demo(client):
+    '''
+    Select barriers by region, choose columns, and fetch a page of rows
+    '''
+    resp = client.get('/barriers/demo?region=Red+Fork&columns=ID&columns=cost')
+    dct = resp.json()
+    assert dct['barriers'] == 'ID,cost\nB,120000\nC,70000'
+    assert dct['total'] == 2
+    resp = client.get('/barriers/demo?offset=2&limit=3')
+    dct = resp.json()
+    assert [line.split(',')[0] for line in dct['barriers'].split('\n')[1:]] == ['C','D','E']
+    assert dct['total'] == 6
+    resp = client.get('/barriers/demo?columns=xxx')
+    assert resp.status_code == 404
+
+def test_passability_demo(client):
+    '''
+    Test the passability entry point
+    '''
+    resp = client.get('/passability/demo')
+    contents = resp.json()['passability'].split('\n')
+    assert len(contents) == 7
+    assert contents[0].startswith('ID,HAB1')
+    resp = client.get('/passability/demo?region=Red+Fork&columns=ID&columns=PRE1')
+    assert resp.json()['passability'] == 'ID,PRE1\nB,0.0\nC,0.3'
+    assert client.get('/passability/foo').status_code == 404
+
+def test_bundle_demo(client):
+    '''
+    The bundle should have the same data as the separate requests, compressed,
+    and a second request with the entity tag should get a 304 response
+    '''
+    resp = client.get('/bundle/demo')
+    assert resp.status_code == 200
+    assert resp.headers['content-encoding'] == 'gzip'
+    dct = resp.json()
+    assert dct['projects'] == client.get('/projects').json()
+    assert dct['barriers'] == client.get('/barriers/demo').json()['barriers']
+    targets = client.get('/targets/demo').json()
+    assert dct['targets'] == targets['targets']
+    assert dct['layout'] == targets['layout']
+    assert dct['colnames'] == client.get('/colnames/demo').json()
+    assert dct['mapinfo'] == client.get('/mapinfo/demo').json()['mapinfo']
+    assert dct['welcome'] == client.get('/html/demo/welcome.html').json()
+
+    etag = resp.headers['etag']
+    resp = client.get('/bundle/demo', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    resp = client.get('/bundle/demo', headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in resp.headers
+    assert resp.json() == dct
+    assert client.get('/bundle/foo').status_code == 404
+
+def test_optipass_demo(client):
+    '''
+    Run the Example 4 request in a worker process, using saved OptiPass outputs
+    '''
+    saved = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&targets=T2&weights=3&weights=1'
+    resp = client.get(f'/optipass/demo?{args}&budgets=0&budgets=100000&budgets=5&tempdir={saved}')
+    assert resp.status_code == 200
+    summary = resp.json()['summary'].split('\n')
+    assert summary[0].startswith(',budget,habitat,gates')
+    assert len(summary) == 8
+    resp = client.get(f'/optipass/demo?{args}&budgets=0&budgets=100000&budgets=5&tempdir=/no/such/dir')
+    assert resp.status_code == 500
+
+def test_optipass_components(client):
+    '''
+    Ask for the summary table only, then for the gains only
+    '''
+    saved = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&targets=T2&weights=3&weights=1'
+    args += f'&budgets=0&budgets=100000&budgets=5&tempdir={saved}'
+    dct = client.get(f'/optipass/demo?{args}&components=summary').json()
+    assert list(dct) == ['summary']
+    assert dct['summary'].split('\n')[0] == ',budget,habitat,gates,netgain'
+    dct = client.get(f'/optipass/demo?{args}&components=gains').json()
+    assert list(dct) == ['matrix']
+    assert dct['matrix'].split('\n')[0] == 'ID,T1,GAIN_T1,T2,GAIN_T2'
+    resp = client.get(f'/optipass/demo?{args}&components=plots')
+    assert resp.status_code == 404
+
+def test_region_frontiers(client, monkeypatch, tmp_path):
+    '''
+    Saved results for decomposed runs are keyed by the run version, results
+    for older versions are removed, and only the most recent ones are kept
+    '''
+    monkeypatch.setenv('OPTIPASS', f'{sys.executable} -m loadtest.stub --latency 0')
+    monkeypatch.setattr(main, 'run_archive', import_module("app.archive","ip-server").RunArchive(tmp_path / 'runs.db'))
+    monkeypatch.setattr(main, 'OPTIPASS_WORKERS', 0)
+    monkeypatch.setattr(main, 'MAX_REGION_FRONTIERS', 4)
+    stale = (('demo', 'old', ('T1',), (), ()), ('Trident',), 0)
+    other = (('other', 'old', ('T1',), (), ()), ('North',), 0)
+    main.region_frontiers.clear()
+    main.region_frontiers[stale] = main.region_frontiers[other] = (0.0, 0.0, [])
+    before = set(Path('tmp').glob('op*'))
+    try:
+        resp = client.get('/optipass/demo?regions=Trident&regions=Red+Fork&targets=T1&budgets=0&budgets=100000&budgets=5&decompose=true')
+        assert resp.status_code == 200
+        assert resp.json()['approximate'] is True
+        assert stale not in main.region_frontiers
+        assert len(main.region_frontiers) == 4
+        version = main.run_version('demo', None)
+        assert all(k[0] == ('demo', version, ('T1',), (), ()) for k in main.region_frontiers)
+        assert [k[2] for k in main.region_frontiers] == [200000, 300000, 400000, 500000]
+    finally:
+        main.region_frontiers.clear()
+        for p in set(Path('tmp').glob('op*')) - before:
+            shutil.rmtree(p)
+
+def test_ranking_demo(client):
+    '''
+    Rank gates by weighted gain per dollar, then the best gate in one region
+    '''
+    args = 'targets=T1&targets=T2&weights=3&weights=1'
+    lines = client.get(f'/ranking/demo?{args}').json()['ranking'].split('\n')
+    assert lines[0] == 'ID,region,cost,gain,ratio'
+    assert [line.split(',')[0] for line in lines[1:]] == ['B','A','E','F','C']
+    assert lines[1].split(',')[3] == '3.9888'
+    lines = client.get(f'/ranking/demo?{args}&region=Trident&k=1').json()['ranking'].split('\n')
+    assert len(lines) == 2 and lines[1].startswith('A,Trident,250000')
+    assert client.get('/ranking/demo?targets=T9').status_code == 404
+    assert client.get('/ranking/foo?targets=T1').status_code == 404
+
+def test_progressive_demo(client):
+    '''
+    A progressive request for Example 4 should stream a provisional result
+    for each budget level, then the exact results, then the tables.
+    '''
+    saved = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&targets=T2&weights=3&weights=1'
+    args += f'&budgets=0&budgets=100000&budgets=5&tempdir={saved}&progressive=true'
+    resp = client.get(f'/optipass/demo?{args}')
+    assert resp.status_code == 200
+    assert resp.headers['content-type'].startswith('application/x-ndjson')
+    lines = [json.loads(line) for line in resp.text.strip().split('\n')]
+    assert len(lines) == 13
+    provisional, exact, tables = lines[:6], lines[6:12], lines[12]
+    assert all(dct['provisional'] for dct in provisional)
+    assert [dct['level'] for dct in provisional] == list(range(6))
+    assert all(0 <= dct['gap'] <= 1 for dct in provisional)
+    assert not any(dct['provisional'] for dct in exact)
+    assert exact[4]['gates'] == ['A','B']
+    assert round(exact[4]['wph'], 3) == 21.084
+    assert all(p['wph'] <= e['wph'] + 1e-6 for p, e in zip(provisional, exact))
+    assert tables['summary'].startswith(',budget,habitat,gates')
+
+#
+# Startup time.  These tests run in a new Python process so modules
+# loaded by other tests don't affect the results.
+#
+
+IMPORT_BUDGET = 1.5       # seconds to import app.main
+STARTUP_BUDGET = 5.0      # seconds to import, initialize, and answer /projects
+
+def test_progressive_decompose(client):
+    '''
+    Progressive results can't be combined with decomposed runs
+    '''
+    args = 'regions=Trident&regions=Red+Fork&targets=T1&budgets=0&budgets=100000&budgets=5'
+    resp = client.get(f'/optipass/demo?{args}&progressive=true&decompose=true')
+    assert resp.status_code == 400
+    assert 'decompose' in resp.json()['detail']
+
+def run_python(script):
+    '''
+    Run a script and return the words on the lines it prints that start with "=>"
+    (the server's log messages are also written to stdout).
+    '''
+    root = Path(os.path.dirname(__file__)).parent
+    res = subprocess.run([sys.executable, '-c', script], cwd=root, capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    return [w for line in res.stdout.split('\n') if line.startswith('=>') for w in line[2:].split()]
+
+def test_import_time():
+    '''
+    Importing the app should not load the modules used to run OptiPass
+    '''
+    script = '''
+import sys, time
+t0 = time.perf_counter()
+import app.main
+print('=>', time.perf_counter() - t0)
+print('=>', *[m for m in ['pandas','numpy','networkx','rich','PIL'] if m in sys.modules], sep=',')
+'''
+    out = run_python(script)
+    assert float(out[0]) < IMPORT_BUDGET
+    assert len(out) == 1, f'modules loaded at import: {out[1]}'
+
+def test_first_response_time():
+    '''
+    Time from starting Python to the first response for a list of projects
+    '''
+    script = '''
+import sys, time
+t0 = time.perf_counter()
+from fastapi.testclient import TestClient
+import app.main
+with TestClient(app.main.app) as client:
+    resp = client.get('/projects')
+    print('=>', time.perf_counter() - t0, resp.status_code)
+    print('=>', *[m for m in ['pandas','networkx','PIL'] if m in sys.modules], sep=',')
+'''
+    out = run_python(script)
+    assert float(out[0]) < STARTUP_BUDGET
+    assert out[1] == '200'
+    assert len(out) == 2, f'modules loaded at startup: {out[2]}'
+
+def test_broken_worker(monkeypatch):
+    '''
+    If a worker process dies the pool is replaced, so later jobs still run
+    '''
+    monkeypatch.setattr(main, 'OPTIPASS_WORKERS', 1)
+    monkeypatch.setattr(main, 'process_pool', None)
+
+    async def jobs():
+        with pytest.raises(RuntimeError):
+            await main.run_job(os._exit, 1)
+        assert main.process_pool is None
+        return await main.run_job(abs, -3)
+
+    try:
+        assert asyncio.run(jobs()) == 3
+    finally:
+        main.process_pool.shutdown()
+
+def test_watch_projects(monkeypatch):
+    '''
+    A project whose files changed is loaded again; an error while loading it
+    is logged and the task keeps running
+    '''
+    main.init()
+    calls = []
+
+    def load(project):
+        calls.append(project)
+        if len(calls) == 1:
+            raise FileNotFoundError(project)
+        main.project_stamps[project] = main.files_stamp(main.project_files(project))
+
+    monkeypatch.setattr(main, 'RELOAD_INTERVAL', 0.01)
+    monkeypatch.setattr(main, 'load_project', load)
+    monkeypatch.setattr(main, 'project_names', ['demo'])
+    monkeypatch.setitem(main.project_stamps, 'demo', ())
+
+    async def run_for_a_while():
+        task = asyncio.create_task(main.watch_projects())
+        await asyncio.sleep(0.3)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(run_for_a_while())
+    assert calls == ['demo', 'demo']
+
+def test_project_stamp(tmp_path):
+    '''
+    The stamp changes when a file is changed or removed
+    '''
+    p = tmp_path / 'barriers.csv'
+    p.write_text('ID\nA\n')
+    before = main.files_stamp([p])
+    assert main.files_stamp([p]) == before
+    p.write_text('ID\nA\nB\n')
+    changed = main.files_stamp([p])
+    assert changed != before
+    p.unlink()
+    assert main.files_stamp([p]) == ((str(p), None, None),)
+
+def test_shutdown_doesnt_wait(monkeypatch):
+    '''
+    Stopping the server doesn't wait for OptiPass jobs that are still running
+    '''
+    import time
+    monkeypatch.setenv('OPTIPASS_PREWARM', '0')
+    monkeypatch.setenv('OPTIPASS_WORKERS', '1')
+    with TestClient(app):
+        job = asyncio.run(main.run_job(abs, -1))
+        pool = main.process_pool
+        future = pool.submit(time.sleep, 3)
+        while not future.running():
+            time.sleep(0.05)
+        time.sleep(0.2)
+        t0 = time.perf_counter()
+    assert job == 1
+    assert time.perf_counter() - t0 < 1
+    assert main.process_pool is None
@@ -0,0 +1,121 @@
+#
+# Unit tests for the shared project model
+#
+
+from importlib import import_module
+
+model = import_module("app.model","ip-server")
+ProjectModel = model.ProjectModel
+
+op = import_module("app.optipass","ip-server")
+OptiPass = op.OptiPass
+
+import pytest
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+@pytest.fixture
+def barriers():
+    return Path(os.path.dirname(__file__)) / 'fixtures'
+
+@pytest.fixture
+def targets():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'targets.csv'
+
+@pytest.fixture
+def colnames():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'colnames.csv'
+
+@pytest.fixture
+def project(barriers, tmp_path):
+    return ProjectModel.publish('fixtures', barriers, tmp_path)
+
+def test_publish(project, barriers, tmp_path):
+    '''
+    Publishing makes one folder of read-only arrays, and publishing
+    the same data again attaches to the same folder
+    '''
+    assert project.path.parent == tmp_path
+    assert project.path.name == f'fixtures-{project.version}-{model.FORMAT}'
+    assert len(project) == 6
+    assert project.passability.dtype == np.float32
+    assert project.dsid.dtype == np.int32
+    assert not project.passability.flags.writeable
+    again = ProjectModel.publish('fixtures', barriers, tmp_path)
+    assert again.path == project.path
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_old_versions(barriers, tmp_path):
+    '''
+    Publishing removes other versions of the project but not other projects
+    whose names start with the same characters
+    '''
+    for name in ['fixtures-0123456789abcdef', 'fixtures-0123456789abcdef-1', 'fixtures-2-0123456789abcdef-2']:
+        (tmp_path / name).mkdir()
+    project = ProjectModel.publish('fixtures', barriers, tmp_path)
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted([project.path.name, 'fixtures-2-0123456789abcdef-2'])
+
+def test_precise_values(barriers, tmp_path):
+    '''
+    Passability values that can't be saved as 32-bit floats are saved as 64-bit floats
+    '''
+    data = tmp_path / 'data'
+    data.mkdir()
+    shutil.copy(barriers / 'barriers.csv', data)
+    pf = pd.read_csv(barriers / 'passability.csv')
+    col = pf.columns[-1]
+    pf.loc[0, col] = 12.3456789
+    pf.to_csv(data / 'passability.csv', index=False)
+    project = ProjectModel.publish('fixtures', data, tmp_path / 'models')
+    assert project.passability.dtype == np.float64
+    _, frame = project.frames(['Trident','Red Fork'])
+    assert frame.loc[0, col] == 12.3456789
+
+def test_arrays(project):
+    '''
+    Check the ID table, downstream links, and missing values
+    '''
+    assert project.ids.tolist() == ['A','B','C','D','E','F']
+    assert project.dsid.tolist() == [-1,0,1,0,3,3]
+    assert project.regions == ['Red Fork','Trident']
+    assert list(project.rows(['Red Fork'])) == [1,2]
+    assert np.isnan(project.cost[3])
+    assert np.isnan(project.passability[3, project.column_index['POST1']])
+
+def test_frames(project, barriers):
+    '''
+    Frames made from the model should have the same values as the CSV files
+    '''
+    bf, pf = project.frames(['Trident','Red Fork'])
+    expected = pd.read_csv(barriers/'passability.csv')
+    assert list(bf.ID) == list(expected.ID)
+    assert bf.DSID.isnull().tolist() == [True,False,False,False,False,False]
+    pd.testing.assert_frame_equal(pf, expected)
+
+def test_frame_columns(project, barriers):
+    '''
+    A frame can have a subset of the passability columns; each column is
+    converted to 64-bit floats only once
+    '''
+    _, pf = project.frames(['Trident','Red Fork'], ['PRE1', 'HAB1'])
+    expected = pd.read_csv(barriers/'passability.csv')[['ID', 'HAB1', 'PRE1']]
+    pd.testing.assert_frame_equal(pf, expected)
+    assert set(project.exact) == {'HAB1', 'PRE1'}
+    assert project.column('HAB1') is project.column('HAB1')
+
+def test_optipass_with_model(project, targets, colnames):
+    '''
+    Example 4 should have the same results when the data comes from the model
+    '''
+    p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    op = OptiPass(project, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], weights=[3,1], tmpdir=p)
+    op.create_input_frame()
+    op.create_paths()
+    op.collect_results()
+    assert op.paths['F'] == ['F','D','A']
+    assert round(op.summary.wph[0],3) == 5.491
+    assert round(op.summary.wph[4],3) == 21.084
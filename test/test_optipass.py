@@ -16,6 +16,8 @@ import pytest
 
 import os
 import pandas as pd
+import shutil
+import sys
 from pathlib import Path
 
 @pytest.fixture
@@ -161,7 +163,6 @@ def test_example_1(barriers, targets, colnames):
     p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_1'
     op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1'], tmpdir=p)
     op.create_input_frame()
-    op.create_paths()
     op.collect_results()
 
     assert type(op.summary) == pd.DataFrame
@@ -187,7 +188,6 @@ def test_example_4(barriers, targets, colnames):
     p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
     op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], tmpdir=p)
     op.create_input_frame()
-    op.create_paths()
     op.collect_results()
     
     assert type(op.summary) == pd.DataFrame
@@ -210,7 +210,6 @@ def test_potential_habitat_1(barriers, targets, colnames):
     p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_1'
     op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1'], tmpdir=p)
     op.create_input_frame()
-    op.create_paths()
     op.collect_results()
 
     m = op.summary
@@ -227,7 +226,6 @@ def test_potential_habitat_4(barriers, targets, colnames):
     p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
     op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], weights=[3,1], tmpdir=p)
     op.create_input_frame()
-    op.create_paths()
     op.collect_results()
 
     m = op.summary
@@ -235,3 +233,116 @@ def test_potential_habitat_4(barriers, targets, colnames):
     assert 'T1' in m.columns and 'T2' in m.columns and 'wph' in m.columns
     assert round(m.wph[0],3) == 5.491
     assert round(m.wph[4],3) == 21.084    # PTNL_HABITAT at $400K
+
+def test_components(barriers, targets, colnames):
+    '''
+    Build only the parts of the tables that are requested
+    '''
+    p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], weights=[3,1], tmpdir=p)
+    op.create_input_frame()
+    summary, matrix = op.collect_results(['summary'])
+    assert list(summary.columns) == ['budget', 'habitat', 'gates', 'netgain']
+    assert len(matrix.columns) == 0
+    summary, matrix = op.collect_results(['habitat', 'matrix'])
+    assert list(summary.columns) == ['budget', 'habitat', 'gates', 'T1', 'T2', 'wph', 'netgain']
+    assert list(matrix.columns) == [0, 100000, 200000, 300000, 400000, 500000, 'count']
+    assert round(summary.wph[4],3) == 21.084
+
+def test_potential_habitat_paths(barriers, targets, colnames):
+    '''
+    The incremental values in the summary should match the product of the
+    passabilities along the downstream path from each barrier, at every budget level
+    '''
+    p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], weights=[3,1], tmpdir=p)
+    op.create_input_frame()
+    op.create_paths()
+    op.collect_results()
+
+    df = op.passability.fillna(0).set_index('ID')
+    for i, gates in enumerate(op.summary.gates):
+        for j, t in enumerate(op.mapping.itertuples()):
+            pvec = df[t.postpass].where(df.index.isin(gates), df[t.prepass])
+            expected = sum(pd.Series(pvec[op.paths[b]]).prod() * df.loc[b, t.unscaled] for b in df.index)
+            assert op.summary[t.Index][i] == pytest.approx(expected * op.weights[j])
+
+@pytest.fixture
+def split_barriers(tmp_path):
+    '''
+    A copy of the demo data where the Red Fork does not flow into the Trident,
+    so the two regions are independent river systems
+    '''
+    src = Path(os.path.dirname(__file__)) / 'fixtures'
+    bf = pd.read_csv(src / 'barriers.csv')
+    bf.loc[bf.ID == 'B', 'DSID'] = None
+    bf.to_csv(tmp_path / 'barriers.csv', index=False)
+    pd.read_csv(src / 'passability.csv').to_csv(tmp_path / 'passability.csv', index=False)
+    return tmp_path
+
+def test_region_groups(barriers, split_barriers, targets, colnames):
+    '''
+    Regions are in the same group when a barrier in one is downstream from
+    a barrier in the other
+    '''
+    op = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1'])
+    assert op.region_groups() == [['Red Fork', 'Trident']]
+    op = OptiPass(split_barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1'])
+    assert op.region_groups() == [['Red Fork'], ['Trident']]
+
+def test_merge_frontiers():
+    '''
+    The merged result for each budget should be the best feasible combination
+    of one result from each group
+    '''
+    f1 = [(0, 1.0, []), (50, 3.0, ['a']), (100, 4.0, ['a','b'])]
+    f2 = [(0, 2.0, []), (60, 5.0, ['c'])]
+    cols = op.merge_frontiers([f1, f2], [0, 50, 100, 150])
+    assert cols['budget'] == [0.0, 50.0, 100.0, 150.0]
+    assert cols['habitat'] == [3.0, 5.0, 6.0, 8.0]
+    assert cols['gates'] == [[], ['a'], ['c'], ['a','c']]
+
+def test_decomposed(split_barriers, targets, colnames, monkeypatch):
+    '''
+    Run each river system separately using the stand-in optimizer.  The combined
+    portfolios have to fit in the budgets, and a second request should use the
+    saved results instead of running the optimizer again.
+    '''
+    monkeypatch.setenv('OPTIPASS', f'{sys.executable} -m loadtest.stub --latency 0')
+    before = set(Path('tmp').glob('op*'))
+    cache = { }
+    args = [split_barriers, targets, colnames, ['Trident', 'Red Fork'], [0, 100000, 5], ['T1','T2'], [3,1]]
+    try:
+        summary, matrix = op.run_decomposed(*args, cache=cache)
+        assert set(Path('tmp').glob('op*')) == before
+    finally:
+        for p in set(Path('tmp').glob('op*')) - before:
+            shutil.rmtree(p)
+    assert len(summary) == 6
+    assert len(cache) == 12
+    costs = pd.read_csv(split_barriers / 'barriers.csv').set_index('ID').cost
+    for b, gates in zip(summary.budget, summary.gates):
+        assert sum(costs[g] for g in gates) <= b
+    assert list(summary.habitat) == sorted(summary.habitat)
+    assert list(summary.wph) == pytest.approx(list(summary.habitat), abs=1e-3)
+
+    monkeypatch.setenv('OPTIPASS', 'false')
+    again, _ = op.run_decomposed(*args, cache=cache)
+    assert list(again.gates) == list(summary.gates)
+
+def test_optipass_job(barriers, targets, colnames, tmp_path):
+    '''
+    A job run by a worker process returns the tables in CSV format
+    '''
+    model = import_module("app.model","ip-server").ProjectModel.publish('demo', barriers, tmp_path)
+    p = Path(os.path.dirname(__file__)) / 'fixtures' / 'Example_4'
+    args = [model.path, targets, colnames, ['Trident', 'Red Fork'], [0, 100000, 5], ['T1','T2'], [3,1], p]
+    summary, matrix, levels, frontiers = op.optipass_job(*args)
+    assert summary.startswith(',budget,habitat,gates')
+    assert matrix.split('\n')[1].startswith('A,')
+    assert levels['gates'][4] == ['A','B']
+    assert frontiers is None
+    assert op.worker_models[model.path] is not None
+
+    args = [model.path, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], [3,1], levels]
+    assert op.rebuild_job(*args) == (summary, matrix)
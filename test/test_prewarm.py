@@ -0,0 +1,238 @@
+#
+# Unit tests for default scenarios
+#
+
+from importlib import import_module
+
+main = import_module("app.main","ip-server")
+
+prewarm = import_module("app.prewarm","ip-server")
+read_scenarios = prewarm.read_scenarios
+
+archive = import_module("app.archive","ip-server")
+RunArchive = archive.RunArchive
+
+import pytest
+
+import asyncio
+import json
+import shutil
+import sys
+import types
+from pathlib import Path
+
+STUB = f'{sys.executable} -m loadtest.stub --latency 0'
+
+REGIONS = ['Trident', 'Red Fork']
+TARGETS = ['T1', 'T2']
+
+@pytest.fixture
+def scenario_file(tmp_path):
+    '''
+    Return a function that writes a scenario spec to a file
+    '''
+    def write(spec):
+        p = tmp_path / 'scenarios.json'
+        p.write_text(json.dumps(spec))
+        return p
+    return write
+
+def test_defaults(scenario_file):
+    '''
+    Parameters that aren't in a scenario come from the defaults
+    '''
+    p = scenario_file({
+        'defaults': {'budgets': [0, 100000, 5], 'targets': ['T1']},
+        'scenarios': [{'regions': ['Trident']}, {'regions': ['Red Fork'], 'targets': ['T2']}],
+    })
+    lst = read_scenarios(p, REGIONS, TARGETS)
+    assert len(lst) == 2
+    assert lst[0] == {
+        'regions': ['Trident'],
+        'targets': ['T1'],
+        'budgets': [0, 100000, 5],
+        'weights': None,
+        'mapping': None,
+    }
+    assert lst[1]['targets'] == ['T2']
+    assert lst[1]['budgets'] == [0, 100000, 5]
+
+def test_keywords(scenario_file):
+    '''
+    "each" makes one scenario per region, "all" means every region or target
+    '''
+    p = scenario_file({
+        'defaults': {'budgets': [0, 100000, 5], 'targets': 'all'},
+        'scenarios': [{'regions': 'each'}, {'regions': 'all'}],
+    })
+    lst = read_scenarios(p, REGIONS, TARGETS)
+    assert [s['regions'] for s in lst] == [['Red Fork'], ['Trident'], ['Red Fork', 'Trident']]
+    assert all(s['targets'] == TARGETS for s in lst)
+
+def test_bad_scenarios(scenario_file):
+    '''
+    Unknown parameters and missing budgets or targets are errors
+    '''
+    p = scenario_file({'scenarios': [{'regions': 'all', 'budgets': [0, 100, 1], 'targets': 'all', 'budget': 5}]})
+    with pytest.raises(AssertionError):
+        read_scenarios(p, REGIONS, TARGETS)
+    p = scenario_file({'scenarios': [{'regions': 'all', 'targets': 'all'}]})
+    with pytest.raises(AssertionError):
+        read_scenarios(p, REGIONS, TARGETS)
+    p = scenario_file({'scenarios': [{'regions': 'all', 'budgets': [0, 100, 1]}]})
+    with pytest.raises(AssertionError):
+        read_scenarios(p, REGIONS, TARGETS)
+
+def test_prewarm_demo(monkeypatch, tmp_path):
+    '''
+    Run the default scenarios for the demo project with the stand-in optimizer.
+    The results should be in the archive, and running them a second time should
+    not start OptiPass again.
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    monkeypatch.setenv('OPTIPASS_PREWARM', '0')
+    main.init()
+    runs = RunArchive(tmp_path / 'runs.db')
+    monkeypatch.setattr(main, 'run_archive', runs)
+    before = set(Path('tmp').glob('op*'))
+
+    async def run_twice():
+        try:
+            await main.prewarm('demo')
+            made = set(Path('tmp').glob('op*')) - before
+            await main.prewarm('demo')
+            return made, set(Path('tmp').glob('op*')) - before
+        finally:
+            main.prewarm_pool.shutdown()
+            main.prewarm_pool = None
+
+    try:
+        first, second = asyncio.run(run_twice())
+        assert len(first) == 3
+        assert second == first
+        saved = runs.runs('demo')
+        assert sorted(r['params']['regions'] for r in saved) == [['Red Fork'], ['Red Fork', 'Trident'], ['Trident']]
+        key = archive.scenario_key(archive.scenario_params('demo', ['Trident', 'Red Fork'], [0, 100000, 5], TARGETS, None, None, optimizer=STUB))
+        levels = runs.lookup(key, main.run_version('demo', None))
+        assert levels['budget'] == [0, 100000, 200000, 300000, 400000, 500000]
+    finally:
+        for p in set(Path('tmp').glob('op*')) - before:
+            shutil.rmtree(p)
+
+def test_prewarm_errors(monkeypatch, tmp_path):
+    '''
+    An error while running a project's scenarios is logged and the background
+    task keeps running
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    monkeypatch.setenv('OPTIPASS_PREWARM_DELAY', '0')
+    monkeypatch.setenv('OPTIPASS_PREWARM_INTERVAL', '0.01')
+    main.init()
+    calls = []
+
+    async def run_scenarios(project):
+        calls.append(project)
+        if len(calls) == 1:
+            raise FileNotFoundError(project)
+
+    monkeypatch.setattr(main, 'prewarm', run_scenarios)
+    monkeypatch.setattr(main, 'project_names', ['demo'])
+    monkeypatch.setattr(main, 'PREWARM_LOCK', tmp_path / 'prewarm.lock')
+
+    async def run_for_a_while():
+        task = asyncio.create_task(main.prewarm_projects())
+        await asyncio.sleep(0.5)
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(run_for_a_while())
+    assert calls[:2] == ['demo', 'demo']
+
+def test_lower_priority_windows(monkeypatch):
+    '''
+    On Windows the worker process is put in the below normal priority class
+    '''
+    calls = []
+
+    class Process:
+        def nice(self, value):
+            calls.append(value)
+
+    psutil = types.ModuleType('psutil')
+    psutil.Process = Process
+    psutil.BELOW_NORMAL_PRIORITY_CLASS = 0x4000
+    monkeypatch.setitem(sys.modules, 'psutil', psutil)
+    monkeypatch.delattr(prewarm.os, 'nice', raising=False)
+    monkeypatch.setattr(prewarm.sys, 'platform', 'win32')
+    prewarm.lower_priority()
+    assert calls == [0x4000]
+
+def test_claim(tmp_path):
+    '''
+    Only one holder of the lock at a time; closing the file releases it
+    '''
+    first = prewarm.claim(tmp_path / 'prewarm.lock')
+    assert first is not None
+    assert prewarm.claim(tmp_path / 'prewarm.lock') is None
+    first.close()
+    second = prewarm.claim(tmp_path / 'prewarm.lock')
+    assert second is not None
+    second.close()
+
+def test_prewarm_one_process(monkeypatch, tmp_path):
+    '''
+    A process that doesn't hold the lock doesn't run scenarios; it takes over
+    when the lock is released
+    '''
+    monkeypatch.setenv('OPTIPASS', STUB)
+    monkeypatch.setenv('OPTIPASS_PREWARM_DELAY', '0')
+    monkeypatch.setenv('OPTIPASS_PREWARM_INTERVAL', '0.05')
+    main.init()
+    calls = []
+
+    async def run_scenarios(project):
+        calls.append(project)
+
+    monkeypatch.setattr(main, 'prewarm', run_scenarios)
+    monkeypatch.setattr(main, 'project_names', ['demo'])
+    monkeypatch.setattr(main, 'PREWARM_LOCK', tmp_path / 'prewarm.lock')
+    other = prewarm.claim(tmp_path / 'prewarm.lock')
+
+    async def run_for_a_while():
+        task = asyncio.create_task(main.prewarm_projects())
+        await asyncio.sleep(0.3)
+        assert calls == []
+        other.close()
+        await asyncio.sleep(0.3)
+        task.cancel()
+
+    asyncio.run(run_for_a_while())
+    assert 'demo' in calls
+
+def test_reload_without_optipass(monkeypatch):
+    '''
+    Changed projects are reloaded even when OptiPass is not installed and
+    the scenarios can't be run
+    '''
+    monkeypatch.setenv('OPTIPASS_PREWARM_DELAY', '0')
+    main.init()
+    optipass = import_module("app.optipass","ip-server")
+    calls = []
+
+    def load(project):
+        calls.append(project)
+
+    monkeypatch.setattr(optipass, 'optipass_is_installed', lambda: False)
+    monkeypatch.setattr(main, 'RELOAD_INTERVAL', 0.01)
+    monkeypatch.setattr(main, 'load_project', load)
+    monkeypatch.setattr(main, 'project_names', ['demo'])
+    monkeypatch.setitem(main.project_stamps, 'demo', ())
+
+    async def run_for_a_while():
+        tasks = [asyncio.create_task(main.prewarm_projects()), asyncio.create_task(main.watch_projects())]
+        await asyncio.sleep(0.2)
+        assert tasks[0].done() and not tasks[1].done()
+        tasks[1].cancel()
+
+    asyncio.run(run_for_a_while())
+    assert 'demo' in calls
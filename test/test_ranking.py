@@ -0,0 +1,72 @@
+#
+# Unit tests for the gate ranking
+#
+
+from importlib import import_module
+
+model = import_module("app.model","ip-server")
+ProjectModel = model.ProjectModel
+
+ranking = import_module("app.ranking","ip-server")
+GateRanking = ranking.GateRanking
+
+op = import_module("app.optipass","ip-server")
+OptiPass = op.OptiPass
+
+habitat = import_module("app.habitat","ip-server")
+HabitatModel = habitat.HabitatModel
+
+tables = import_module("app.tables","ip-server")
+Table = tables.Table
+
+import pytest
+
+import os
+from pathlib import Path
+
+@pytest.fixture
+def barriers():
+    return Path(os.path.dirname(__file__)) / 'fixtures'
+
+@pytest.fixture
+def targets():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'targets.csv'
+
+@pytest.fixture
+def colnames():
+    return Path(os.path.dirname(__file__)) / 'fixtures' / 'colnames.csv'
+
+@pytest.fixture
+def gate_ranking(barriers, colnames, tmp_path):
+    project = ProjectModel.publish('fixtures', barriers, tmp_path)
+    return GateRanking(project, Table.read(colnames))
+
+def test_standalone_gains(gate_ranking, barriers, targets, colnames):
+    '''
+    The gain for a gate should be the change in weighted potential habitat
+    computed by the habitat model when that gate is the only one restored
+    '''
+    p = OptiPass(barriers, targets, colnames, ['Trident', 'Red Fork'], ['T1','T2'], [3,1])
+    m = HabitatModel.from_frames(p.barriers, p.passability, p.mapping, p.weights)
+    _, base = m.evaluate([])
+    rows, gains, ratios = gate_ranking.top(['T1','T2'], [3,1])
+    ids = [gate_ranking.model.ids[i] for i in rows]
+    assert 'D' not in ids
+    for x, g in zip(ids, gains):
+        assert g == pytest.approx(m.evaluate([x])[1] - base)
+    assert list(ratios) == sorted(ratios, reverse=True)
+
+def test_top_k(gate_ranking):
+    '''
+    Rankings for one target use the sorted index; filters and limits apply
+    to rankings for one or more targets
+    '''
+    rows, gains, ratios = gate_ranking.top(['T1'])
+    assert [gate_ranking.model.ids[i] for i in rows] == ['A', 'B', 'E', 'F', 'C']
+    assert round(gains[1], 4) == 0.876
+    rows, _, _ = gate_ranking.top(['T1'], regions=['Trident'], k=2)
+    assert [gate_ranking.model.ids[i] for i in rows] == ['A', 'E']
+    rows, _, _ = gate_ranking.top(['T1','T2'], [3,1], regions=['Red Fork'], k=1)
+    assert [gate_ranking.model.ids[i] for i in rows] == ['B']
+    with pytest.raises(AssertionError):
+        gate_ranking.top(['T9'])
@@ -0,0 +1,93 @@
+#
+# Unit tests for the spatial index
+#
+
+from importlib import import_module
+
+spatial = import_module("app.spatial","ip-server")
+GridIndex = spatial.GridIndex
+
+import pytest
+
+import random
+import time
+from math import hypot, inf, nan
+
+# X and Y coordinates of barriers A through F in the demo project
+
+XS = [330, 235, 148, 195, 100, 125]
+YS = [202, 230, 220, 335, 440, 450]
+
+def test_grid():
+    '''
+    Every point should be in exactly one cell
+    '''
+    g = GridIndex(XS, YS)
+    assert len(g) == 6
+    assert g.ncols * g.nrows >= 6
+
+def test_missing_coordinates():
+    '''
+    Points without coordinates are not added to the grid
+    '''
+    g = GridIndex(XS + [nan], YS + [100])
+    assert len(g) == 6
+    assert g.within(0, 0, 1000, 1000) == [0,1,2,3,4,5]
+
+def test_within():
+    '''
+    Find barriers inside rectangles on the demo map
+    '''
+    g = GridIndex(XS, YS)
+    assert g.within(0, 0, 1000, 1000) == [0,1,2,3,4,5]
+    assert g.within(90, 400, 200, 500) == [4,5]
+    assert g.within(148, 220, 235, 230) == [1,2]
+    assert g.within(500, 500, 600, 600) == []
+
+def test_nearest():
+    '''
+    Find barriers closest to points on the demo map
+    '''
+    g = GridIndex(XS, YS)
+    assert g.nearest(330, 200, 1) == [0]
+    assert g.nearest(110, 445, 2) in ([4,5], [5,4])
+    assert g.nearest(0, 0, 10) == sorted(range(6), key=lambda i: hypot(XS[i], YS[i]))
+
+def test_random_points():
+    '''
+    Compare grid searches with brute force searches on random points
+    '''
+    rng = random.Random(42)
+    xs = [rng.uniform(0, 100) for _ in range(500)]
+    ys = [rng.uniform(0, 50) for _ in range(500)]
+    g = GridIndex(xs, ys)
+    for _ in range(20):
+        x0, x1 = sorted(rng.uniform(-10, 110) for _ in range(2))
+        y0, y1 = sorted(rng.uniform(-10, 60) for _ in range(2))
+        expected = [i for i in range(500) if x0 <= xs[i] <= x1 and y0 <= ys[i] <= y1]
+        assert g.within(x0, y0, x1, y1) == expected
+        x, y = rng.uniform(-20, 120), rng.uniform(-20, 70)
+        dist = sorted(hypot(xs[i]-x, ys[i]-y) for i in range(500))
+        assert [hypot(xs[i]-x, ys[i]-y) for i in g.nearest(x, y, 7)] == dist[:7]
+
+def test_distant_points():
+    '''
+    A search from a location far outside the grid only looks at cells in the grid
+    '''
+    g = GridIndex(XS, YS)
+    t0 = time.perf_counter()
+    assert g.nearest(1e9, 1e9, 1) == [max(range(6), key=lambda i: XS[i] + YS[i])]
+    assert g.nearest(-1e9, 0, 6) == sorted(range(6), key=lambda i: hypot(XS[i] + 1e9, YS[i]))
+    assert time.perf_counter() - t0 < 0.1
+
+def test_bad_coordinates():
+    '''
+    NaN and infinite coordinates are errors
+    '''
+    g = GridIndex(XS, YS)
+    with pytest.raises(ValueError):
+        g.nearest(nan, 0, 1)
+    with pytest.raises(ValueError):
+        g.nearest(0, inf, 1)
+    with pytest.raises(ValueError):
+        g.within(-inf, 0, 500, 500)
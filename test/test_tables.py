@@ -0,0 +1,60 @@
+#
+# Unit tests for in-memory CSV tables
+#
+
+from importlib import import_module
+
+tables = import_module("app.tables","ip-server")
+Table = tables.Table
+
+import pytest
+
+import os
+from pathlib import Path
+
+@pytest.fixture
+def barriers():
+    return Table.read(Path(os.path.dirname(__file__)) / 'fixtures' / 'barriers.csv')
+
+def test_read(barriers):
+    '''
+    Check the header and columns of the fixture barrier file
+    '''
+    assert len(barriers) == 6
+    assert barriers.header[0] == 'ID' and barriers.header[-1] == 'comment'
+    assert barriers.columns['ID'] == ['A','B','C','D','E','F']
+    assert barriers.columns['cost'][3] == 'NA'
+
+def test_round_trip(barriers):
+    '''
+    Writing all rows and columns should reproduce the original file
+    '''
+    p = Path(os.path.dirname(__file__)) / 'fixtures' / 'barriers.csv'
+    assert barriers.to_csv() == p.read_text().rstrip()
+
+def test_original_text(tmp_path):
+    '''
+    Quoting and line endings in the file are kept when the whole table is written
+    '''
+    p = tmp_path / 'quoted.csv'
+    p.write_bytes(b'"ID","name"\r\n"A","Red Fork"\r\n"B","x, y"\r\n')
+    t = Table.read(p)
+    assert t.columns['name'] == ['Red Fork', 'x, y']
+    assert t.to_csv() == '"ID","name"\n"A","Red Fork"\n"B","x, y"'
+    assert t.to_csv([1], ['name']) == 'name\n"x, y"'
+
+def test_select(barriers):
+    '''
+    Select rows and columns
+    '''
+    assert barriers.to_csv([1,2], ['ID','cost']) == 'ID,cost\nB,120000\nC,70000'
+    assert barriers.to_csv([], ['ID']) == 'ID'
+
+def test_index(barriers):
+    '''
+    Find rows using an index on the region column
+    '''
+    barriers.add_index('region')
+    assert barriers.find('region', ['Red Fork']) == [1,2]
+    assert barriers.find('region', ['Red Fork','Trident']) == [0,1,2,3,4,5]
+    assert barriers.find('region', ['Dorne']) == []
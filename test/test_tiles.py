@@ -0,0 +1,95 @@
+#
+# Unit tests for the image pyramids made for static maps
+#
+
+from importlib import import_module
+
+tiles = import_module("app.tiles","ip-server")
+MapPyramid = tiles.MapPyramid
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+import threading
+from PIL import Image
+
+@pytest.fixture
+def pyramid():
+    return MapPyramid(Path('static/maps/demo/Riverlands.png'))
+
+def test_levels(pyramid):
+    '''
+    The demo map is 473 x 533, so it should have three levels
+    '''
+    assert (pyramid.width, pyramid.height) == (473, 533)
+    assert pyramid.max_zoom == 2
+    assert pyramid.info()['levels'] == [(119,134), (237,267), (473,533)]
+    assert pyramid.levels == { }
+
+def test_tiles(pyramid):
+    '''
+    Tiles at the edges of a level are cropped to the size of the level
+    '''
+    img = Image.open(BytesIO(pyramid.tile(0,0,0)))
+    assert img.size == (119,134)
+    img = Image.open(BytesIO(pyramid.tile(2,1,2)))
+    assert img.size == (473-256, 533-512)
+    assert pyramid.tile(2,1,2) is pyramid.tile(2,1,2)
+    with pytest.raises(AssertionError):
+        pyramid.tile(2,2,0)
+    with pytest.raises(AssertionError):
+        pyramid.tile(3,0,0)
+
+def test_scaled(pyramid):
+    '''
+    A scaled map is the smallest level at least as wide as the request
+    '''
+    assert pyramid.scaled(100)[0] == 0
+    assert pyramid.scaled(119)[0] == 0
+    z, png = pyramid.scaled(200)
+    assert z == 1
+    assert Image.open(BytesIO(png)).size == (237,267)
+    assert pyramid.scaled(1000)[0] == 2
+
+def test_threads(pyramid):
+    '''
+    Requests from several threads at once get the same tile, made only once
+    '''
+    with ThreadPoolExecutor(8) as pool:
+        pngs = list(pool.map(lambda _: pyramid.tile(1,0,0), range(16)))
+    assert all(p is pngs[0] for p in pngs)
+
+def test_lru(pyramid):
+    '''
+    Only the most recently used levels and tiles are kept
+    '''
+    pyramid.max_levels = 2
+    pyramid.max_images = 2
+    first = pyramid.tile(2,0,0)
+    pyramid.tile(1,0,0)
+    pyramid.tile(0,0,0)
+    assert list(pyramid.levels) == [1, 0]
+    assert list(pyramid.images) == [(1,0,0), (0,0,0)]
+    pyramid.tile(1,0,0)
+    pyramid.tile(2,0,0)
+    assert list(pyramid.images) == [(1,0,0), (2,0,0)]
+    assert pyramid.tile(2,0,0) == first
+
+def test_encode_in_parallel(pyramid, monkeypatch):
+    '''
+    Different tiles are encoded at the same time in different threads
+    '''
+    pyramid.level(2)
+    barrier = threading.Barrier(2, timeout=5)
+    png = pyramid._png
+
+    def encode(img):
+        barrier.wait()
+        return png(img)
+
+    monkeypatch.setattr(pyramid, '_png', encode)
+    with ThreadPoolExecutor(2) as pool:
+        tiles = list(pool.map(lambda x: pyramid.tile(2,x,0), [0, 1]))
+    assert len(tiles) == 2